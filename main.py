@@ -2,11 +2,30 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import os
+import sys
 import asyncio
 import asyncpg
+import bisect
+import functools
 from datetime import datetime, timedelta
+import heapq
+import hashlib
+import html
+import io
+import json
 import math
+import random
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+from types import SimpleNamespace
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import aiohttp  # Для нейросети
+from aiohttp import web  # Для /metrics
 
 # ================== ТВОИ ID ==================
 GUILD_ID = 1422153897362849905
@@ -18,6 +37,232 @@ ROLES = {
     "support": 1473349102422196314,
 }
 
+# ================== МЕТРИКИ ==================
+# Гистограммы и счётчики в памяти, отдаются в формате Prometheus на METRICS_HOST:METRICS_PORT/metrics.
+# Запись — одно деление пополам и два сложения, так что сбор включён всегда; порт 0 выключает только HTTP.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def render_labels(names, values):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._series = {}  # значения меток -> [счётчики корзин (последняя — +Inf), сумма]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in list(self._series.items()):
+            labels = render_labels(self.labels, values)
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (None,), counts):
+                cumulative += count
+                le = "+Inf" if bound is None else repr(bound)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values = {}
+
+    def inc(self, *label_values):
+        self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for values, value in list(self._values.items()):
+            labels = render_labels(self.labels, values)
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+class Gauge:
+    """Значение снимается функцией в момент запроса /metrics; kind='counter' — для растущих счётчиков из stats()"""
+
+    def __init__(self, name, doc, read, kind='gauge'):
+        self.name, self.doc, self.read, self.kind = name, doc, read, kind
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+class Metrics:
+    def __init__(self):
+        self._metrics = []
+        self._runner = None
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request):
+        return web.Response(body=self.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"📈 Метрики: http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class StartupTimer:
+    """Сколько длился каждый этап запуска, от импорта модуля до первого on_ready"""
+
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self._last) * 1000))
+        self._last = now
+
+    def report(self):
+        total = (self._last - self.started) * 1000
+        return " • ".join(f"{phase} {ms:.0f} мс" for phase, ms in self.phases) + f" • итого {total:.0f} мс"
+
+startup = StartupTimer()
+
+metrics = Metrics()
+COMMAND_SECONDS = metrics.add(Histogram('bot_command_duration_seconds', 'Время выполнения слэш-команды', ('command',)))
+COMMAND_ERRORS = metrics.add(Counter('bot_command_errors_total', 'Ошибки слэш-команд', ('command', 'error')))
+EVENT_SECONDS = metrics.add(Histogram('bot_event_duration_seconds', 'Время обработчика события', ('event',)))
+EVENT_ERRORS = metrics.add(Counter('bot_event_errors_total', 'Ошибки обработчиков событий', ('event', 'error')))
+GATEWAY_EVENTS = metrics.add(Counter('bot_gateway_events_total', 'Разосланные события шлюза', ('event',)))
+QUERY_SECONDS = metrics.add(Histogram('db_query_duration_seconds', 'Время запроса к БД', ('query',)))
+QUERY_ERRORS = metrics.add(Counter('db_query_errors_total', 'Ошибки запросов к БД', ('query',)))
+POOL_ACQUIRE_SECONDS = metrics.add(Histogram('db_pool_acquire_seconds', 'Ожидание соединения из пула'))
+metrics.add(Gauge('db_pool_size', 'Соединений в пуле', lambda: bot.db_pool.get_size()))
+metrics.add(Gauge('db_pool_idle', 'Свободных соединений в пуле', lambda: bot.db_pool.get_idle_size()))
+metrics.add(Gauge('ai_requests_in_flight', 'Запросов к нейросети в работе', lambda: ai_scheduler.stats()['active']))
+metrics.add(Gauge('ai_requests_queued', 'Запросов к нейросети в очереди', lambda: ai_scheduler.stats()['queued']))
+metrics.add(Gauge('discord_gateway_latency_seconds', 'Задержка шлюза Discord', lambda: bot.latency))
+# Счётчики кэшей и буферов, которые раньше были видны только в /botstats; читаются при каждом запросе /metrics
+metrics.add(Gauge('activity_buffer_pending_events', 'Событий в буфере активности',
+                  lambda: activity_buffer.stats()['pending_events']))
+metrics.add(Gauge('activity_buffer_pending_users', 'Игроков в буфере активности',
+                  lambda: activity_buffer.stats()['pending_users']))
+metrics.add(Gauge('activity_flush_last_seconds', 'Длительность последнего сброса буфера',
+                  lambda: activity_buffer.stats()['last_flush_ms'] / 1000))
+metrics.add(Gauge('activity_flush_max_seconds', 'Самый долгий сброс буфера',
+                  lambda: activity_buffer.stats()['max_flush_ms'] / 1000))
+metrics.add(Gauge('activity_flush_seconds_total', 'Суммарное время сбросов буфера',
+                  lambda: activity_buffer.total_flush_ms / 1000, 'counter'))
+metrics.add(Gauge('activity_flushes_total', 'Сбросов буфера', lambda: activity_buffer.stats()['flushes'], 'counter'))
+metrics.add(Gauge('activity_flush_failures_total', 'Неудачных сбросов буфера',
+                  lambda: activity_buffer.stats()['failed_flushes'], 'counter'))
+metrics.add(Gauge('ai_cache_entries', 'Ответов в кэше нейросети', lambda: ai_cache.stats()['entries']))
+metrics.add(Gauge('ai_cache_hits_total', 'Попаданий в кэш нейросети', lambda: ai_cache.stats()['hits'], 'counter'))
+metrics.add(Gauge('ai_cache_misses_total', 'Промахов кэша нейросети', lambda: ai_cache.stats()['misses'], 'counter'))
+metrics.add(Gauge('ai_cache_hit_ratio', 'Доля попаданий в кэш нейросети', lambda: ai_cache.stats()['hit_ratio']))
+metrics.add(Gauge('ai_cache_saved_seconds_total', 'Секунд ожидания нейросети, сэкономленных кэшем',
+                  lambda: ai_cache.saved_seconds, 'counter'))
+metrics.add(Gauge('leaderboard_cache_hits_total', 'Попаданий в кэш топа', lambda: leaderboard.stats()['hits'], 'counter'))
+metrics.add(Gauge('leaderboard_cache_misses_total', 'Промахов кэша топа', lambda: leaderboard.stats()['misses'], 'counter'))
+metrics.add(Gauge('leaderboard_cache_hit_ratio', 'Доля попаданий в кэш топа', lambda: leaderboard.stats()['hit_ratio']))
+metrics.add(Gauge('leaderboard_cache_guilds', 'Серверов в кэше топа', lambda: leaderboard.stats()['guilds']))
+
+_query_labels = {}  # текст запроса -> короткая метка
+
+def query_label(query):
+    label = _query_labels.get(query)
+    if label is None:
+        label = _query_labels[query] = " ".join(query.split())[:80]
+    return label
+
+def log_query(record):
+    """Query logger asyncpg: вызывается после каждого запроса соединения"""
+    label = query_label(record.query)
+    QUERY_SECONDS.observe(record.elapsed, label)
+    if record.exception is not None:
+        QUERY_ERRORS.inc(label)
+
+async def instrument_connection(conn):
+    conn.add_query_logger(log_query)
+
+class TimedPool:
+    """Обёртка пула asyncpg, которая меряет ожидание в acquire(); остальное отдаёт пулу как есть"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        started = time.perf_counter()
+        async with self._pool.acquire(timeout=timeout) as conn:
+            POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+            yield conn
+
+def timed_event(handler):
+    """Меряет время и ошибки обработчика события; ставится под @bot.event"""
+    event = handler.__name__.removeprefix('on_')
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception as e:
+            EVENT_ERRORS.inc(event, type(e).__name__)
+            raise
+        finally:
+            EVENT_SECONDS.observe(time.perf_counter() - started, event)
+    return wrapper
+
+def record_command(interaction, error=None):
+    started = interaction.extras.pop('started', None)
+    name = interaction.command.qualified_name if interaction.command else "unknown"
+    if started is not None:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, name)
+    if error is not None:
+        original = getattr(error, 'original', error)
+        COMMAND_ERRORS.inc(name, type(original).__name__)
+
+class InstrumentedTree(app_commands.CommandTree):
+    """Дерево команд, засекающее каждую слэш-команду: старт в interaction_check, финиш в завершении или ошибке"""
+
+    async def interaction_check(self, interaction):
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction, error):
+        record_command(interaction, error)
+        await super().on_error(interaction, error)
+
 # ================== НАСТРОЙКИ БОТА ==================
 intents = discord.Intents.default()
 intents.message_content = True
@@ -25,179 +270,2314 @@ intents.members = True
 intents.guilds = True
 intents.voice_states = True
 
-class MyBot(commands.Bot):
+# Шардирование: задаётся лаунчером кластера (--cluster) или вручную для одного процесса со всеми шардами
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))  # 0 — обычный бот без шардов
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id]  # пусто — все шарды
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+CLUSTER_IPC_PORT = int(os.getenv('CLUSTER_IPC_PORT', '0'))  # порт лаунчера; у воркера задаётся лаунчером
+CLUSTER_SIZE = int(os.getenv('CLUSTER_SIZE', '1'))  # процессов в кластере; у воркера задаётся лаунчером
+SHARDED = SHARD_COUNT > 0
+
+class MyBot(commands.AutoShardedBot if SHARDED else commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix='!', intents=intents)
+        shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS or None} if SHARDED else {}
+        super().__init__(command_prefix='!', intents=intents, tree_cls=InstrumentedTree, **shard_options)
         self.db_pool = None
+        self.db_ready = asyncio.Event()  # выставляется, когда пул создан и таблицы готовы
+        self.ai = None
+
+    def dispatch(self, event_name, /, *args, **kwargs):
+        GATEWAY_EVENTS.inc(event_name)
+        super().dispatch(event_name, *args, **kwargs)
 
     async def setup_hook(self):
-        guild = discord.Object(id=GUILD_ID)
-        self.tree.copy_global_to(guild=guild)
-        await self.tree.sync(guild=guild)
-        print(f"✅ Синхронизировано на сервер {GUILD_ID}")
+        # setup_hook вызывается один раз, в отличие от on_ready, который срабатывает при каждом переподключении
+        if METRICS_PORT:
+            await metrics.start(METRICS_HOST, METRICS_PORT)
+        startup.mark("вход")
+        try:
+            await init_db()
+            if self.db_pool is not None:
+                await ticket_registry.load()
+        except Exception as e:
+            print(f"❌ Не удалось подключиться к базе данных: {e}")
+            self.db_ready.set()  # ожидающие получат ошибку, а не повиснут навсегда
+        startup.mark("БД")
+        self.add_view(TicketView())
+        self.add_view(TicketCloseView())
+        self.ai = AIClient(AI_TOKEN)
+        await self.ai.start()
+        activity_buffer.start()
+        voice_tracker.start()
+        if cluster is not None:
+            cluster.start()
+        # Задачи на всю БД, а не на сервер, в кластере крутит только первый воркер
+        if WARN_EXPIRY_SCHEDULER and CLUSTER_ID == 0:
+            warn_expiry.start()
+        if CLUSTER_ID == 0:
+            activity_rollups.start()
+        startup.mark("фоновые задачи")
+        for guild_id in COMMAND_GUILD_IDS:
+            guild = discord.Object(id=guild_id)
+            self.tree.copy_global_to(guild=guild)
+            if not owns_guild(guild_id):
+                continue
+            if await sync_commands(self.tree, guild):
+                print(f"✅ Синхронизировано на сервер {guild_id}")
+            else:
+                print(f"✅ Команды сервера {guild_id} не менялись, синхронизация пропущена")
+        startup.mark("команды")
 
-bot = MyBot()
+    async def close(self):
+        # Сначала досчитываем голос и сбрасываем накопленную активность, потом закрываем пул
+        await voice_tracker.stop()
+        await activity_buffer.stop()
+        await warn_expiry.stop()
+        await activity_rollups.stop()
+        if cluster is not None:
+            await cluster.stop()
+        if self.db_pool is not None:
+            await self.db_pool.close()
+        if self.ai is not None:
+            await self.ai.close()
+        await metrics.stop()
+        await super().close()
 
-# ================== СЛОВАРИ ==================
-voice_tracking = {}
-user_conversations = {}  # Для истории диалогов с нейросетью
+bot = MyBot()
 
 # ================== ТОКЕН ДЛЯ НЕЙРОСЕТИ ==================
 AI_TOKEN = os.getenv('AI_TOKEN')  # Получаем из переменных окружения
 
+# ================== КЛИЕНТ НЕЙРОСЕТИ ==================
+AI_BASE_URL = os.getenv('AI_BASE_URL', 'https://openrouter.ai/api/v1')  # в тестах — адрес локальной заглушки
+AI_MODEL = os.getenv('AI_MODEL', 'openrouter/free')
+AI_CONNECTION_LIMIT = int(os.getenv('AI_CONNECTION_LIMIT', '20'))
+AI_KEEPALIVE = float(os.getenv('AI_KEEPALIVE', '60'))  # секунды простоя соединения
+AI_CONNECT_TIMEOUT = float(os.getenv('AI_CONNECT_TIMEOUT', '5'))
+AI_TOTAL_TIMEOUT = float(os.getenv('AI_TOTAL_TIMEOUT', '60'))
+AI_STREAM = os.getenv('AI_STREAM', '1') == '1'  # показывать ответ по мере генерации
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', '1.2'))  # не чаще одной правки за столько секунд
+DISCORD_MESSAGE_LIMIT = 1900
+
+class AIError(Exception):
+    """Ответ API нейросети с кодом, отличным от 200"""
+
+    def __init__(self, status, data):
+        super().__init__(f"{status}: {data}")
+        self.status = status
+        self.data = data
+
+class AIClient:
+    """Одна долгоживущая aiohttp-сессия к API нейросети с keep-alive и кэшем DNS"""
+
+    def __init__(self, token, base_url=AI_BASE_URL, model=AI_MODEL):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self._session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=AI_CONNECTION_LIMIT,
+            keepalive_timeout=AI_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=AI_TOTAL_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json",
+                "HTTP-Referer": "https://discord.com",
+                "X-Title": "Discord Bot"
+            },
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def chat(self, messages, max_tokens=500):
+        """Отправляет диалог и возвращает текст ответа"""
+        async with self._session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens
+            }
+        ) as resp:
+            if resp.status != 200:
+                # Прокси перед API отдают ошибки HTML-страницей, поэтому тело читаем как текст
+                raise AIError(resp.status, await resp.text())
+            data = await resp.json()
+            return data['choices'][0]['message']['content']
+
+    async def stream_chat(self, messages, max_tokens=500):
+        """То же, что chat, но отдаёт кусочки текста из SSE-потока по мере генерации"""
+        async with self._session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "stream": True
+            },
+            # Общий таймаут оборвал бы длинную генерацию, поэтому ограничиваем паузы между чанками
+            timeout=aiohttp.ClientTimeout(total=None, connect=AI_CONNECT_TIMEOUT, sock_read=AI_TOTAL_TIMEOUT)
+        ) as resp:
+            if resp.status != 200:
+                raise AIError(resp.status, await resp.text())
+            async for raw in resp.content:
+                line = raw.decode('utf-8').strip()
+                # Пустые строки разделяют события, строки с ":" — комментарии-пинги
+                if not line.startswith('data:'):
+                    continue
+                payload = line[5:].strip()
+                if payload == '[DONE]':
+                    break
+                chunk = json.loads(payload)
+                if 'error' in chunk:
+                    raise AIError(resp.status, chunk['error'])
+                delta = chunk['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    yield delta
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Режет текст на куски не длиннее limit, по возможности по строкам или пробелам"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    chunks.append(text)
+    return chunks
+
+class StreamingReply:
+    """Показывает ответ в followup-сообщениях по мере генерации.
+
+    Сообщение правится не чаще раза в AI_STREAM_EDIT_INTERVAL, а всё, что не
+    влезает в лимит Discord, уходит в следующее сообщение.
+    """
+
+    def __init__(self, interaction, interval=AI_STREAM_EDIT_INTERVAL):
+        self.interaction = interaction
+        self.interval = interval
+        self.text = ""
+        self._current = ""  # текст сообщения, которое ещё дописывается
+        self._message = None
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+        self._current += delta
+        if len(self._current) > DISCORD_MESSAGE_LIMIT:
+            *full, self._current = split_message(self._current)
+            for chunk in full:
+                await self._show(chunk)
+                self._message = None
+        if time.monotonic() - self._last_edit >= self.interval:
+            await self._show(self._current)
+
+    async def finish(self):
+        """Дописывает последний кусок и возвращает весь ответ"""
+        if not self.text.strip():
+            await self.interaction.followup.send("🤷 Нейросеть вернула пустой ответ")
+        elif self._current.strip():
+            await self._show(self._current)
+        return self.text
+
+    async def _show(self, content):
+        if not content.strip() or (self._message is not None and content == self._shown):
+            return
+        if self._message is None:
+            self._message = await self.interaction.followup.send(content, wait=True)
+        else:
+            await self._message.edit(content=content)
+        self._shown = content
+        self._last_edit = time.monotonic()
+
+# ================== ИСТОРИЯ ДИАЛОГОВ ==================
+AI_SYSTEM_PROMPT = "Ты полезный ассистент. Отвечай на русском языке кратко и по делу."
+AI_CONTEXT_TOKENS = int(os.getenv('AI_CONTEXT_TOKENS', '3000'))  # предел одного диалога
+AI_MEMORY_BUDGET_TOKENS = int(os.getenv('AI_MEMORY_BUDGET_TOKENS', '2000000'))  # на все диалоги в памяти
+AI_CONVERSATION_IDLE = float(os.getenv('AI_CONVERSATION_IDLE', '3600'))  # секунды без сообщений до выгрузки
+AI_PERSIST_CONVERSATIONS = os.getenv('AI_PERSIST_CONVERSATIONS', '0') == '1'  # хранить историю в PostgreSQL
+# В кластере без AI_PERSIST_CONVERSATIONS у игрока своя история на каждом воркере
+
+def estimate_tokens(message):
+    """Грубая оценка токенов: ~3 символа на токен для смеси кириллицы и латиницы плюс служебные"""
+    return len(message["content"]) // 3 + 4
+
+class Conversation:
+    __slots__ = ("messages", "tokens", "touched")
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.tokens = sum(estimate_tokens(m) for m in messages)
+        self.touched = time.monotonic()
+
+class ConversationStore:
+    """История диалогов с нейросетью: LRU с выгрузкой простаивающих, общий бюджет и обрезка по токенам"""
+
+    def __init__(self, max_tokens, budget_tokens, idle_seconds, persist, shared=False):
+        self.max_tokens = max_tokens
+        self.budget_tokens = budget_tokens
+        self.idle_seconds = idle_seconds
+        self.persist = persist
+        # В кластере игрок может писать /ai на серверах разных воркеров: тогда источник истины — БД,
+        # диалог перечитывается при каждом обращении и сохраняется после каждой реплики
+        self.shared = persist and shared
+        self._conversations = OrderedDict()  # user_id -> Conversation, в порядке последнего обращения
+        self._tokens = 0
+        self.evictions = 0
+        self.loads = 0
+
+    async def add(self, user_id, role, content):
+        """Добавляет реплику, обрезает старые и возвращает диалог для отправки в API"""
+        conversation = await self._get(user_id)
+        message = {"role": role, "content": content}
+        conversation.messages.append(message)
+        self._resize(conversation, estimate_tokens(message))
+        self._trim(conversation)
+        conversation.touched = time.monotonic()
+        self._evict()
+        if role == "assistant" or self.shared:
+            await self._save(user_id, conversation)
+        return conversation.messages
+
+    async def has_history(self, user_id):
+        """Есть ли у игрока реплики кроме системного промпта"""
+        conversation = await self._get(user_id)
+        return len(conversation.messages) > 1
+
+    async def reset(self, user_id):
+        conversation = self._conversations.pop(user_id, None)
+        if conversation is not None:
+            self._tokens -= conversation.tokens
+        if self.persist and bot.db_pool is not None:
+            await CONVERSATION_DELETE(bot.db_pool, user_id)
+
+    async def _get(self, user_id):
+        conversation = self._conversations.get(user_id)
+        if conversation is not None and not self.shared:
+            self._conversations.move_to_end(user_id)
+            return conversation
+
+        messages = None
+        if self.persist and bot.db_pool is not None:
+            raw = await CONVERSATION_LOAD(bot.db_pool, user_id)
+            if raw is not None:
+                messages = json.loads(raw)
+                self.loads += 1
+        # Пока шёл запрос, диалог мог появиться в памяти
+        conversation = self._conversations.get(user_id)
+        if conversation is not None and messages is not None and self.shared:
+            # Другой воркер мог дописать диалог: копия из БД свежее
+            del self._conversations[user_id]
+            self._tokens -= conversation.tokens
+            conversation = None
+        if conversation is None:
+            conversation = Conversation(messages or [{"role": "system", "content": AI_SYSTEM_PROMPT}])
+            self._conversations[user_id] = conversation
+            self._tokens += conversation.tokens
+        else:
+            self._conversations.move_to_end(user_id)
+        return conversation
+
+    def _resize(self, conversation, delta):
+        conversation.tokens += delta
+        self._tokens += delta
+
+    def _trim(self, conversation):
+        messages = conversation.messages
+        # Системный промпт и последняя реплика остаются всегда
+        while conversation.tokens > self.max_tokens and len(messages) > 2:
+            self._resize(conversation, -estimate_tokens(messages.pop(1)))
+        if conversation.tokens > self.max_tokens:
+            # Одна огромная реплика: обрезаем её текст, чтобы не раздувать запрос
+            last = messages[-1]
+            before = estimate_tokens(last)
+            # Служебные токены самой реплики тоже входят в лимит
+            allowed = max(self.max_tokens - (conversation.tokens - before) - estimate_tokens({"content": ""}), 0)
+            last["content"] = last["content"][:allowed * 3]
+            self._resize(conversation, estimate_tokens(last) - before)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._conversations:
+            user_id, conversation = next(iter(self._conversations.items()))
+            if self._tokens <= self.budget_tokens and now - conversation.touched < self.idle_seconds:
+                break
+            del self._conversations[user_id]
+            self._tokens -= conversation.tokens
+            self.evictions += 1
+
+    async def _save(self, user_id, conversation):
+        if not self.persist or bot.db_pool is None:
+            return
+        await CONVERSATION_SAVE(bot.db_pool, user_id, json.dumps(conversation.messages, ensure_ascii=False), datetime.now())
+
+    def stats(self):
+        return {
+            "users": len(self._conversations),
+            "tokens": self._tokens,
+            "budget": self.budget_tokens,
+            "evictions": self.evictions,
+            "loads": self.loads,
+        }
+
+conversations = ConversationStore(AI_CONTEXT_TOKENS, AI_MEMORY_BUDGET_TOKENS, AI_CONVERSATION_IDLE, AI_PERSIST_CONVERSATIONS,
+                                  shared=CLUSTER_SIZE > 1)
+
+# ================== КЭШ ОТВЕТОВ НЕЙРОСЕТИ ==================
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '3600'))  # секунды
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '500'))
+
+def normalize_prompt(text):
+    """Приводит вопрос к виду, в котором «Как получить монеты?» и «как  получить монеты» совпадают"""
+    text = " ".join(text.lower().replace("ё", "е").split())
+    return text.strip(" .,!?…")
+
+class AIResponseCache:
+    """Ответы на первые вопросы диалога: ключ — модель, системный промпт и нормализованный вопрос"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # ключ -> (истекает, ответ, сколько секунд он генерировался)
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(model, system_prompt, prompt):
+        raw = "\n".join((model, normalize_prompt(system_prompt), normalize_prompt(prompt)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[2]
+        return entry[1]
+
+    def put(self, key, answer, latency):
+        if not answer.strip():
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, answer, latency)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "saved_seconds": round(self.saved_seconds, 1),
+        }
+
+ai_cache = AIResponseCache(AI_CACHE_TTL, AI_CACHE_SIZE)
+
+# ================== ОЧЕРЕДЬ ЗАПРОСОВ К НЕЙРОСЕТИ ==================
+AI_MAX_CONCURRENT = int(os.getenv('AI_MAX_CONCURRENT', '4'))  # одновременных запросов к API
+AI_QUEUE_SIZE = int(os.getenv('AI_QUEUE_SIZE', '20'))  # сколько ещё может ждать в очереди
+AI_USER_RATE = float(os.getenv('AI_USER_RATE', '3'))  # запросов в минуту на игрока
+AI_USER_BURST = int(os.getenv('AI_USER_BURST', '3'))
+AI_BREAKER_THRESHOLD = int(os.getenv('AI_BREAKER_THRESHOLD', '5'))  # ошибок подряд до размыкания
+AI_BREAKER_COOLDOWN = float(os.getenv('AI_BREAKER_COOLDOWN', '30'))  # секунды до пробного запроса
+
+class AIRejected(Exception):
+    """Запрос к нейросети не пущен: лимит игрока, полная очередь или недоступный API"""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity):
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+class CircuitBreaker:
+    """После threshold ошибок подряд отказывает сразу, через cooldown пускает один пробный запрос"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self._probing or time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        wait = self.cooldown - (time.monotonic() - self.opened_at)
+        if wait > 0 or self._probing:
+            raise AIRejected(f"🔌 Нейросеть сейчас недоступна, попробуй через {max(int(wait), 1)} с")
+        self._probing = True
+
+    def release_probe(self):
+        """Пробный запрос не состоялся или упал не по вине API — исход неизвестен"""
+        self._probing = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+def is_upstream_failure(error):
+    """Ошибки, говорящие о проблемах на стороне API, а не в самом запросе"""
+    if isinstance(error, AIError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class AIOutcome:
+    """Исход обращений к API внутри slot(): размыкатель учитывает только их, а не ответы в Discord"""
+
+    __slots__ = ("failed", "succeeded")
+
+    def __init__(self):
+        self.failed = False
+        self.succeeded = False
+
+    async def call(self, request):
+        """Дожидается запроса к нейросети, запоминая его исход"""
+        try:
+            result = await request
+        except BaseException as e:
+            self.failed = self.failed or is_upstream_failure(e)
+            raise
+        self.succeeded = True
+        return result
+
+    async def stream(self, chunks):
+        """Отдаёт кусочки потокового ответа; правки сообщений между ними в исход не попадают"""
+        try:
+            while True:
+                try:
+                    delta = await self.call(anext(chunks))
+                except StopAsyncIteration:
+                    self.succeeded = True
+                    return
+                self.succeeded = False  # поток ещё не дочитан
+                yield delta
+        finally:
+            await chunks.aclose()
+
+class AIScheduler:
+    """Общий лимит одновременных запросов, очередь с позицией, лимиты игроков и размыкатель"""
+
+    def __init__(self, max_concurrent, queue_size, user_rate, user_burst, breaker):
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.breaker = breaker
+        self._active = 0
+        self._waiters = deque()
+        self._buckets = {}  # user_id -> TokenBucket
+        self.rejected = 0
+
+    def _take_token(self, user_id):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                # Полные вёдра ничего не помнят, их можно выбросить
+                self._buckets = {uid: b for uid, b in self._buckets.items()
+                                 if b.tokens + (now - b.updated) * self.user_rate < self.user_burst}
+            bucket = self._buckets[user_id] = TokenBucket(self.user_burst)
+        bucket.tokens = min(self.user_burst, bucket.tokens + (now - bucket.updated) * self.user_rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            wait = (1 - bucket.tokens) / self.user_rate
+            raise AIRejected(f"🐢 Слишком много запросов, попробуй через {math.ceil(wait)} с")
+        bucket.tokens -= 1
+
+    async def _acquire(self, on_queued):
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise AIRejected("🚦 Нейросеть перегружена, попробуй чуть позже")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Сообщение о позиции тоже может упасть или быть отменено — ожидающий не должен остаться в очереди
+            if on_queued is not None:
+                await on_queued(len(self._waiters))
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        # Место передаётся первому живому в очереди, счётчик при этом не меняется
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id, on_queued=None):
+        try:
+            self.breaker.check()
+            try:
+                self._take_token(user_id)
+                await self._acquire(on_queued)
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+        except AIRejected:
+            self.rejected += 1
+            raise
+        outcome = AIOutcome()
+        try:
+            yield outcome
+        finally:
+            if outcome.failed:
+                self.breaker.failure()
+            elif outcome.succeeded:
+                self.breaker.success()
+            else:
+                # До API не дошли или ответ не дочитан: исход неизвестен
+                self.breaker.release_probe()
+            self._release()
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "breaker": self.breaker.state,
+        }
+
+def cluster_share(total):
+    """Доля общего лимита на один процесс кластера"""
+    return max(1, total // CLUSTER_SIZE)
+
+# AI_MAX_CONCURRENT и AI_QUEUE_SIZE — на весь кластер, поэтому делятся между воркерами. Лимит игрока и
+# размыкатель остаются на процесс: игрок на серверах двух воркеров получает два ведра запросов.
+ai_scheduler = AIScheduler(cluster_share(AI_MAX_CONCURRENT), cluster_share(AI_QUEUE_SIZE), AI_USER_RATE, AI_USER_BURST,
+                           CircuitBreaker(AI_BREAKER_THRESHOLD, AI_BREAKER_COOLDOWN))
+
 # ================== ФУНКЦИЯ ОЖИДАНИЯ БД ==================
 async def wait_for_db():
     """Ждём, пока база данных инициализируется"""
-    while bot.db_pool is None:
-        await asyncio.sleep(1)
+    await bot.db_ready.wait()
+    if bot.db_pool is None:
+        raise RuntimeError("База данных недоступна")
     return bot.db_pool
 
-# ================== БАЗА ДАННЫХ (PostgreSQL) ==================
-async def init_db():
-    """Инициализация подключения к PostgreSQL и создание таблиц"""
-    database_url = os.getenv('DATABASE_URL')
+# ================== БАЗА ДАННЫХ (PostgreSQL или SQLite) ==================
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '200'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))  # секунды на запрос
+
+async def init_db(database_url=None, **pool_options):
+    """Инициализация подключения к PostgreSQL или SQLite и создание таблиц"""
+    database_url = database_url or os.getenv('DATABASE_URL')
     if not database_url:
-        print("❌ ОШИБКА: DATABASE_URL не найден в переменных окружения!")
-        return
+        # Без явного адреса не подменяем базу молча: иначе бот «забудет» все данные из PostgreSQL
+        raise RuntimeError("DATABASE_URL не задан: укажите postgresql://... или явно sqlite:///bot.db")
     
-    bot.db_pool = await asyncpg.create_pool(database_url)
-    
-    async with bot.db_pool.acquire() as conn:
-        # Варны
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS warns (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                guild_id BIGINT,
-                moderator_id BIGINT,
-                reason TEXT,
-                date TIMESTAMP,
-                expired BOOLEAN DEFAULT FALSE
-            )
-        ''')
+    if database_url.startswith('sqlite:///'):
+        pool = await SqlitePool.open(database_url[len('sqlite:///'):], SQLITE_POOL_SIZE,
+                                     **{'init': instrument_connection, **pool_options})
+    else:
+        pool = await asyncpg.create_pool(
+            database_url,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            **{'init': instrument_connection, **pool_options},
+        )
+    
+    async with pool.acquire() as conn:
+        # Таблицы, функции и миграции — под одной блокировкой: воркеры кластера стартуют одновременно
+        async with schema_lock(conn):
+            # Варны
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS warns (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    moderator_id BIGINT,
+                    reason TEXT,
+                    date TIMESTAMP,
+                    expired BOOLEAN DEFAULT FALSE
+                )
+            ''')
         
-        # Сообщения
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                user_id BIGINT,
-                guild_id BIGINT,
-                count INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, guild_id)
-            )
-        ''')
+            # Сообщения
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    count INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
         
-        # Монеты
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS coins (
-                user_id BIGINT,
-                guild_id BIGINT,
-                balance REAL DEFAULT 0,
-                PRIMARY KEY (user_id, guild_id)
-            )
-        ''')
+            # Монеты
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS coins (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    balance REAL DEFAULT 0,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
         
-        # XP
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS xp (
-                user_id BIGINT,
-                guild_id BIGINT,
-                xp INTEGER DEFAULT 0,
-                level INTEGER DEFAULT 1,
-                PRIMARY KEY (user_id, guild_id)
-            )
-        ''')
+            # XP
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS xp (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    xp INTEGER DEFAULT 0,
+                    level INTEGER DEFAULT 1,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
         
-        # Голосовое время
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS voice_time (
-                user_id BIGINT,
-                guild_id BIGINT,
-                total_minutes INTEGER DEFAULT 0,
-                last_join TIMESTAMP,
-                PRIMARY KEY (user_id, guild_id)
-            )
-        ''')
+            # Голосовое время
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS voice_time (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    total_minutes INTEGER DEFAULT 0,
+                    last_join TIMESTAMP,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
         
-        # Уведомления
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS coin_notifications (
-                user_id BIGINT PRIMARY KEY,
-                last_notification REAL DEFAULT 0
-            )
-        ''')
+            # Уведомления
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS coin_notifications (
+                    user_id BIGINT PRIMARY KEY,
+                    last_notification REAL DEFAULT 0
+                )
+            ''')
         
-        # Браки
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS marriages (
-                user_id BIGINT,
-                guild_id BIGINT,
-                partner_id BIGINT,
-                married_since TIMESTAMP,
-                PRIMARY KEY (user_id, guild_id)
-            )
-        ''')
+            # Браки
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS marriages (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    partner_id BIGINT,
+                    married_since TIMESTAMP,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
+        
+            # Формулы уровней (см. level_base / level_from_total); в SQLite это Python-функции соединения
+            if not is_sqlite(conn):
+                await conn.execute('''
+                    CREATE OR REPLACE FUNCTION xp_level_base(lvl INTEGER) RETURNS BIGINT
+                    LANGUAGE SQL IMMUTABLE AS $$ SELECT 50::BIGINT * lvl * (lvl - 1) $$
+                ''')
+                await conn.execute('''
+                    CREATE OR REPLACE FUNCTION xp_level(total BIGINT) RETURNS INTEGER
+                    LANGUAGE SQL IMMUTABLE AS $$
+                        SELECT ((1 + floor(sqrt((1 + 4 * (GREATEST(total, 0) / 50))::NUMERIC))::BIGINT) / 2)::INTEGER
+                    $$
+                ''')
+                await conn.execute('''
+                    CREATE OR REPLACE FUNCTION xp_remainder(total BIGINT) RETURNS INTEGER
+                    LANGUAGE SQL IMMUTABLE AS $$ SELECT (GREATEST(total, 0) - xp_level_base(xp_level(total)))::INTEGER $$
+                ''')
+        
+            await apply_migrations(conn)
     
-    print("✅ PostgreSQL подключён и таблицы созданы")
+    bot.db_pool = TimedPool(pool)
+    bot.db_ready.set()
+    if is_sqlite(pool):
+        print(f"✅ SQLite открыта в режиме WAL и таблицы созданы ({pool.get_size()} соединений)")
+        return
+    if DB_STATEMENT_CACHE_SIZE < len(STATEMENTS):
+        print(f"⚠️ DB_STATEMENT_CACHE_SIZE={DB_STATEMENT_CACHE_SIZE} меньше числа запросов ({len(STATEMENTS)}): планы будут вытесняться")
+    print(f"✅ PostgreSQL подключён и таблицы созданы (пул {DB_POOL_MIN}–{DB_POOL_MAX})")
 
-async def check_expired_warns():
-    await bot.wait_until_ready()
-    while not bot.is_closed():
-        seven_days_ago = datetime.now() - timedelta(days=7)
-        async with bot.db_pool.acquire() as conn:
-            await conn.execute('UPDATE warns SET expired = TRUE WHERE date < $1 AND expired = FALSE', seven_days_ago)
-        await asyncio.sleep(3600)
+async def db_health():
+    """Состояние пула: занятость соединений и время простого запроса"""
+    pool = bot.db_pool
+    if pool is None:
+        return {"ready": False}
+    size, idle, max_size = pool.get_size(), pool.get_idle_size(), pool.get_max_size()
+    started = time.perf_counter()
+    try:
+        async with pool.acquire(timeout=5) as conn:
+            acquired = time.perf_counter()
+            await conn.fetchval('SELECT 1')
+        ok = True
+    except Exception:
+        acquired = time.perf_counter()
+        ok = False
+    finished = time.perf_counter()
+    return {
+        "ready": True,
+        "ok": ok,
+        "size": size,
+        "idle": idle,
+        "max": max_size,
+        "saturation": round((size - idle) / max_size, 2),
+        "acquire_ms": round((acquired - started) * 1000, 2),
+        "ping_ms": round((finished - acquired) * 1000, 2),
+    }
 
-async def check_coin_milestone(user_id, conn):
-    row = await conn.fetchrow('SELECT balance FROM coins WHERE user_id = $1', user_id)
-    if not row:
+# ================== ВСТРОЕННАЯ SQLite ==================
+# DATABASE_URL вида sqlite:///bot.db (только явно) включает встроенную SQLite: WAL, свои потоки
+# на соединение, чтобы не блокировать цикл событий. Пул и соединения повторяют ту часть интерфейса asyncpg,
+# которой пользуется бот, а Statement переводит SQL в диалект SQLite ($1 -> ?1, без ::приведений).
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '4'))  # читатели идут параллельно, писатель — один
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda raw: datetime.fromisoformat(raw.decode()))
+sqlite3.register_converter("TIMESTAMPTZ", lambda raw: datetime.fromisoformat(raw.decode()))
+
+def is_sqlite(db):
+    return getattr(db, 'dialect', None) == 'sqlite'
+
+@functools.lru_cache(maxsize=512)
+def sqlite_sql(sql):
+    """Запрос в синтаксисе PostgreSQL -> SQLite (только то, что встречается в этом файле)"""
+    sql = sql.replace("'-Infinity'::REAL", "-9e999")
+    sql = sql.replace("SERIAL PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT").replace("NOW()", "CURRENT_TIMESTAMP")
+    sql = re.sub(r"= ANY\((\$\d+)[^)]*\)", r"IN (SELECT value FROM json_each(\1))", sql)
+    sql = re.sub(r"::[A-Za-z_]+(\[\])?", "", sql)
+    return re.sub(r"\$(\d+)", r"?\1", sql)
+
+def sqlite_args(args):
+    # Массивы (= ANY($1)) передаются как JSON
+    return tuple(json.dumps(arg) if isinstance(arg, list) else arg for arg in args)
+
+class SqliteRecord(tuple):
+    """Строка SQLite, которая ведёт себя как asyncpg.Record: по индексу, по ключу, атрибутом и через dict()"""
+
+    def __new__(cls, keys, values):
+        record = super().__new__(cls, values)
+        record._keys = keys
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._keys.index(key)
+            except ValueError:
+                raise KeyError(key) from None
+        return super().__getitem__(key)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def keys(self):
+        return iter(self._keys)
+
+    def values(self):
+        return iter(self)
+
+    def items(self):
+        return zip(self._keys, self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+def sqlite_record(cursor, values):
+    return SqliteRecord(tuple(column[0] for column in cursor.description), values)
+
+class SqliteConnection:
+    """Одно соединение SQLite со своим потоком; методы как у соединения asyncpg"""
+
+    dialect = 'sqlite'
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._db = None
+        self._loggers = []
+
+    async def connect(self, path):
+        self._db = await self._run(self._open, path)
+
+    @staticmethod
+    def _open(path):
+        db = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                             detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite_record
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        # Формулы уровней, как SQL-функции в PostgreSQL (см. init_db)
+        db.create_function('xp_level_base', 1, lambda level: level_base(level), deterministic=True)
+        db.create_function('xp_level', 1, lambda total: level_from_total(total), deterministic=True)
+        db.create_function('xp_remainder', 1,
+                           lambda total: max(total, 0) - level_base(level_from_total(total)), deterministic=True)
+        # Миграции берут advisory lock; в SQLite запись и так сериализована
+        db.create_function('pg_advisory_lock', 1, lambda lock_id: None)
+        db.create_function('pg_advisory_unlock', 1, lambda lock_id: None)
+        return db
+
+    async def _run(self, fn, *args):
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Как отмена запроса в asyncpg: прерываем его, SQLite сама откатит явную транзакцию
+            if self._db is not None:
+                self._db.interrupt()
+            try:
+                await future
+            except Exception:
+                pass
+            raise
+
+    def _execute(self, sql, args, mode):
+        rows = self._db.execute(sql, args).fetchall()
+        if mode == 'row':
+            return rows[0] if rows else None
+        if mode == 'val':
+            return rows[0][0] if rows else None
+        return rows
+
+    async def _logged(self, query, args, fn, *fn_args):
+        # Тот же протокол, что у query logger asyncpg: query, args, elapsed, exception
+        started = time.perf_counter()
+        error = None
+        try:
+            return await self._run(fn, *fn_args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            record = SimpleNamespace(query=query, args=args, elapsed=time.perf_counter() - started, exception=error)
+            for logger in self._loggers:
+                logger(record)
+
+    async def _query(self, sql, args, mode):
+        return await self._logged(sql, args, self._execute, sqlite_sql(sql), sqlite_args(args), mode)
+
+    async def execute(self, sql, *args, **kwargs):
+        await self._query(sql, args, 'all')
+        return "OK"
+
+    async def fetch(self, sql, *args, **kwargs):
+        return await self._query(sql, args, 'all')
+
+    async def fetchrow(self, sql, *args, **kwargs):
+        return await self._query(sql, args, 'row')
+
+    async def fetchval(self, sql, *args, **kwargs):
+        return await self._query(sql, args, 'val')
+
+    def _atomic(self, fn, args):
+        db = self._db
+        if db.in_transaction:
+            return fn(db, *args)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(db, *args)
+        except BaseException:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    async def call(self, fn, *args):
+        """Выполняет fn(sqlite3.Connection, *args) в потоке соединения одной транзакцией"""
+        return await self._logged(fn.__name__, args, self._atomic, fn, args)
+
+    def _rollback(self):
+        if self._db.in_transaction:
+            self._db.execute('ROLLBACK')
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self._run(self._db.execute, 'BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            await self._run(self._rollback)
+            raise
+        await self._run(self._db.execute, 'COMMIT')
+
+    def add_query_logger(self, logger):
+        self._loggers.append(logger)
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+
+class SqlitePool:
+    """Несколько соединений SQLite к одному файлу; acquire() отдаёт свободное"""
+
+    dialect = 'sqlite'
+
+    def __init__(self, connections):
+        self._connections = connections
+        self._idle = asyncio.Queue()
+        for conn in connections:
+            self._idle.put_nowait(conn)
+
+    @classmethod
+    async def open(cls, path, size, init=None, **_pool_options):
+        connections = []
+        for _ in range(size):
+            conn = SqliteConnection()
+            await conn.connect(path)
+            if init is not None:
+                await init(conn)
+            connections.append(conn)
+        return cls(connections)
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        conn = await asyncio.wait_for(self._idle.get(), timeout)
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def execute(self, sql, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(sql, *args)
+
+    async def fetch(self, sql, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def fetchrow(self, sql, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    async def fetchval(self, sql, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(sql, *args)
+
+    async def call(self, fn, *args):
+        async with self.acquire() as conn:
+            return await conn.call(fn, *args)
+
+    def get_size(self):
+        return len(self._connections)
+
+    def get_idle_size(self):
+        return self._idle.qsize()
+
+    def get_max_size(self):
+        return len(self._connections)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+
+# ================== ДОСТУП К ДАННЫМ ==================
+# Все запросы обработчиков — именованные Statement. asyncpg готовит каждый текст один раз на соединение
+# (кэш на DB_STATEMENT_CACHE_SIZE запросов) и дальше исполняет готовый план; время пишется по имени.
+# На SQLite тот же текст переводится sqlite_sql, а запросы без аналога там задаются функцией sqlite=.
+class Row(asyncpg.Record):
+    """Запись asyncpg, поля которой доступны и по ключу, и как атрибуты"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+class ProfileRow(Row):
+    messages: int
+    coins: float
+    xp: int
+    level: int
+    active_warns: int
+    total_warns: int
+    voice_minutes: int
+    partner_id: int
+    position: int
+
+class LeaderboardRow(Row):
+    user_id: int
+    balance: float
+    level: int
+
+class BalanceRow(Row):
+    user_id: int
+    guild_id: int
+    balance: float
+    level: int
+
+class XpRow(Row):
+    xp: int
+    level: int
+
+class WarnDueRow(Row):
+    id: int
+    date: datetime
+
+class VoiceSessionRow(Row):
+    user_id: int
+    guild_id: int
+    accrued_at: datetime
+
+class OpenTicketRow(Row):
+    guild_id: int
+    user_id: int
+    channel_id: int
+
+class NotifiedRow(Row):
+    user_id: int
+    last_notification: float
+
+class RollupRow(Row):
+    messages: int
+    voice_minutes: int
+    coins: float
+    xp: int
+
+class RollupTopRow(RollupRow):
+    user_id: int
+
+STATEMENT_SECONDS = metrics.add(Histogram('db_statement_duration_seconds', 'Время именованного запроса', ('statement',)))
+
+class Statement:
+    """Именованный запрос: вызывается как await STATEMENT(conn, *args), conn — соединение или пул"""
+
+    def __init__(self, name, kind, sql, record=Row, sqlite=None):
+        self.name, self.kind, self.sql, self.record, self.sqlite = name, kind, sql, record, sqlite
+
+    async def __call__(self, conn, *args):
+        started = time.perf_counter()
+        try:
+            if self.sqlite is not None and is_sqlite(conn):
+                return await conn.call(self.sqlite, *args)
+            if self.kind in ('fetch', 'fetchrow'):
+                return await getattr(conn, self.kind)(self.sql, *args, record_class=self.record)
+            return await getattr(conn, self.kind)(self.sql, *args)
+        finally:
+            STATEMENT_SECONDS.observe(time.perf_counter() - started, self.name)
+
+STATEMENTS = {}
+
+def statement(name, kind, sql, record=Row, sqlite=None):
+    STATEMENTS[name] = Statement(name, kind, sql, record, sqlite)
+    return STATEMENTS[name]
+
+@asynccontextmanager
+async def transaction():
+    """Соединение из пула в открытой транзакции: всё внутри блока фиксируется или откатывается целиком"""
+    pool = await wait_for_db()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            yield conn
+
+async def prepared_statements():
+    """Имена запросов, уже подготовленных на одном из соединений пула (по pg_prepared_statements); None для SQLite"""
+    pool = await wait_for_db()
+    if is_sqlite(pool):
+        return None
+    async with pool.acquire() as conn:
+        prepared = {row['statement'] for row in await conn.fetch('SELECT statement FROM pg_prepared_statements')}
+    return [name for name, stmt in STATEMENTS.items() if stmt.sql in prepared]
+
+# Варны
+WARN_INSERT = statement('warn_insert', 'fetchval', '''
+    INSERT INTO warns (user_id, guild_id, moderator_id, reason, date) VALUES ($1, $2, $3, $4, $5) RETURNING id
+''')
+WARN_COUNT = statement('warn_count', 'fetchval',
+    'SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2 AND date > $3 AND expired = FALSE')
+WARNS_UPCOMING = statement('warns_upcoming', 'fetch',
+    'SELECT id, date FROM warns WHERE expired = FALSE AND date > $1', WarnDueRow)
+WARNS_EXPIRE = statement('warns_expire', 'execute', 'UPDATE warns SET expired = TRUE WHERE id = ANY($1::int[])')
+
+# Монеты и уровни
+COIN_BALANCE = statement('coin_balance', 'fetchval', 'SELECT balance FROM coins WHERE user_id = $1')
+COIN_NOTIFIED_MANY = statement('coin_notified_many', 'fetch',
+    'SELECT user_id, last_notification FROM coin_notifications WHERE user_id = ANY($1::bigint[])', NotifiedRow)
+
+def sqlite_coin_notified_set_many(db, user_ids, balances):
+    db.executemany('''
+        INSERT INTO coin_notifications (user_id, last_notification) VALUES (?1, ?2)
+        ON CONFLICT (user_id) DO UPDATE SET last_notification = excluded.last_notification
+    ''', zip(user_ids, balances))
+
+COIN_NOTIFIED_SET_MANY = statement('coin_notified_set_many', 'execute', '''
+    INSERT INTO coin_notifications (user_id, last_notification)
+    SELECT * FROM unnest($1::bigint[], $2::real[])
+    ON CONFLICT (user_id) DO UPDATE SET last_notification = EXCLUDED.last_notification
+''', sqlite=sqlite_coin_notified_set_many)
+XP_ADD = statement('xp_add', 'fetchrow', '''
+    INSERT INTO xp (user_id, guild_id, xp, level)
+    VALUES ($1, $2, xp_remainder($3), xp_level($3))
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET
+        xp = xp_remainder(xp_level_base(xp.level) + xp.xp + $3),
+        level = xp_level(xp_level_base(xp.level) + xp.xp + $3)
+    RETURNING xp, level
+''', XpRow)
+# В SQLite нет unnest и DML в CTE: та же пачка разбирается построчно в одной транзакции потока соединения
+SQLITE_COIN_ADD = '''
+    INSERT INTO coins (user_id, guild_id, balance) VALUES (?1, ?2, ?3)
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = balance + excluded.balance
+    RETURNING balance
+'''
+SQLITE_MESSAGES_ADD = '''
+    INSERT INTO messages (user_id, guild_id, count) VALUES (?1, ?2, ?3)
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET count = count + excluded.count
+'''
+SQLITE_VOICE_ADD = '''
+    INSERT INTO voice_time (user_id, guild_id, total_minutes) VALUES (?1, ?2, ?3)
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET total_minutes = total_minutes + excluded.total_minutes
+'''
+SQLITE_ROLLUP_ADD = '''
+    INSERT INTO activity_rollups (guild_id, user_id, bucket, messages, voice_minutes, coins, xp)
+    VALUES (?2, ?1, ?7, ?3, ?6, ?4, ?5)
+    ON CONFLICT (guild_id, user_id, bucket) DO UPDATE SET
+        messages = messages + excluded.messages, voice_minutes = voice_minutes + excluded.voice_minutes,
+        coins = coins + excluded.coins, xp = xp + excluded.xp
+'''
+BALANCE_KEYS = ('user_id', 'guild_id', 'balance', 'level')
+
+def sqlite_activity_flush(db, user_ids, guild_ids, msg_deltas, coin_deltas, xp_deltas, voice_deltas, bucket):
+    updated = []
+    for user_id, guild_id, coin_delta, xp_delta in zip(user_ids, guild_ids, coin_deltas, xp_deltas):
+        balance = level = None
+        if coin_delta > 0:
+            balance = db.execute(SQLITE_COIN_ADD, (user_id, guild_id, coin_delta)).fetchone()[0]
+        if xp_delta > 0:
+            level = db.execute(sqlite_sql(XP_ADD.sql), (user_id, guild_id, xp_delta)).fetchone()['level']
+        if balance is not None or level is not None:
+            updated.append(SqliteRecord(BALANCE_KEYS, (user_id, guild_id, balance, level)))
+    rows = list(zip(user_ids, guild_ids, msg_deltas, voice_deltas))
+    db.executemany(SQLITE_MESSAGES_ADD, [(u, g, m) for u, g, m, _ in rows if m > 0])
+    db.executemany(SQLITE_VOICE_ADD, [(u, g, v) for u, g, _, v in rows if v > 0])
+    db.executemany(SQLITE_ROLLUP_ADD, [row + (bucket,) for row in
+                                       zip(user_ids, guild_ids, msg_deltas, coin_deltas, xp_deltas, voice_deltas)])
+    return updated
+
+# Один запрос на всю пачку буфера: монеты, XP, сообщения, голос и часовая корзина истории ($7);
+# возвращает новые балансы и уровни.
+# Для XP прирост восстанавливается из EXCLUDED как xp_level_base(level) + xp.
+ACTIVITY_FLUSH = statement('activity_flush', 'fetch', '''
+    WITH data AS (
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::real[], $5::bigint[], $6::int[])
+            AS d(user_id, guild_id, msg_delta, coin_delta, xp_delta, voice_delta)
+    ), upd_coins AS (
+        INSERT INTO coins (user_id, guild_id, balance)
+        SELECT user_id, guild_id, coin_delta FROM data WHERE coin_delta > 0
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = coins.balance + EXCLUDED.balance
+        RETURNING user_id, guild_id, balance
+    ), upd_xp AS (
+        INSERT INTO xp (user_id, guild_id, xp, level)
+        SELECT user_id, guild_id, xp_remainder(xp_delta), xp_level(xp_delta) FROM data WHERE xp_delta > 0
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET
+            xp = xp_remainder(xp_level_base(xp.level) + xp.xp + xp_level_base(EXCLUDED.level) + EXCLUDED.xp),
+            level = xp_level(xp_level_base(xp.level) + xp.xp + xp_level_base(EXCLUDED.level) + EXCLUDED.xp)
+        RETURNING user_id, guild_id, level
+    ), upd_messages AS (
+        INSERT INTO messages (user_id, guild_id, count)
+        SELECT user_id, guild_id, msg_delta FROM data WHERE msg_delta > 0
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET count = messages.count + EXCLUDED.count
+    ), upd_voice AS (
+        INSERT INTO voice_time (user_id, guild_id, total_minutes)
+        SELECT user_id, guild_id, voice_delta FROM data WHERE voice_delta > 0
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET total_minutes = voice_time.total_minutes + EXCLUDED.total_minutes
+    ), upd_rollup AS (
+        INSERT INTO activity_rollups (guild_id, user_id, bucket, messages, voice_minutes, coins, xp)
+        SELECT guild_id, user_id, $7::timestamp, msg_delta, voice_delta, coin_delta, xp_delta FROM data
+        ON CONFLICT (guild_id, user_id, bucket) DO UPDATE SET
+            messages = activity_rollups.messages + EXCLUDED.messages,
+            voice_minutes = activity_rollups.voice_minutes + EXCLUDED.voice_minutes,
+            coins = activity_rollups.coins + EXCLUDED.coins,
+            xp = activity_rollups.xp + EXCLUDED.xp
+    )
+    SELECT COALESCE(c.user_id, x.user_id) AS user_id, COALESCE(c.guild_id, x.guild_id) AS guild_id,
+           c.balance, x.level
+    FROM upd_coins c FULL JOIN upd_xp x ON c.user_id = x.user_id AND c.guild_id = x.guild_id
+''', BalanceRow, sqlite=sqlite_activity_flush)
+
+# История активности: корзины по часам, старше ROLLUP_HOURLY_DAYS — по дням
+ROLLUP_USER = statement('rollup_user', 'fetchrow', '''
+    SELECT COALESCE(SUM(messages), 0) AS messages, COALESCE(SUM(voice_minutes), 0) AS voice_minutes,
+           COALESCE(SUM(coins), 0) AS coins, COALESCE(SUM(xp), 0) AS xp
+    FROM activity_rollups
+    WHERE guild_id = $1 AND user_id = $2 AND bucket >= $3
+''', RollupRow)
+ROLLUP_TOP = statement('rollup_top', 'fetch', '''
+    SELECT user_id, SUM(messages) AS messages, SUM(voice_minutes) AS voice_minutes,
+           SUM(coins) AS coins, SUM(xp) AS xp
+    FROM activity_rollups
+    WHERE guild_id = $1 AND bucket >= $2
+    GROUP BY user_id
+    ORDER BY SUM(coins) DESC
+    LIMIT $3
+''', RollupTopRow)
+ROLLUP_EXPIRE = statement('rollup_expire', 'execute', 'DELETE FROM activity_rollups WHERE bucket < $1')
+
+def sqlite_rollup_compact(db, cutoff):
+    day = "strftime('%Y-%m-%d 00:00:00', bucket)"
+    db.execute(f'''
+        INSERT INTO activity_rollups (guild_id, user_id, bucket, messages, voice_minutes, coins, xp)
+        SELECT guild_id, user_id, {day}, SUM(messages), SUM(voice_minutes), SUM(coins), SUM(xp)
+        FROM activity_rollups WHERE bucket < ?1 AND bucket <> {day}
+        GROUP BY guild_id, user_id, {day}
+        ON CONFLICT (guild_id, user_id, bucket) DO UPDATE SET
+            messages = messages + excluded.messages, voice_minutes = voice_minutes + excluded.voice_minutes,
+            coins = coins + excluded.coins, xp = xp + excluded.xp
+    ''', (cutoff,))
+    db.execute(f'DELETE FROM activity_rollups WHERE bucket < ?1 AND bucket <> {day}', (cutoff,))
+
+# Часовые корзины до $1 (полночь) складываются в корзину своей полуночи и удаляются
+ROLLUP_COMPACT = statement('rollup_compact', 'execute', '''
+    WITH hourly AS (
+        DELETE FROM activity_rollups
+        WHERE bucket < $1 AND bucket <> date_trunc('day', bucket)
+        RETURNING guild_id, user_id, bucket, messages, voice_minutes, coins, xp
+    )
+    INSERT INTO activity_rollups (guild_id, user_id, bucket, messages, voice_minutes, coins, xp)
+    SELECT guild_id, user_id, date_trunc('day', bucket), SUM(messages), SUM(voice_minutes), SUM(coins), SUM(xp)
+    FROM hourly
+    GROUP BY guild_id, user_id, date_trunc('day', bucket)
+    ON CONFLICT (guild_id, user_id, bucket) DO UPDATE SET
+        messages = activity_rollups.messages + EXCLUDED.messages,
+        voice_minutes = activity_rollups.voice_minutes + EXCLUDED.voice_minutes,
+        coins = activity_rollups.coins + EXCLUDED.coins,
+        xp = activity_rollups.xp + EXCLUDED.xp
+''', sqlite=sqlite_rollup_compact)
+
+# Топ и профили
+RANK_POSITION = statement('rank_position', 'fetchval', '''
+    SELECT COUNT(*) + 1 FROM coins
+    WHERE guild_id = $1 AND balance > COALESCE(
+        (SELECT balance FROM coins WHERE user_id = $2 AND guild_id = $1), '-Infinity'::REAL)
+''')
+RANK_BALANCES = statement('rank_balances', 'fetch', 'SELECT user_id, balance FROM coins WHERE guild_id = $1')
+LEADERBOARD_TOP = statement('leaderboard_top', 'fetch', '''
+    SELECT coins.user_id, coins.balance, xp.level 
+    FROM coins 
+    LEFT JOIN xp ON coins.user_id = xp.user_id AND coins.guild_id = xp.guild_id
+    WHERE coins.guild_id = $1
+    ORDER BY coins.balance DESC 
+    LIMIT $2
+''', LeaderboardRow)
+PROFILE = statement('profile', 'fetchrow', '''
+    SELECT
+        COALESCE((SELECT count FROM messages WHERE user_id = $1 AND guild_id = $2), 0) AS messages,
+        COALESCE(c.balance, 0) AS coins,
+        COALESCE(x.xp, 0) AS xp,
+        COALESCE(x.level, 1) AS level,
+        (SELECT COUNT(*) FROM warns
+         WHERE user_id = $1 AND guild_id = $2 AND date > $3 AND expired = FALSE) AS active_warns,
+        (SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2) AS total_warns,
+        COALESCE((SELECT total_minutes FROM voice_time WHERE user_id = $1 AND guild_id = $2), 0) AS voice_minutes,
+        (SELECT partner_id FROM marriages WHERE user_id = $1 AND guild_id = $2) AS partner_id,
+        (SELECT COUNT(*) + 1 FROM coins
+         WHERE guild_id = $2 AND balance > COALESCE(c.balance, '-Infinity'::REAL)) AS position
+    FROM (SELECT $1::BIGINT AS user_id, $2::BIGINT AS guild_id) p
+    LEFT JOIN coins c ON c.user_id = p.user_id AND c.guild_id = p.guild_id
+    LEFT JOIN xp x ON x.user_id = p.user_id AND x.guild_id = p.guild_id
+''', ProfileRow)
+
+# Голос
+VOICE_SESSIONS_LOAD = statement('voice_sessions_load', 'fetch',
+    'SELECT user_id, guild_id, accrued_at FROM voice_sessions', VoiceSessionRow)
+SQLITE_VOICE_SESSION_UPSERT = '''
+    INSERT INTO voice_sessions (user_id, guild_id, channel_id, joined_at, accrued_at) VALUES (?1, ?2, ?3, ?4, ?5)
+    ON CONFLICT (user_id, guild_id) DO UPDATE SET channel_id = excluded.channel_id, accrued_at = excluded.accrued_at
+'''
+
+def sqlite_voice_sessions_save(db, user_ids, guild_ids, channel_ids, joined, accrued, closed_users, closed_guilds):
+    db.executemany(SQLITE_VOICE_SESSION_UPSERT, zip(user_ids, guild_ids, channel_ids, joined, accrued))
+    db.executemany('DELETE FROM voice_sessions WHERE user_id = ?1 AND guild_id = ?2', zip(closed_users, closed_guilds))
+
+VOICE_SESSIONS_SAVE = statement('voice_sessions_save', 'execute', '''
+    WITH upsert AS (
+        INSERT INTO voice_sessions (user_id, guild_id, channel_id, joined_at, accrued_at)
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::timestamp[], $5::timestamp[])
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET
+            channel_id = EXCLUDED.channel_id, accrued_at = EXCLUDED.accrued_at
+    )
+    DELETE FROM voice_sessions
+    WHERE (user_id, guild_id) IN (SELECT * FROM unnest($6::bigint[], $7::bigint[]))
+''', sqlite=sqlite_voice_sessions_save)
+
+# Браки
+PARTNER = statement('partner', 'fetchval', 'SELECT partner_id FROM marriages WHERE user_id = $1 AND guild_id = $2')
+MARRIAGE_INSERT = statement('marriage_insert', 'execute',
+    'INSERT INTO marriages (user_id, guild_id, partner_id, married_since) VALUES ($1, $2, $3, $4)')
+
+# Диалоги нейросети
+CONVERSATION_LOAD = statement('conversation_load', 'fetchval', 'SELECT messages FROM ai_conversations WHERE user_id = $1')
+CONVERSATION_SAVE = statement('conversation_save', 'execute', '''
+    INSERT INTO ai_conversations (user_id, messages, updated_at) VALUES ($1, $2::jsonb, $3)
+    ON CONFLICT (user_id) DO UPDATE SET messages = EXCLUDED.messages, updated_at = EXCLUDED.updated_at
+''')
+CONVERSATION_DELETE = statement('conversation_delete', 'execute', 'DELETE FROM ai_conversations WHERE user_id = $1')
+
+# Тикеты
+OPEN_TICKETS_LOAD = statement('open_tickets_load', 'fetch',
+    'SELECT guild_id, user_id, channel_id FROM open_tickets', OpenTicketRow)
+OPEN_TICKET_SAVE = statement('open_ticket_save', 'execute', '''
+    INSERT INTO open_tickets (guild_id, user_id, channel_id, opened_at) VALUES ($1, $2, $3, $4)
+    ON CONFLICT (guild_id, user_id) DO UPDATE SET channel_id = EXCLUDED.channel_id, opened_at = EXCLUDED.opened_at
+''')
+OPEN_TICKET_DELETE = statement('open_ticket_delete', 'execute', 'DELETE FROM open_tickets WHERE channel_id = $1')
+COMMAND_SYNC_HASH = statement('command_sync_hash', 'fetchval', 'SELECT payload_hash FROM command_sync WHERE guild_id = $1')
+COMMAND_SYNC_SAVE = statement('command_sync_save', 'execute', '''
+    INSERT INTO command_sync (guild_id, payload_hash, synced_at) VALUES ($1, $2, $3)
+    ON CONFLICT (guild_id) DO UPDATE SET payload_hash = EXCLUDED.payload_hash, synced_at = EXCLUDED.synced_at
+''')
+TICKET_ARCHIVE = statement('ticket_archive', 'execute', '''
+    INSERT INTO tickets (guild_id, channel_id, channel_name, opener_id, closer_id,
+                         opened_at, closed_at, message_count, archive_message_id)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+''')
+
+# ================== МИГРАЦИИ ==================
+# Версия, описание, запросы. Новые шаги только дописываются в конец, старые не меняются.
+MIGRATIONS = [
+    (1, "Индекс рейтинга монет", [
+        'CREATE INDEX IF NOT EXISTS coins_guild_balance_idx ON coins (guild_id, balance DESC)',
+    ]),
+    (2, "Индексы варнов", [
+        'CREATE INDEX IF NOT EXISTS warns_active_idx ON warns (user_id, guild_id, date) WHERE expired = FALSE',
+        'CREATE INDEX IF NOT EXISTS warns_user_guild_idx ON warns (user_id, guild_id)',
+        'CREATE INDEX IF NOT EXISTS warns_expiry_idx ON warns (date) WHERE expired = FALSE',
+    ]),
+    (3, "Индекс монет по игроку", [
+        'CREATE INDEX IF NOT EXISTS coins_user_idx ON coins (user_id)',
+    ]),
+    (4, "Открытые голосовые сессии", [
+        '''
+        CREATE TABLE IF NOT EXISTS voice_sessions (
+            user_id BIGINT,
+            guild_id BIGINT,
+            channel_id BIGINT,
+            joined_at TIMESTAMP,
+            accrued_at TIMESTAMP,
+            PRIMARY KEY (user_id, guild_id)
+        )
+        ''',
+    ]),
+    (5, "История диалогов с нейросетью", [
+        '''
+        CREATE TABLE IF NOT EXISTS ai_conversations (
+            user_id BIGINT PRIMARY KEY,
+            messages JSONB,
+            updated_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (6, "Архив тикетов", [
+        '''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id SERIAL PRIMARY KEY,
+            guild_id BIGINT,
+            channel_id BIGINT,
+            channel_name TEXT,
+            opener_id BIGINT,
+            closer_id BIGINT,
+            opened_at TIMESTAMPTZ,
+            closed_at TIMESTAMPTZ,
+            message_count INTEGER,
+            archive_message_id BIGINT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS tickets_opener_idx ON tickets (guild_id, opener_id, closed_at DESC)',
+        'CREATE INDEX IF NOT EXISTS tickets_closed_idx ON tickets (guild_id, closed_at DESC)',
+    ]),
+    (7, "Реестр открытых тикетов", [
+        '''
+        CREATE TABLE IF NOT EXISTS open_tickets (
+            guild_id BIGINT,
+            user_id BIGINT,
+            channel_id BIGINT UNIQUE,
+            opened_at TIMESTAMP,
+            PRIMARY KEY (guild_id, user_id)
+        )
+        ''',
+    ]),
+    (8, "Хэши синхронизации команд", [
+        '''
+        CREATE TABLE IF NOT EXISTS command_sync (
+            guild_id BIGINT PRIMARY KEY,
+            payload_hash TEXT,
+            synced_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (9, "История активности по корзинам", [
+        '''
+        CREATE TABLE IF NOT EXISTS activity_rollups (
+            guild_id BIGINT,
+            user_id BIGINT,
+            bucket TIMESTAMP,
+            messages INTEGER DEFAULT 0,
+            voice_minutes INTEGER DEFAULT 0,
+            coins REAL DEFAULT 0,
+            xp INTEGER DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id, bucket)
+        )
+        ''',
+        # Топ за период читается только из индекса: диапазон по bucket, все суммируемые поля в ключе
+        'CREATE INDEX IF NOT EXISTS activity_rollups_period_idx '
+        'ON activity_rollups (guild_id, bucket, user_id, messages, voice_minutes, coins, xp)',
+    ]),
+    (10, "Индекс истории активности игрока", [
+        # ROLLUP_USER по activity_rollups_period_idx перебирал корзины всех игроков сервера за период,
+        # а первичный ключ требует чтения таблицы. Здесь диапазон корзин одного игрока, суммы — из индекса.
+        # Поля в ключе, а не в INCLUDE: тот же текст миграции работает и в SQLite
+        'CREATE INDEX IF NOT EXISTS activity_rollups_user_idx '
+        'ON activity_rollups (guild_id, user_id, bucket, messages, voice_minutes, coins, xp)',
+    ]),
+]
+
+MIGRATIONS_LOCK_ID = 804_001  # pg_advisory_lock, чтобы миграции не шли из двух процессов сразу
+
+async def pending_migrations(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+    applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+@asynccontextmanager
+async def schema_lock(conn):
+    """Держит pg_advisory_lock на время DDL; в SQLite запись и так сериализована"""
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATIONS_LOCK_ID)
+    try:
+        yield
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATIONS_LOCK_ID)
+
+async def apply_migrations(conn):
+    """Применяет недостающие миграции по порядку, каждую в своей транзакции; вызывается под schema_lock"""
+    for version, description, statements in await pending_migrations(conn):
+        async with conn.transaction():
+            for sql in statements:
+                await conn.execute(sql)
+            await conn.execute('INSERT INTO schema_migrations (version, description) VALUES ($1, $2)',
+                               version, description)
+        print(f"✅ Миграция {version}: {description}")
+
+def hot_queries():
+    """Горячие запросы бота с примерными параметрами — для EXPLAIN"""
+    seven_days_ago = datetime.now() - timedelta(days=7)
+    return [
+        ("Профиль /stat /infoplayer", PROFILE.sql, (0, 0, seven_days_ago)),
+        ("Место в топе", RANK_POSITION.sql, (0, 0)),
+        ("Топ /top", LEADERBOARD_TOP.sql, (0, LEADERBOARD_SIZE)),
+        ("Варны за 7 дней", WARN_COUNT.sql, (0, 0, seven_days_ago)),
+        ("Монеты для уведомления", COIN_BALANCE.sql, (0,)),
+        ("Загрузка сроков варнов", WARNS_UPCOMING.sql, (seven_days_ago,)),
+    ]
+
+async def print_plans(conn, title):
+    print(f"\n==================== {title} ====================")
+    for name, sql, args in hot_queries():
+        plan = await conn.fetch('EXPLAIN ' + sql, *args)
+        print(f"\n--- {name} ---")
+        for row in plan:
+            print(row[0])
+
+async def migrations_dry_run():
+    """Печатает планы горячих запросов до и после недостающих миграций, ничего не сохраняя"""
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url or database_url.startswith('sqlite:///'):
+        print("ℹ️ Пробный прогон миграций с планами EXPLAIN есть только для PostgreSQL")
         return
-    
-    balance = row['balance']
-    
-    row = await conn.fetchrow('SELECT last_notification FROM coin_notifications WHERE user_id = $1', user_id)
-    last_notified = row['last_notification'] if row else 0
-    
-    current_milestone = int(balance // 100) * 100
-    last_milestone = int(last_notified // 100) * 100
-    
-    if current_milestone > last_milestone:
+    conn = await asyncpg.connect(database_url)
+    try:
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            pending = await pending_migrations(conn)
+            print("Ожидают применения: " + (", ".join(f"{v} ({d})" for v, d, _ in pending) or "нет"))
+            await print_plans(conn, "ДО")
+            for _, _, statements in pending:
+                for sql in statements:
+                    await conn.execute(sql)
+            await conn.execute('ANALYZE coins; ANALYZE warns')
+            await print_plans(conn, "ПОСЛЕ")
+        finally:
+            await transaction.rollback()
+    finally:
+        await conn.close()
+
+# ================== ИСТЕЧЕНИЕ ВАРНОВ ==================
+# Варн активен 7 дней. Все счётчики фильтруют по date > now - 7 дней, так что истечение
+# считается при чтении и общий UPDATE по таблице не нужен. Планировщик (по желанию)
+# дополнительно помечает expired = TRUE ровно в момент истечения.
+WARN_LIFETIME = timedelta(days=7)
+WARN_EXPIRY_SCHEDULER = os.getenv('WARN_EXPIRY_SCHEDULER', '0') == '1'
+# Планировщик крутит только воркер 0, а варны выдают все воркеры кластера: он перечитывает сроки из БД
+WARN_EXPIRY_POLL = float(os.getenv('WARN_EXPIRY_POLL', '300'))  # секунды
+
+class WarnExpiryScheduler:
+    """Мин-куча сроков истечения активных варнов; сроки подгружаются из БД при старте и раз в WARN_EXPIRY_POLL"""
+
+    def __init__(self, poll_interval=WARN_EXPIRY_POLL):
+        self.poll_interval = poll_interval
+        self._heap = []  # (срок, warn_id)
+        self._known = set()  # warn_id в куче, чтобы перечитывание не дублировало сроки
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.expired = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, warn_id, date):
+        if self._task is None:
+            return
+        self._push(warn_id, date)
+        self._wakeup.set()
+
+    def _push(self, warn_id, date):
+        if warn_id not in self._known:
+            self._known.add(warn_id)
+            heapq.heappush(self._heap, (date + WARN_LIFETIME, warn_id))
+
+    async def _load(self, pool):
+        # Уже истёкшие варны не трогаем: при чтении они и так не считаются
+        async with pool.acquire() as conn:
+            rows = await WARNS_UPCOMING(conn, datetime.now() - WARN_LIFETIME)
+        for row in rows:
+            self._push(row['id'], row['date'])
+
+    async def _run(self):
+        pool = await wait_for_db()
+        await self._load(pool)
+        next_poll = time.monotonic() + self.poll_interval
+
+        while True:
+            self._wakeup.clear()
+            if time.monotonic() >= next_poll:
+                # Варны, выданные на других воркерах кластера
+                try:
+                    await self._load(pool)
+                except Exception as e:
+                    print(f"❌ Ошибка загрузки сроков варнов: {e}")
+                next_poll = time.monotonic() + self.poll_interval
+            now = datetime.now()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+
+            delay = 3600
+            if due:
+                try:
+                    async with pool.acquire() as conn:
+                        await WARNS_EXPIRE(conn, [warn_id for _, warn_id in due])
+                    self.expired += len(due)
+                    self._known.difference_update(warn_id for _, warn_id in due)
+                except Exception as e:
+                    print(f"❌ Ошибка истечения варнов: {e}")
+                    for item in due:
+                        heapq.heappush(self._heap, item)
+                    delay = 60
+            if self._heap:
+                delay = min(delay, max((self._heap[0][0] - datetime.now()).total_seconds(), 0))
+            delay = min(delay, max(next_poll - time.monotonic(), 0))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {"enabled": self._task is not None, "scheduled": len(self._heap), "expired": self.expired}
+
+warn_expiry = WarnExpiryScheduler()
+
+def coin_milestone(balance):
+    return int(balance // 100) * 100
+
+async def coin_milestones(conn, balances):
+    """Отмечает, кто перешагнул новую сотню монет: {user_id: баланс} -> {user_id: сотня}, два запроса на пачку"""
+    notified = {row['user_id']: row['last_notification'] or 0
+                for row in await COIN_NOTIFIED_MANY(conn, list(balances))}
+    crossed = {user_id: balance for user_id, balance in balances.items()
+               if coin_milestone(balance) > coin_milestone(notified.get(user_id, 0))}
+    if crossed:
+        await COIN_NOTIFIED_SET_MANY(conn, list(crossed), list(crossed.values()))
+    return {user_id: coin_milestone(balance) for user_id, balance in crossed.items()}
+
+async def send_coin_milestones(milestones):
+    for user_id, milestone in milestones.items():
         user = bot.get_user(user_id)
         if user:
             embed = discord.Embed(
                 title="💰 Достижение!",
-                description=f"Ты накопил **{int(current_milestone)} монет**! Так держать!",
+                description=f"Ты накопил **{milestone} монет**! Так держать!",
                 color=discord.Color.gold()
             )
             try:
                 await user.send(embed=embed)
             except:
                 pass
-        
-        await conn.execute('''
-            INSERT INTO coin_notifications (user_id, last_notification) 
-            VALUES ($1, $2) 
-            ON CONFLICT (user_id) DO UPDATE SET last_notification = $2
-        ''', user_id, balance)
+
+async def check_coin_milestone(user_id, conn):
+    balance = await COIN_BALANCE(conn, user_id)
+    if balance is None:
+        return
+    await send_coin_milestones(await coin_milestones(conn, {user_id: balance}))
+
+# ================== УРОВНИ ==================
+# Для перехода с уровня L на L+1 нужно L * 100 XP, значит уровень L начинается
+# с 50 * L * (L - 1) XP суммарно. Уровень и остаток считаются по формуле, без цикла.
+def level_base(level):
+    """Суммарный XP, с которого начинается уровень"""
+    return 50 * level * (level - 1)
+
+def level_from_total(total):
+    """Уровень по суммарному XP"""
+    total = max(total, 0)
+    return (1 + math.isqrt(1 + 4 * (total // 50))) // 2
+
+def apply_xp(level, xp, amount):
+    """Новые (level, xp) после начисления amount XP"""
+    total = max(level_base(level) + xp + amount, 0)
+    new_level = level_from_total(total)
+    return new_level, total - level_base(new_level)
 
 async def add_xp(user_id, guild_id, amount, conn):
-    row = await conn.fetchrow('SELECT xp, level FROM xp WHERE user_id = $1 AND guild_id = $2', user_id, guild_id)
-    
-    if row:
-        xp, level = row['xp'], row['level']
-        xp += amount
-        
-        next_level_xp = level * 100
-        
-        while xp >= next_level_xp:
-            level += 1
-            xp -= next_level_xp
-            next_level_xp = level * 100
-        
-        await conn.execute('UPDATE xp SET xp = $1, level = $2 WHERE user_id = $3 AND guild_id = $4', 
-                          xp, level, user_id, guild_id)
+    """Атомарно начисляет XP и возвращает (уровень до, уровень после)"""
+    row = await XP_ADD(conn, user_id, guild_id, amount)
+    total = level_base(row.level) + row.xp
+    return level_from_total(total - amount), row.level
+
+# ================== БУФЕР АКТИВНОСТИ ==================
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5'))  # секунды
+ACTIVITY_FLUSH_EVENTS = int(os.getenv('ACTIVITY_FLUSH_EVENTS', '500'))  # событий до досрочного сброса
+
+class ActivityBuffer:
+    """Копит сообщения, монеты, XP и минуты в голосе в памяти и пишет их в БД пачками"""
+
+    def __init__(self, interval, max_events):
+        self.interval = interval
+        self.max_events = max_events
+        self._pending = {}  # (user_id, guild_id) -> [сообщения, монеты, xp, минуты в голосе]
+        self._events = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        # Метрики
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add(self, user_id, guild_id, messages=0, coins=0.0, xp=0, voice=0):
+        self._merge((user_id, guild_id), (messages, coins, xp, voice))
+        self._events += 1
+        if self._events >= self.max_events:
+            self._wakeup.set()
+
+    def _merge(self, key, deltas):
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = list(deltas)
+        else:
+            for i, delta in enumerate(deltas):
+                entry[i] += delta
+
+    def pending(self, user_id, guild_id):
+        """Ещё не записанные в БД (сообщения, монеты, xp, минуты в голосе) игрока"""
+        return tuple(self._pending.get((user_id, guild_id), (0, 0.0, 0, 0)))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и гарантированно пишет остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending and bot.db_pool is not None:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Не удалось сбросить буфер активности при остановке: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                try:
+                    await wait_for_db()
+                    await self.flush()
+                except Exception as e:
+                    print(f"❌ Ошибка сброса буфера активности: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, events = self._pending, self._events
+            self._pending, self._events = {}, 0
+
+            started = time.perf_counter()
+            updated = None
+            try:
+                async with bot.db_pool.acquire() as conn:
+                    updated = await self._write(conn, batch)
+            except BaseException:
+                if updated is None:
+                    # Сам запрос не прошёл (в том числе отмена при остановке): транзакция откатилась,
+                    # пачка вернётся в буфер
+                    self.failed_flushes += 1
+                    self._restore(batch, events)
+                # Иначе пачка уже записана, а сбой случился при возврате соединения — вернуть её значит учесть дважды
+                raise
+            finally:
+                if updated is not None:
+                    self._apply(batch, updated)
+
+            elapsed = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed_events += events
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self.total_flush_ms += elapsed
+
+        await self._notify_milestones(updated)
+
+    def _restore(self, batch, events):
+        # Возвращаем непринятую пачку в буфер, чтобы не потерять активность
+        for key, deltas in batch.items():
+            self._merge(key, deltas)
+        self._events += events
+
+    async def _write(self, conn, batch):
+        user_ids, guild_ids, messages, coins, xps, voices = [], [], [], [], [], []
+        for (user_id, guild_id), (msg_delta, coin_delta, xp_delta, voice_delta) in batch.items():
+            user_ids.append(user_id)
+            guild_ids.append(guild_id)
+            messages.append(msg_delta)
+            coins.append(coin_delta)
+            xps.append(xp_delta)
+            voices.append(voice_delta)
+
+        return await ACTIVITY_FLUSH(conn, user_ids, guild_ids, messages, coins, xps, voices,
+                                    hour_bucket(datetime.now()))
+
+    def _apply(self, batch, updated):
+        # Кэши обновляются только по записанной пачке; их ошибки не должны возвращать её в буфер
+        for user_id, guild_id in batch:
+            profiles.invalidate(guild_id, user_id)
+        for row in updated:
+            if row['balance'] is not None:
+                rank_service.update(row['guild_id'], row['user_id'], row['balance'])
+            leaderboard.update(row['guild_id'], row['user_id'], balance=row['balance'], level=row['level'])
+
+    async def _notify_milestones(self, updated):
+        # Новые балансы уже пришли из ACTIVITY_FLUSH; уведомления хранятся по игроку, берём его больший баланс
+        balances = {}
+        for row in updated:
+            if row['balance'] is not None:
+                balances[row['user_id']] = max(row['balance'], balances.get(row['user_id'], row['balance']))
+        if not balances:
+            return
+        async with bot.db_pool.acquire() as conn:
+            milestones = await coin_milestones(conn, balances)
+        await send_coin_milestones(milestones)
+
+    def stats(self):
+        return {
+            "pending_users": len(self._pending),
+            "pending_events": self._events,
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_EVENTS)
+
+# ================== РЕЙТИНГ ==================
+RANK_IN_MEMORY = os.getenv('RANK_IN_MEMORY', '0') == '1'  # держать рейтинг серверов в памяти
+
+class _RankNode:
+    __slots__ = ("key", "prio", "size", "left", "right")
+
+    def __init__(self, key):
+        self.key = key
+        self.prio = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+
+def _rank_size(node):
+    return node.size if node else 0
+
+def _rank_fix(node):
+    node.size = 1 + _rank_size(node.left) + _rank_size(node.right)
+
+def _rank_split(node, key):
+    """Делит дерево на ключи < key и >= key"""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = _rank_split(node.right, key)
+        _rank_fix(node)
+        return node, right
+    left, node.left = _rank_split(node.left, key)
+    _rank_fix(node)
+    return left, node
+
+def _rank_merge(left, right):
+    if left is None or right is None:
+        return left or right
+    if left.prio > right.prio:
+        left.right = _rank_merge(left.right, right)
+        _rank_fix(left)
+        return left
+    right.left = _rank_merge(left, right.left)
+    _rank_fix(right)
+    return right
+
+class RankTree:
+    """Декартово дерево с размерами поддеревьев: вставка, удаление и ранг за O(log n)"""
+
+    def __init__(self, keys=()):
+        self.root = None
+        # Строим за O(n) из отсортированных ключей через стек правой ветки
+        stack = []
+        for key in sorted(keys):
+            node = _RankNode(key)
+            last = None
+            while stack and stack[-1].prio < node.prio:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        if stack:
+            self.root = stack[0]
+            self._fix_sizes()
+
+    def _fix_sizes(self):
+        order, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(child for child in (node.left, node.right) if child)
+        for node in reversed(order):
+            _rank_fix(node)
+
+    def __len__(self):
+        return _rank_size(self.root)
+
+    def insert(self, key):
+        left, right = _rank_split(self.root, key)
+        self.root = _rank_merge(_rank_merge(left, _RankNode(key)), right)
+
+    def remove(self, key):
+        left, rest = _rank_split(self.root, key)
+        _, right = _rank_split(rest, (key[0], key[1] + 1))
+        self.root = _rank_merge(left, right)
+
+    def count_greater(self, key):
+        count, node = 0, self.root
+        while node:
+            if node.key > key:
+                count += 1 + _rank_size(node.right)
+                node = node.left
+            else:
+                node = node.right
+        return count
+
+class GuildRank:
+    """Балансы одного сервера и дерево по ключу (balance, user_id)"""
+
+    def __init__(self, rows):
+        self.balances = {row['user_id']: row['balance'] for row in rows}
+        self.tree = RankTree((balance, user_id) for user_id, balance in self.balances.items())
+
+    def set(self, user_id, balance):
+        old = self.balances.get(user_id)
+        if old is not None:
+            self.tree.remove((old, user_id))
+        self.balances[user_id] = balance
+        self.tree.insert((balance, user_id))
+
+    def position(self, user_id):
+        balance = self.balances.get(user_id)
+        if balance is None:
+            return len(self.balances) + 1
+        return self.tree.count_greater((balance, math.inf)) + 1
+
+class RankService:
+    """Место игрока в топе по монетам: запрос по индексу (guild_id, balance DESC) или дерево в памяти"""
+
+    def __init__(self, in_memory):
+        self.in_memory = in_memory
+        self._guilds = {}
+        self._loading = {}  # guild_id -> обновления, пришедшие во время загрузки
+        self._locks = {}
+
+    async def position(self, guild_id, user_id, conn):
+        if not self.in_memory:
+            return await RANK_POSITION(conn, guild_id, user_id)
+
+        rank = self._guilds.get(guild_id)
+        if rank is None:
+            rank = await self._load(guild_id, conn)
+        return rank.position(user_id)
+
+    async def _load(self, guild_id, conn):
+        lock = self._locks.setdefault(guild_id, asyncio.Lock())
+        async with lock:
+            if guild_id in self._guilds:
+                return self._guilds[guild_id]
+            self._loading[guild_id] = []
+            try:
+                rows = await RANK_BALANCES(conn, guild_id)
+            finally:
+                updates = self._loading.pop(guild_id)
+            rank = GuildRank(rows)
+            for user_id, balance in updates:
+                rank.set(user_id, balance)
+            self._guilds[guild_id] = rank
+            return rank
+
+    def update(self, guild_id, user_id, balance):
+        """Новый абсолютный баланс игрока (вызывается из всех путей начисления монет)"""
+        if not self.in_memory:
+            return
+        rank = self._guilds.get(guild_id)
+        if rank is not None:
+            rank.set(user_id, balance)
+        elif guild_id in self._loading:
+            self._loading[guild_id].append((user_id, balance))
+
+    def stats(self):
+        return {
+            "mode": "memory" if self.in_memory else "db",
+            "guilds": len(self._guilds),
+            "entries": sum(len(rank.balances) for rank in self._guilds.values()),
+        }
+
+rank_service = RankService(RANK_IN_MEMORY)
+
+# ================== КЭШ ТОПА ==================
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))  # сколько мест держать на сервер
+LEADERBOARD_MAX_GUILDS = int(os.getenv('LEADERBOARD_MAX_GUILDS', '1000'))  # серверов в кэше одновременно
+
+class LeaderboardCache:
+    """Топ-K по монетам для каждого сервера, обновляется на месте при начислениях.
+
+    Монеты только начисляются, поэтому попасть в топ можно лишь через update(),
+    и кэш остаётся точным без перечитывания БД.
+    """
+
+    def __init__(self, size, max_guilds):
+        self.size = size
+        self.max_guilds = max_guilds
+        self._boards = OrderedDict()  # guild_id -> [{'user_id', 'balance', 'level'}], по убыванию баланса
+        self._loads = {}  # guild_id -> задача загрузки
+        self._dirty = set()  # серверы, изменённые во время загрузки
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, guild_id):
+        board = self._boards.get(guild_id)
+        if board is not None:
+            self.hits += 1
+            self._boards.move_to_end(guild_id)
+            return board
+
+        self.misses += 1
+        task = self._loads.get(guild_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(guild_id))
+            self._loads[guild_id] = task
+            task.add_done_callback(lambda _: self._loads.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, guild_id):
+        self._dirty.discard(guild_id)
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            rows = await LEADERBOARD_TOP(conn, guild_id, self.size)
+        board = [dict(row) for row in rows]
+        # Если кто-то заработал монеты, пока шёл запрос, снимок мог устареть — не кэшируем его
+        if guild_id not in self._dirty:
+            self._boards[guild_id] = board
+            while len(self._boards) > self.max_guilds:
+                self._boards.popitem(last=False)
+        return board
+
+    def update(self, guild_id, user_id, balance=None, level=None):
+        """Новый баланс и/или уровень игрока после начисления"""
+        if guild_id in self._loads:
+            self._dirty.add(guild_id)
+        board = self._boards.get(guild_id)
+        if board is None:
+            return
+
+        for entry in board:
+            if entry['user_id'] == user_id:
+                if balance is not None:
+                    entry['balance'] = balance
+                if level is not None:
+                    entry['level'] = level
+                break
+        else:
+            if balance is None or (len(board) >= self.size and balance <= board[-1]['balance']):
+                return
+            if level is None:
+                # Уровень новичка в топе неизвестен — перечитаем сервер при следующем запросе
+                del self._boards[guild_id]
+                return
+            board.append({'user_id': user_id, 'balance': balance, 'level': level})
+
+        board.sort(key=lambda entry: entry['balance'], reverse=True)
+        del board[self.size:]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "guilds": len(self._boards),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+leaderboard = LeaderboardCache(LEADERBOARD_SIZE, LEADERBOARD_MAX_GUILDS)
+
+# ================== ИСТОРИЯ АКТИВНОСТИ ==================
+# Каждый сброс буфера активности заодно дописывает приросты в часовую корзину (сервер, игрок, час).
+# Часовые корзины старше ROLLUP_HOURLY_DAYS сворачиваются в дневные (корзина на полночь),
+# поэтому строк на игрока не больше 24 * ROLLUP_HOURLY_DAYS + ROLLUP_KEEP_DAYS, как бы долго ни жил бот.
+ROLLUP_HOURLY_DAYS = int(os.getenv('ROLLUP_HOURLY_DAYS', '2'))  # сколько дней хранить по часам
+ROLLUP_KEEP_DAYS = int(os.getenv('ROLLUP_KEEP_DAYS', '400'))  # дневные корзины старше удаляются, 0 — хранить всё
+ROLLUP_COMPACT_INTERVAL = float(os.getenv('ROLLUP_COMPACT_INTERVAL', '3600'))  # секунды между свёртками
+ROLLUP_TOP_TTL = float(os.getenv('ROLLUP_TOP_TTL', '60'))  # секунды кэша топа за период
+ROLLUP_TOP_CACHE_SIZE = int(os.getenv('ROLLUP_TOP_CACHE_SIZE', '1000'))  # топов (сервер, период) в кэше
+
+ROLLUP_PERIODS = {
+    'day': (timedelta(days=1), "за сутки"),
+    'week': (timedelta(days=7), "за неделю"),
+    'month': (timedelta(days=30), "за месяц"),
+}
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def day_bucket(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def period_start(period):
+    """Начало периода, выровненное вверх по корзинам, которые для него ещё хранятся.
+
+    Неполная корзина на границе не берётся: иначе «за сутки» захватывали бы лишний час, а «за месяц»
+    по дневным корзинам — до лишних 23 часов. Период выходит короче не больше чем на одну корзину.
+    """
+    now = datetime.now()
+    since = now - ROLLUP_PERIODS[period][0]
+    if since >= day_bucket(now - timedelta(days=ROLLUP_HOURLY_DAYS)):
+        bucket, step = hour_bucket(since), timedelta(hours=1)
     else:
-        await conn.execute('INSERT INTO xp (user_id, guild_id, xp, level) VALUES ($1, $2, $3, $4)', 
-                          user_id, guild_id, amount, 1)
+        bucket, step = day_bucket(since), timedelta(days=1)
+    return bucket if bucket == since else bucket + step
+
+class ActivityRollups:
+    """Активность за период из корзин: по игроку — с учётом буфера, топ сервера — с коротким кэшем"""
+
+    def __init__(self, top_ttl, max_tops):
+        self.top_ttl = top_ttl
+        self.max_tops = max_tops
+        self._tops = OrderedDict()  # (guild_id, period) -> (истекает, строки), LRU
+        self._task = None
+        self.compactions = 0
+        self.last_compact_ms = 0.0
+
+    async def user(self, guild_id, user_id, period):
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            row = dict(await ROLLUP_USER(conn, guild_id, user_id, period_start(period)))
+        messages, coins, xp, voice = activity_buffer.pending(user_id, guild_id)
+        row['messages'] += messages
+        row['coins'] += coins
+        row['xp'] += xp
+        row['voice_minutes'] += voice
+        return row
+
+    async def top(self, guild_id, period, limit=10):
+        key = (guild_id, period)
+        cached = self._tops.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._tops.move_to_end(key)
+            return cached[1]
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            rows = [dict(row) for row in await ROLLUP_TOP(conn, guild_id, period_start(period), limit)]
+        self._tops[key] = (time.monotonic() + self.top_ttl, rows)
+        self._tops.move_to_end(key)
+        while len(self._tops) > self.max_tops:
+            self._tops.popitem(last=False)
+        return rows
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def compact(self):
+        """Сворачивает старые часовые корзины в дневные и удаляет корзины старше ROLLUP_KEEP_DAYS"""
+        started = time.perf_counter()
+        now = datetime.now()
+        async with transaction() as conn:
+            if ROLLUP_KEEP_DAYS:
+                await ROLLUP_EXPIRE(conn, day_bucket(now - timedelta(days=ROLLUP_KEEP_DAYS)))
+            await ROLLUP_COMPACT(conn, day_bucket(now - timedelta(days=ROLLUP_HOURLY_DAYS)))
+        self.compactions += 1
+        self.last_compact_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    async def _run(self):
+        while True:
+            try:
+                await wait_for_db()
+                await self.compact()
+            except Exception as e:
+                print(f"❌ Ошибка свёртки истории активности: {e}")
+            await asyncio.sleep(ROLLUP_COMPACT_INTERVAL)
+
+    def stats(self):
+        return {"enabled": self._task is not None, "compactions": self.compactions,
+                "last_compact_ms": self.last_compact_ms, "cached_tops": len(self._tops)}
+
+activity_rollups = ActivityRollups(ROLLUP_TOP_TTL, ROLLUP_TOP_CACHE_SIZE)
+
+# ================== ПРОФИЛИ ИГРОКОВ ==================
+PROFILE_TTL = float(os.getenv('PROFILE_TTL', '15'))  # секунды
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '5000'))
+
+class ProfileLoader:
+    """Вся статистика игрока одним запросом, с кэшем на (guild_id, user_id) и коротким TTL"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = OrderedDict()  # (guild_id, user_id) -> (истекает, профиль)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self.hits += 1
+            self._cache.move_to_end(key)
+            profile = cached[1]
+        else:
+            self.misses += 1
+            profile = await self._fetch(guild_id, user_id)
+            self._cache[key] = (time.monotonic() + self.ttl, profile)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        # Добавляем активность, которая ещё лежит в буфере
+        messages, coins, xp, voice = activity_buffer.pending(user_id, guild_id)
+        if not (messages or coins or xp or voice):
+            return profile
+        profile = dict(profile)
+        profile['messages'] += messages
+        profile['coins'] += coins
+        profile['level'], profile['xp'] = apply_xp(profile['level'], profile['xp'], xp)
+        profile['voice_minutes'] += voice
+        return profile
+
+    async def _fetch(self, guild_id, user_id):
+        seven_days_ago = datetime.now() - timedelta(days=7)
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            row = await PROFILE(conn, user_id, guild_id, seven_days_ago)
+        return dict(row)
+
+    def invalidate(self, guild_id, user_id):
+        self._cache.pop((guild_id, user_id), None)
+
+    def stats(self):
+        return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+profiles = ProfileLoader(PROFILE_TTL, PROFILE_CACHE_SIZE)
 
 # ================== ПРИВЕТСТВИЕ ПРИ ДОБАВЛЕНИИ НА СЕРВЕР ==================
 @bot.event
@@ -222,62 +2602,289 @@ async def on_guild_join(guild):
             pass
 
 # ================== ГОЛОС ==================
+VOICE_TICK_SECONDS = float(os.getenv('VOICE_TICK_SECONDS', '60'))
+VOICE_RESUME_GRACE = timedelta(seconds=int(os.getenv('VOICE_RESUME_GRACE', '300')))  # простой бота, который ещё засчитываем
+
+class VoiceSession:
+    __slots__ = ("channel_id", "joined_at", "accrued_at", "afk")
+
+    def __init__(self, channel_id, joined_at, accrued_at, afk):
+        self.channel_id = channel_id
+        self.joined_at = joined_at
+        self.accrued_at = accrued_at  # до этого момента минуты уже начислены
+        self.afk = afk
+
+class VoiceTracker:
+    """Открытые голосовые сессии: минуты начисляются каждый тик пачкой, сессии хранятся в БД.
+
+    За минуту в голосе даётся 1 монета и 5 XP, в AFK-канале — ничего.
+    Начисления идут через буфер активности, а состояние сессий пишется
+    одним запросом на тик, так что после падения теряется не больше тика.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.sessions = {}  # (guild_id, user_id) -> VoiceSession
+        self._closed = set()  # сессии, которые надо удалить из БД на следующем тике
+        self._task = None
+        self.last_tick_ms = 0.0
+
+    def _accrue(self, key, session, now):
+        minutes = int((now - session.accrued_at).total_seconds() // 60)
+        if minutes <= 0:
+            return
+        session.accrued_at += timedelta(minutes=minutes)
+        if not session.afk:
+            guild_id, user_id = key
+            activity_buffer.add(user_id, guild_id, coins=minutes, xp=minutes * 5, voice=minutes)
+
+    def join(self, guild_id, user_id, channel, now, accrued_at=None):
+        self._closed.discard((guild_id, user_id))
+        self.sessions[(guild_id, user_id)] = VoiceSession(
+            channel.id, now, accrued_at or now, channel == channel.guild.afk_channel)
+
+    def move(self, guild_id, user_id, channel, now):
+        key = (guild_id, user_id)
+        session = self.sessions.get(key)
+        if session is None:
+            return self.join(guild_id, user_id, channel, now)
+        self._accrue(key, session, now)
+        session.channel_id = channel.id
+        session.afk = channel == channel.guild.afk_channel
+
+    def leave(self, guild_id, user_id, now):
+        key = (guild_id, user_id)
+        session = self.sessions.pop(key, None)
+        if session is not None:
+            self._accrue(key, session, now)
+            self._closed.add(key)
+
+    async def rebuild(self):
+        """Сверяет сессии с текущими голосовыми состояниями шлюза (старт и переподключение)"""
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            rows = await VOICE_SESSIONS_LOAD(conn)
+        # Сессии серверов других воркеров кластера не трогаем
+        persisted = {(row['guild_id'], row['user_id']): row['accrued_at'] for row in rows if owns_guild(row['guild_id'])}
+
+        now = datetime.now()
+        live = set()
+        for guild in bot.guilds:
+            for channel in guild.voice_channels + guild.stage_channels:
+                for user_id in channel.voice_states:
+                    member = guild.get_member(user_id)
+                    if member is None or member.bot:
+                        continue
+                    key = (guild.id, user_id)
+                    live.add(key)
+                    if key in self.sessions:
+                        self.move(guild.id, user_id, channel, now)
+                        continue
+                    # Если бот лежал недолго, засчитываем и время простоя
+                    accrued_at = persisted.get(key)
+                    if accrued_at is None or now - accrued_at > VOICE_RESUME_GRACE:
+                        accrued_at = now
+                    self.join(guild.id, user_id, channel, now, accrued_at)
+
+        for key in list(self.sessions):
+            if key not in live:
+                self.leave(*key, now)
+        self._closed.update(key for key in persisted if key not in live)
+        print(f"🎤 Голосовых сессий: {len(self.sessions)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Начисляет минуты до текущего момента и сохраняет сессии"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if bot.db_pool is not None:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"❌ Не удалось сохранить голосовые сессии: {e}")
+
+    async def _run(self):
+        await wait_for_db()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"❌ Ошибка тика голосовых сессий: {e}")
+
+    async def tick(self):
+        started = time.perf_counter()
+        now = datetime.now()
+        user_ids, guild_ids, channel_ids, joined, accrued = [], [], [], [], []
+        for key, session in self.sessions.items():
+            self._accrue(key, session, now)
+            guild_id, user_id = key
+            user_ids.append(user_id)
+            guild_ids.append(guild_id)
+            channel_ids.append(session.channel_id)
+            joined.append(session.joined_at)
+            accrued.append(session.accrued_at)
+        closed, self._closed = self._closed, set()
+        if not user_ids and not closed:
+            return
+
+        try:
+            async with bot.db_pool.acquire() as conn:
+                await VOICE_SESSIONS_SAVE(conn, user_ids, guild_ids, channel_ids, joined, accrued,
+                    [user_id for _, user_id in closed], [guild_id for guild_id, _ in closed])
+        except BaseException:
+            self._closed |= closed
+            raise
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        afk = sum(1 for session in self.sessions.values() if session.afk)
+        return {"sessions": len(self.sessions), "afk": afk, "last_tick_ms": round(self.last_tick_ms, 2)}
+
+voice_tracker = VoiceTracker(VOICE_TICK_SECONDS)
+
 @bot.event
+@timed_event
 async def on_voice_state_update(member, before, after):
-    if member.bot:
+    if member.bot or before.channel == after.channel:
         return
     
-    if before.channel is None and after.channel is not None:
-        voice_tracking[member.id] = (after.channel.id, datetime.now())
-    
-    elif before.channel is not None and after.channel is None:
-        if member.id in voice_tracking:
-            join_time = voice_tracking[member.id][1]
-            minutes_spent = int((datetime.now() - join_time).total_seconds() / 60)
-            
-            if minutes_spent > 0:
-                pool = await wait_for_db()
-                async with pool.acquire() as conn:
-                    await conn.execute('''
-                        INSERT INTO coins (user_id, guild_id, balance) VALUES ($1, $2, $3) 
-                        ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = coins.balance + $3
-                    ''', member.id, member.guild.id, minutes_spent)
-                    
-                    await add_xp(member.id, member.guild.id, minutes_spent * 5, conn)
-                    
-                    await conn.execute('''
-                        INSERT INTO voice_time (user_id, guild_id, total_minutes) VALUES ($1, $2, $3) 
-                        ON CONFLICT (user_id, guild_id) DO UPDATE SET total_minutes = voice_time.total_minutes + $3
-                    ''', member.id, member.guild.id, minutes_spent)
-                    
-                    await check_coin_milestone(member.id, conn)
-            
-            del voice_tracking[member.id]
+    now = datetime.now()
+    if before.channel is None:
+        voice_tracker.join(member.guild.id, member.id, after.channel, now)
+    elif after.channel is None:
+        voice_tracker.leave(member.guild.id, member.id, now)
+    else:
+        voice_tracker.move(member.guild.id, member.id, after.channel, now)
+
+# ================== ИНДЕКС РОЛЕЙ ==================
+class RoleIndex:
+    """Роль -> участники с ней; поддерживается событиями шлюза вместо обхода guild.members"""
+
+    def __init__(self):
+        self._holders = {}  # guild_id -> {role_id: set(member_id)}
+        self._rendered = {}  # (guild_id, role_ids) -> готовый текст списка
+        self.builds = 0
+        self.renders = 0
+
+    def _guild(self, guild):
+        """Индекс сервера; строится одним проходом по участникам при первом обращении"""
+        holders = self._holders.get(guild.id)
+        if holders is None:
+            holders = {}
+            for member in guild.members:
+                for role in member.roles:
+                    if role.id != guild.id:
+                        holders.setdefault(role.id, set()).add(member.id)
+            self._holders[guild.id] = holders
+            self.builds += 1
+        return holders
+
+    def invalidate(self, guild_id, role_ids=None):
+        stale = [key for key in self._rendered if key[0] == guild_id and (role_ids is None or not role_ids.isdisjoint(key[1]))]
+        for key in stale:
+            del self._rendered[key]
+
+    def holder_ids(self, guild, *role_ids):
+        holders = self._guild(guild)
+        result = set()
+        for role_id in role_ids:
+            result |= holders.get(role_id, set())
+        return result
+
+    def members(self, guild, *role_ids):
+        return [member for member in map(guild.get_member, self.holder_ids(guild, *role_ids)) if member is not None]
+
+    def render(self, guild, *role_ids):
+        """Список «• участник — высшая роль» для владельцев ролей, кэшируется до изменения"""
+        key = (guild.id, role_ids)
+        text = self._rendered.get(key)
+        if text is None:
+            members = sorted(self.members(guild, *role_ids), key=lambda m: (-m.top_role.position, m.id))
+            text = "\n".join(f"• {m.mention} — {m.top_role.name}" for m in members)
+            self._rendered[key] = text
+            self.renders += 1
+        return text
+
+    def update_member(self, guild, member_id, before_ids, after_ids):
+        holders = self._holders.get(guild.id)
+        if holders is None:
+            return  # индекс ещё не строился — соберётся сразу актуальным
+        for role_id in before_ids - after_ids:
+            members = holders.get(role_id)
+            if members is not None:
+                members.discard(member_id)
+                if not members:
+                    del holders[role_id]
+        for role_id in after_ids - before_ids:
+            holders.setdefault(role_id, set()).add(member_id)
+        self.invalidate(guild.id, before_ids | after_ids)
+
+    def drop_role(self, guild, role_id):
+        holders = self._holders.get(guild.id)
+        if holders is not None:
+            holders.pop(role_id, None)
+        self.invalidate(guild.id)
+
+    def drop_guild(self, guild_id):
+        self._holders.pop(guild_id, None)
+        self.invalidate(guild_id)
+
+    def stats(self):
+        entries = sum(len(members) for holders in self._holders.values() for members in holders.values())
+        return {"guilds": len(self._holders), "entries": entries, "rendered": len(self._rendered),
+                "builds": self.builds, "renders": self.renders}
+
+role_index = RoleIndex()
+
+def member_role_ids(member):
+    return {role.id for role in member.roles if role.id != member.guild.id}
+
+@bot.event
+async def on_member_join(member):
+    role_index.update_member(member.guild, member.id, set(), member_role_ids(member))
+
+@bot.event
+async def on_member_remove(member):
+    role_index.update_member(member.guild, member.id, member_role_ids(member), set())
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        role_index.update_member(after.guild, after.id, member_role_ids(before), member_role_ids(after))
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name or before.position != after.position:
+        role_index.invalidate(after.guild.id)  # у участников сменились подписи высшей роли
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_index.drop_role(role.guild, role.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    role_index.drop_guild(guild.id)
 
 # ================== СООБЩЕНИЯ ==================
 @bot.event
+@timed_event
 async def on_message(message):
     if message.author.bot or not message.guild:
         return
     
-    pool = await wait_for_db()
-    async with pool.acquire() as conn:
-        word_count = len(message.content.split())
-        if word_count >= 5:
-            coins_earned = 0.05
-            await conn.execute('''
-                INSERT INTO coins (user_id, guild_id, balance) VALUES ($1, $2, $3) 
-                ON CONFLICT (user_id, guild_id) DO UPDATE SET balance = coins.balance + $3
-            ''', message.author.id, message.guild.id, coins_earned)
-            await check_coin_milestone(message.author.id, conn)
-        
-        await add_xp(message.author.id, message.guild.id, 1, conn)
-        
-        await conn.execute('''
-            INSERT INTO messages (user_id, guild_id, count) VALUES ($1, $2, 1) 
-            ON CONFLICT (user_id, guild_id) DO UPDATE SET count = messages.count + 1
-        ''', message.author.id, message.guild.id)
-    
+    word_count = len(message.content.split())
+    coins_earned = 0.05 if word_count >= 5 else 0.0
+    activity_buffer.add(message.author.id, message.guild.id, messages=1, coins=coins_earned, xp=1)
+
     await bot.process_commands(message)
 
 # ================== КОМАНДЫ ==================
@@ -286,7 +2893,7 @@ async def help_command(interaction: discord.Interaction):
     embed = discord.Embed(title="📚 Команды", color=discord.Color.blue())
     embed.add_field(name="🤖 Нейросеть", value="`/ai` — поговори с искусственным интеллектом", inline=False)
     embed.add_field(name="👤 Обычные", value="`/ping` `/admins` `/stat` `/top` `/marry`", inline=False)
-    embed.add_field(name="🛡️ Модерация", value="`/clear` `/warn` `/infoplayer`", inline=False)
+    embed.add_field(name="🛡️ Модерация", value="`/clear` `/purge` `/warn` `/infoplayer`", inline=False)
     embed.add_field(name="🔨 Админ", value="`/ban` `/kick` `/ticket`", inline=False)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -294,11 +2901,114 @@ async def help_command(interaction: discord.Interaction):
 async def ping_command(interaction: discord.Interaction):
     await interaction.response.send_message(f"🏓 Понг! Задержка: {round(bot.latency * 1000)} мс", ephemeral=True)
 
+@bot.tree.command(name="botstats", description="Внутренние метрики бота (админ)")
+@app_commands.checks.has_any_role(ROLES["admin"])
+async def botstats_command(interaction: discord.Interaction):
+    embed = discord.Embed(title="📊 Метрики бота", color=discord.Color.dark_teal())
+    stats = await db_health()
+    embed.add_field(
+        name="🗄️ SQLite" if is_sqlite(bot.db_pool) else "🗄️ PostgreSQL",
+        value=(f"{'🟢' if stats['ok'] else '🔴'} Соединений: {stats['size'] - stats['idle']}/{stats['max']} заняты "
+               f"({stats['saturation']:.0%}) • Получение: {stats['acquire_ms']} мс • SELECT 1: {stats['ping_ms']} мс")
+              if stats['ready'] else "⏳ Не подключена",
+        inline=False
+    )
+    prepared = await prepared_statements() if stats['ready'] else None
+    if prepared is not None:
+        embed.add_field(
+            name="🧾 Именованные запросы",
+            value=f"Подготовлено на соединении: {len(prepared)}/{len(STATEMENTS)} • Кэш планов: {DB_STATEMENT_CACHE_SIZE}",
+            inline=False
+        )
+    stats = activity_buffer.stats()
+    embed.add_field(
+        name="🧺 Буфер активности",
+        value=f"В очереди: {stats['pending_events']} событий / {stats['pending_users']} игроков\n"
+              f"Сбросов: {stats['flushes']} (ошибок: {stats['failed_flushes']})\n"
+              f"Сброс: посл. {stats['last_flush_ms']} мс • ср. {stats['avg_flush_ms']} мс • макс. {stats['max_flush_ms']} мс",
+        inline=False
+    )
+    stats = activity_rollups.stats()
+    embed.add_field(
+        name="🗓️ История активности",
+        value=f"Свёртка: {'🟢' if stats['enabled'] else '⚪ не в этом процессе'} • Свёрток: {stats['compactions']} "
+              f"(посл. {stats['last_compact_ms']} мс) • Топов в кэше: {stats['cached_tops']}",
+        inline=False
+    )
+    stats = rank_service.stats()
+    embed.add_field(
+        name="🏆 Рейтинг",
+        value=f"Режим: {stats['mode']} • Серверов в памяти: {stats['guilds']} • Записей: {stats['entries']}",
+        inline=False
+    )
+    stats = voice_tracker.stats()
+    embed.add_field(
+        name="🎤 Голос",
+        value=f"Сессий: {stats['sessions']} (AFK: {stats['afk']}) • Тик: {stats['last_tick_ms']} мс",
+        inline=False
+    )
+    stats = role_index.stats()
+    embed.add_field(
+        name="🎭 Индекс ролей",
+        value=f"Серверов: {stats['guilds']} • Записей: {stats['entries']} • Готовых списков: {stats['rendered']} "
+              f"• Сборок: {stats['builds']} • Отрисовок: {stats['renders']}",
+        inline=False
+    )
+    stats = ai_scheduler.stats()
+    embed.add_field(
+        name="🚦 Запросы к нейросети",
+        value=f"Выполняется: {stats['active']} • В очереди: {stats['queued']} • Отклонено: {stats['rejected']} "
+              f"• Размыкатель: {stats['breaker']}",
+        inline=False
+    )
+    stats = ai_cache.stats()
+    embed.add_field(
+        name="🗂️ Кэш ответов нейросети",
+        value=f"Записей: {stats['entries']} • Попаданий: {stats['hits']} • Промахов: {stats['misses']} "
+              f"({stats['hit_ratio']:.0%}) • Сэкономлено: {stats['saved_seconds']} с",
+        inline=False
+    )
+    stats = conversations.stats()
+    embed.add_field(
+        name="🤖 Диалоги нейросети",
+        value=f"В памяти: {stats['users']} • Токенов: ~{stats['tokens']}/{stats['budget']}\n"
+              f"Выгружено: {stats['evictions']} • Загружено из БД: {stats['loads']}",
+        inline=False
+    )
+    if cluster is not None and cluster.snapshot:
+        stats = cluster.snapshot
+        shards = " • ".join(f"#{shard_id}: {ms} мс" for shard_id, ms in sorted(stats['shards'].items(), key=lambda item: int(item[0])))
+        embed.add_field(
+            name="🧩 Кластер",
+            value=f"Процессов: {stats['workers']} • Шардов: {stats['shard_count']} • Серверов: {stats['guilds']}\n"
+                  f"Этот процесс: #{CLUSTER_ID}, шарды {', '.join(map(str, SHARD_IDS))}\n{shards[:900]}",
+            inline=False
+        )
+    stats = warn_expiry.stats()
+    if stats['enabled']:
+        embed.add_field(
+            name="⏳ Истечение варнов",
+            value=f"В очереди: {stats['scheduled']} • Истекло: {stats['expired']}",
+            inline=False
+        )
+    stats = profiles.stats()
+    embed.add_field(
+        name="👤 Кэш профилей",
+        value=f"Записей: {stats['entries']} • Попаданий: {stats['hits']} • Промахов: {stats['misses']}",
+        inline=False
+    )
+    stats = leaderboard.stats()
+    embed.add_field(
+        name="🥇 Кэш топа",
+        value=f"Серверов: {stats['guilds']} • Попаданий: {stats['hits']} • Промахов: {stats['misses']} ({stats['hit_ratio']:.0%})",
+        inline=False
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="admins", description="Список администрации")
 async def admins_command(interaction: discord.Interaction):
-    admin_ids = [ROLES["admin"], ROLES["mod"]]
-    admins = [f"• {m.mention} — {m.top_role.name}" for m in interaction.guild.members if any(r.id in admin_ids for r in m.roles)]
-    await interaction.response.send_message(embed=discord.Embed(title="👮 Администрация", description="\n".join(admins) or "Нет", color=discord.Color.gold()), ephemeral=True)
+    admins = role_index.render(interaction.guild, ROLES["admin"], ROLES["mod"])
+    await interaction.response.send_message(embed=discord.Embed(title="👮 Администрация", description=admins or "Нет", color=discord.Color.gold()), ephemeral=True)
 
 @bot.tree.command(name="clear", description="Очистить сообщения")
 @app_commands.describe(amount="Количество (1-100)")
@@ -337,13 +3047,13 @@ async def warn_command(interaction: discord.Interaction, member: discord.Member,
     
     pool = await wait_for_db()
     async with pool.acquire() as conn:
-        await conn.execute('INSERT INTO warns (user_id, guild_id, moderator_id, reason, date) VALUES ($1, $2, $3, $4, $5)',
-                          member.id, interaction.guild_id, interaction.user.id, reason, datetime.now())
+        now = datetime.now()
+        warn_id = await WARN_INSERT(conn, member.id, interaction.guild_id, interaction.user.id, reason, now)
+        warn_expiry.schedule(warn_id, now)
+        profiles.invalidate(interaction.guild_id, member.id)
         
         seven_days_ago = datetime.now() - timedelta(days=7)
-        row = await conn.fetchrow('SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2 AND date > $3 AND expired = FALSE',
-                                 member.id, interaction.guild_id, seven_days_ago)
-        warn_count = row['count']
+        warn_count = await WARN_COUNT(conn, member.id, interaction.guild_id, seven_days_ago)
     
     embed = discord.Embed(title="⚠️ Предупреждение", color=discord.Color.orange())
     embed.add_field(name="Пользователь", value=member.mention)
@@ -356,6 +3066,206 @@ async def warn_command(interaction: discord.Interaction, member: discord.Member,
         await member.ban(reason="Автобан: 5 предупреждений")
         await interaction.followup.send(embed=discord.Embed(title="🔨 Автобан", description=f"{member.mention} забанен за 5 варнов", color=discord.Color.red()), ephemeral=True)
 
+# ================== МАССОВАЯ ЧИСТКА ==================
+# /purge удаляет тысячи сообщений: младше 14 дней — пачками по 100 через bulk delete,
+# старше — по одному с паузой (у такого удаления свой, очень тесный лимит). Лимиты по бакетам
+# дополнительно соблюдает HTTP-клиент discord.py. Закреплённые сообщения не трогаются.
+PURGE_MAX = int(os.getenv('PURGE_MAX', '10000'))  # сообщений за одну чистку
+PURGE_SINGLE_DELETE_DELAY = float(os.getenv('PURGE_SINGLE_DELETE_DELAY', '1.0'))  # секунды между одиночными удалениями
+PURGE_PROGRESS_INTERVAL = float(os.getenv('PURGE_PROGRESS_INTERVAL', '3'))  # секунды между обновлениями прогресса
+PURGE_MAX_SCAN = int(os.getenv('PURGE_MAX_SCAN', '50000'))  # просмотренных сообщений за одну чистку
+PURGE_BULK_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)  # запас до границы bulk delete
+
+class PurgeJob:
+    """Одна чистка по нескольким каналам; держит в памяти не больше одной пачки"""
+
+    def __init__(self, channels, limit, check, after=None, max_scan=PURGE_MAX_SCAN):
+        self.channels = channels
+        self.limit = limit
+        self.check = check
+        self.after = after
+        self.max_scan = max_scan
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        self.current = None
+        self.cancelled = False
+        self.done = False
+        self.started = time.monotonic()
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def scan_exhausted(self):
+        # Фильтр по автору или тексту может почти ничего не находить — без предела обход шёл бы по всей истории
+        return self.scanned >= self.max_scan
+
+    async def run(self):
+        try:
+            for channel in self.channels:
+                if self.cancelled or self.matched >= self.limit or self.scan_exhausted:
+                    break
+                self.current = channel
+                await self._purge_channel(channel)
+        finally:
+            self.done = True
+
+    async def _purge_channel(self, channel):
+        batch = []
+        async for message in channel.history(limit=None, after=self.after, oldest_first=False):
+            if self.cancelled:
+                return
+            if self.scan_exhausted:
+                break
+            self.scanned += 1
+            if message.pinned or not self.check(message):
+                continue
+            self.matched += 1
+            if not batch:
+                # Граница bulk delete — на каждую пачку: обход большого канала идёт дольше запаса в 5 минут
+                cutoff = discord.utils.utcnow() - PURGE_BULK_MAX_AGE
+            if message.created_at > cutoff:
+                batch.append(message)
+                if len(batch) == 100:
+                    await self._bulk(channel, batch)
+                    batch = []
+            else:
+                # История идёт от новых к старым: дальше только старые, дочищаем пачку и идём по одному
+                if batch:
+                    await self._bulk(channel, batch)
+                    batch = []
+                await self._single(message)
+            if self.matched >= self.limit:
+                break
+        if batch and not self.cancelled:
+            await self._bulk(channel, batch)
+
+    async def _bulk(self, channel, batch):
+        # Пока пачка набиралась, её старые сообщения могли перешагнуть границу в 14 дней
+        cutoff = discord.utils.utcnow() - PURGE_BULK_MAX_AGE
+        for message in [message for message in batch if message.created_at <= cutoff]:
+            await self._single(message)
+        batch = [message for message in batch if message.created_at > cutoff]
+        if not batch:
+            return
+        try:
+            if len(batch) == 1:
+                await batch[0].delete()
+            else:
+                await channel.delete_messages(batch, reason="Массовая чистка /purge")
+            self.deleted += len(batch)
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            self.failed += len(batch)
+            print(f"❌ Ошибка bulk delete в #{channel.name}: {e}")
+
+    async def _single(self, message):
+        try:
+            await message.delete()
+            self.deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            self.failed += 1
+            print(f"❌ Ошибка удаления сообщения {message.id}: {e}")
+        await asyncio.sleep(PURGE_SINGLE_DELETE_DELAY)
+
+    def progress(self):
+        elapsed = int(time.monotonic() - self.started)
+        if self.done:
+            if self.cancelled:
+                state = "⏹️ Остановлено"
+            elif self.scan_exhausted:
+                state = f"⚠️ Просмотрен предел в {self.max_scan} сообщений, более старые не тронуты"
+            else:
+                state = "✅ Готово"
+        else:
+            state = f"🧹 Чищу #{self.current.name}" if self.current else "🧹 Начинаю"
+        return (f"{state}\nУдалено: **{self.deleted}** из {self.limit} • Просмотрено: {self.scanned} из {self.max_scan} "
+                f"• Ошибок: {self.failed} • {elapsed} с")
+
+purge_jobs = {}  # guild_id -> идущая чистка, одна на сервер
+
+class PurgeCancelView(discord.ui.View):
+    def __init__(self, job, owner_id):
+        super().__init__(timeout=None)
+        self.job = job
+        self.owner_id = owner_id
+
+    @discord.ui.button(label="⏹️ Остановить", style=discord.ButtonStyle.red)
+    async def stop_purge(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.owner_id:
+            return await interaction.response.send_message("❌ Остановить может только запустивший", ephemeral=True)
+        self.job.cancel()
+        await interaction.response.send_message("⏹️ Останавливаю чистку...", ephemeral=True)
+
+async def report_purge(interaction, job, view):
+    """Обновляет отложенный ответ, пока идёт чистка; токен взаимодействия живёт 15 минут"""
+    while not job.done:
+        await asyncio.sleep(PURGE_PROGRESS_INTERVAL)
+        try:
+            await interaction.edit_original_response(content=job.progress(), view=None if job.done else view)
+        except discord.HTTPException:
+            return False
+    return True
+
+@bot.tree.command(name="purge", description="Массовая очистка сообщений")
+@app_commands.describe(
+    amount=f"Сколько удалить (1-{PURGE_MAX})",
+    member="Только сообщения этого пользователя",
+    contains="Только сообщения с этим текстом",
+    minutes="Только за последние N минут",
+    everywhere="Во всех текстовых каналах сервера",
+)
+@app_commands.checks.has_any_role(ROLES["admin"], ROLES["mod"])
+async def purge_command(interaction: discord.Interaction, amount: int, member: discord.Member = None,
+                        contains: str = None, minutes: int = None, everywhere: bool = False):
+    if amount < 1 or amount > PURGE_MAX:
+        return await interaction.response.send_message(f"❌ От 1 до {PURGE_MAX}", ephemeral=True)
+    if minutes is not None and minutes < 1:
+        return await interaction.response.send_message("❌ Минут должно быть не меньше 1", ephemeral=True)
+    if interaction.guild_id in purge_jobs:
+        return await interaction.response.send_message("❌ На сервере уже идёт чистка", ephemeral=True)
+
+    if everywhere:
+        me = interaction.guild.me
+        channels = [channel for channel in interaction.guild.text_channels
+                    if channel.permissions_for(me).manage_messages and channel.permissions_for(me).read_message_history]
+    else:
+        channels = [interaction.channel]
+    needle = contains.lower() if contains else None
+
+    def check(message):
+        if member is not None and message.author.id != member.id:
+            return False
+        return needle is None or needle in message.content.lower()
+
+    after = discord.utils.utcnow() - timedelta(minutes=minutes) if minutes is not None else None
+    job = PurgeJob(channels, amount, check, after)
+    view = PurgeCancelView(job, interaction.user.id)
+    purge_jobs[interaction.guild_id] = job
+    await interaction.response.send_message(job.progress(), view=view, ephemeral=True)
+    reporter = asyncio.create_task(report_purge(interaction, job, view))
+    try:
+        await job.run()
+    finally:
+        purge_jobs.pop(interaction.guild_id, None)
+        view.stop()
+    if await reporter:
+        try:
+            await interaction.edit_original_response(content=job.progress(), view=None)
+            return
+        except discord.HTTPException:
+            pass
+    # Чистка пережила токен взаимодействия — итог в личку
+    try:
+        await interaction.user.send(f"🧹 Чистка на **{interaction.guild.name}** завершена\n{job.progress()}")
+    except discord.HTTPException:
+        pass
+
 # ================== /infoplayer С КНОПКАМИ ==================
 class InfoplayerView(discord.ui.View):
     def __init__(self, member):
@@ -393,29 +3303,18 @@ class InfoplayerView(discord.ui.View):
         
         pool = await wait_for_db()
         async with pool.acquire() as conn:
-            await conn.execute('INSERT INTO warns (user_id, guild_id, moderator_id, reason, date) VALUES ($1, $2, $3, $4, $5)',
-                              self.member.id, interaction.guild_id, interaction.user.id, "Варн через инфоплейер", datetime.now())
+            now = datetime.now()
+            warn_id = await WARN_INSERT(conn, self.member.id, interaction.guild_id, interaction.user.id, "Варн через инфоплейер", now)
+        warn_expiry.schedule(warn_id, now)
+        profiles.invalidate(interaction.guild_id, self.member.id)
         
         await interaction.response.send_message(f"✅ {self.member.mention} получил варн", ephemeral=True)
     
     @discord.ui.button(label="📩 Тикет", style=discord.ButtonStyle.success)
     async def ticket_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        category = discord.utils.get(interaction.guild.categories, name="ТИКЕТЫ")
-        if not category:
-            category = await interaction.guild.create_category("ТИКЕТЫ")
-        
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            self.member: discord.PermissionOverwrite(read_messages=True, send_messages=True),
-            interaction.guild.get_role(ROLES["support"]): discord.PermissionOverwrite(read_messages=True, send_messages=True),
-            interaction.guild.get_role(ROLES["admin"]): discord.PermissionOverwrite(read_messages=True, send_messages=True)
-        }
-        
-        channel = await interaction.guild.create_text_channel(
-            name=f"ticket-{self.member.name}",
-            category=category,
-            overwrites=overwrites
-        )
+        channel = await open_ticket(interaction, self.member)
+        if channel is None:
+            return
         
         await interaction.response.send_message(f"✅ Тикет создан: {channel.mention}", ephemeral=True)
         await channel.send(embed=discord.Embed(title="📩 Тикет", description=f"Тикет открыт для {self.member.mention}", color=discord.Color.green()), view=TicketCloseView())
@@ -424,34 +3323,19 @@ class InfoplayerView(discord.ui.View):
 @app_commands.describe(member="Пользователь")
 @app_commands.checks.has_any_role(ROLES["admin"])
 async def infoplayer_command(interaction: discord.Interaction, member: discord.Member):
-    pool = await wait_for_db()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow('SELECT count FROM messages WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        msg_count = row['count'] if row else 0
-        
-        seven = datetime.now() - timedelta(days=7)
-        row = await conn.fetchrow('SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2 AND date > $3 AND expired = FALSE',
-                                 member.id, interaction.guild_id, seven)
-        active_warns = row['count']
-        
-        row = await conn.fetchrow('SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        total_warns = row['count']
-        
-        row = await conn.fetchrow('SELECT balance FROM coins WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        coins = row['balance'] if row else 0
-        
-        row = await conn.fetchrow('SELECT xp, level FROM xp WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        xp, level = (row['xp'], row['level']) if row else (0, 1)
-        
-        row = await conn.fetchrow('SELECT total_minutes FROM voice_time WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        voice_minutes = row['total_minutes'] if row else 0
-        
-        row = await conn.fetchrow('SELECT partner_id FROM marriages WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        partner_name = "Нет"
-        if row and row['partner_id']:
-            partner = interaction.guild.get_member(row['partner_id'])
-            if partner:
-                partner_name = partner.mention
+    profile = await profiles.get(interaction.guild_id, member.id)
+    msg_count = profile['messages']
+    active_warns = profile['active_warns']
+    total_warns = profile['total_warns']
+    coins = profile['coins']
+    xp, level = profile['xp'], profile['level']
+    voice_minutes = profile['voice_minutes']
+    
+    partner_name = "Нет"
+    if profile['partner_id']:
+        partner = interaction.guild.get_member(profile['partner_id'])
+        if partner:
+            partner_name = partner.mention
     
     roles = [r.mention for r in member.roles if r.name != "@everyone"]
     
@@ -478,55 +3362,39 @@ async def infoplayer_command(interaction: discord.Interaction, member: discord.M
     await interaction.response.send_message(embed=embed, view=InfoplayerView(member), ephemeral=True)
 
 # ================== /stat ==================
+PERIOD_CHOICES = [
+    app_commands.Choice(name="За сутки", value="day"),
+    app_commands.Choice(name="За неделю", value="week"),
+    app_commands.Choice(name="За месяц", value="month"),
+]
+
 @bot.tree.command(name="stat", description="Показать статистику игрока")
-@app_commands.describe(member="Пользователь (оставь пустым для себя)")
-async def stat_command(interaction: discord.Interaction, member: discord.Member = None):
+@app_commands.describe(member="Пользователь (оставь пустым для себя)", period="Добавить активность за период")
+@app_commands.choices(period=PERIOD_CHOICES)
+async def stat_command(interaction: discord.Interaction, member: discord.Member = None,
+                       period: app_commands.Choice[str] = None):
     if member is None:
         member = interaction.user
     
-    pool = await wait_for_db()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow('SELECT count FROM messages WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        msg_count = row['count'] if row else 0
-        
-        row = await conn.fetchrow('SELECT balance FROM coins WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        coins = row['balance'] if row else 0
-        
-        row = await conn.fetchrow('SELECT xp, level FROM xp WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        if row:
-            xp, level = row['xp'], row['level']
-            next_level_xp = level * 100
-        else:
-            xp, level = 0, 1
-            next_level_xp = 100
-        
-        seven_days_ago = datetime.now() - timedelta(days=7)
-        row = await conn.fetchrow('SELECT COUNT(*) FROM warns WHERE user_id = $1 AND guild_id = $2 AND date > $3 AND expired = FALSE',
-                                 member.id, interaction.guild_id, seven_days_ago)
-        warns = row['count']
-        
-        rows = await conn.fetch('SELECT user_id FROM coins WHERE guild_id = $1 ORDER BY balance DESC', interaction.guild_id)
-        position = 1
-        found = False
-        for i, row in enumerate(rows, 1):
-            if row['user_id'] == member.id:
-                position = i
-                found = True
-                break
-        
-        if not found:
-            total = await conn.fetchval('SELECT COUNT(*) FROM coins WHERE guild_id = $1', interaction.guild_id)
-            position = total + 1 if total else 1
-        
-        row = await conn.fetchrow('SELECT total_minutes FROM voice_time WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        voice_minutes = row['total_minutes'] if row else 0
-        
-        row = await conn.fetchrow('SELECT partner_id FROM marriages WHERE user_id = $1 AND guild_id = $2', member.id, interaction.guild_id)
-        partner_name = "Нет"
-        if row and row['partner_id']:
-            partner = interaction.guild.get_member(row['partner_id'])
-            if partner:
-                partner_name = partner.mention
+    profile = await profiles.get(interaction.guild_id, member.id)
+    msg_count = profile['messages']
+    coins = profile['coins']
+    xp, level = profile['xp'], profile['level']
+    next_level_xp = level * 100
+    warns = profile['active_warns']
+    voice_minutes = profile['voice_minutes']
+    
+    position = profile['position']
+    if rank_service.in_memory:
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            position = await rank_service.position(interaction.guild_id, member.id, conn)
+    
+    partner_name = "Нет"
+    if profile['partner_id']:
+        partner = interaction.guild.get_member(profile['partner_id'])
+        if partner:
+            partner_name = partner.mention
     
     progress = int((xp / next_level_xp) * 10)
     progress_bar = "🟩" * progress + "⬜" * (10 - progress)
@@ -566,23 +3434,27 @@ async def stat_command(interaction: discord.Interaction, member: discord.Member
     embed.add_field(name="💬 Сообщения", value=f"**{msg_count}**", inline=True)
     embed.add_field(name="🎤 В голосе", value=f"**{voice_minutes}** мин", inline=True)
     
+    if period is not None:
+        recent = await activity_rollups.user(interaction.guild_id, member.id, period.value)
+        embed.add_field(
+            name=f"📅 {ROLLUP_PERIODS[period.value][1].capitalize()}",
+            value=f"💬 {recent['messages']} • 🎤 {recent['voice_minutes']} мин • "
+                  f"🪙 +{int(recent['coins'])} • ✨ +{recent['xp']} XP",
+            inline=False
+        )
+    
     embed.set_footer(text=f"Запросил: {interaction.user.display_name}")
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 # ================== /top ==================
 @bot.tree.command(name="top", description="Топ игроков по монетам")
-async def top_command(interaction: discord.Interaction):
-    pool = await wait_for_db()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT coins.user_id, coins.balance, xp.level 
-            FROM coins 
-            LEFT JOIN xp ON coins.user_id = xp.user_id AND coins.guild_id = xp.guild_id
-            WHERE coins.guild_id = $1
-            ORDER BY coins.balance DESC 
-            LIMIT 10
-        ''', interaction.guild_id)
+@app_commands.describe(period="Топ по заработанному за период вместо общего баланса")
+@app_commands.choices(period=PERIOD_CHOICES)
+async def top_command(interaction: discord.Interaction, period: app_commands.Choice[str] = None):
+    if period is not None:
+        return await top_period(interaction, period.value)
+    rows = (await leaderboard.get(interaction.guild_id))[:10]
     
     if not rows:
         await interaction.response.send_message("❌ Нет данных", ephemeral=True)
@@ -604,6 +3476,26 @@ async def top_command(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+async def top_period(interaction, period):
+    """Топ по монетам, заработанным за период, из корзин истории активности"""
+    rows = await activity_rollups.top(interaction.guild_id, period)
+    if not rows:
+        await interaction.response.send_message("❌ Нет данных за этот период", ephemeral=True)
+        return
+    
+    embed = discord.Embed(title=f"🏆 Топ по монетам {ROLLUP_PERIODS[period][1]}", color=discord.Color.gold())
+    medals = ["🥇", "🥈", "🥉"] + ["🔹"] * 7
+    for i, row in enumerate(rows, 1):
+        user = interaction.guild.get_member(row['user_id'])
+        name = user.display_name if user else "Неизвестный"
+        embed.add_field(
+            name=f"{medals[i-1]} {i}. {name}",
+            value=f"🪙 +{int(row['coins'])} монет • 💬 {row['messages']} сообщений • 🎤 {row['voice_minutes']} мин",
+            inline=False
+        )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # ================== /marry ==================
 @bot.tree.command(name="marry", description="Предложить пожениться")
 @app_commands.describe(partner="Пользователь, которому предлагаешь")
@@ -617,8 +3509,7 @@ async def marry_command(interaction: discord.Interaction, partner: discord.Membe
     pool = await wait_for_db()
     async with pool.acquire() as conn:
         for uid in [interaction.user.id, partner.id]:
-            row = await conn.fetchrow('SELECT partner_id FROM marriages WHERE user_id = $1 AND guild_id = $2', uid, interaction.guild_id)
-            if row:
+            if await PARTNER(conn, uid, interaction.guild_id):
                 return await interaction.response.send_message(f"❌ {interaction.user.mention if uid == interaction.user.id else partner.mention} уже в браке", ephemeral=True)
     
     class MarryView(discord.ui.View):
@@ -630,13 +3521,16 @@ async def marry_command(interaction: discord.Interaction, partner: discord.Membe
             if interaction2.user.id != partner.id:
                 return await interaction2.response.send_message("❌ Только партнёр может согласиться", ephemeral=True)
             
-            pool = await wait_for_db()
-            async with pool.acquire() as conn:
-                now = datetime.now()
-                await conn.execute('INSERT INTO marriages (user_id, guild_id, partner_id, married_since) VALUES ($1, $2, $3, $4)',
-                                  interaction.user.id, interaction.guild_id, partner.id, now)
-                await conn.execute('INSERT INTO marriages (user_id, guild_id, partner_id, married_since) VALUES ($1, $2, $3, $4)',
-                                  partner.id, interaction.guild_id, interaction.user.id, now)
+            # Обе записи или ни одной: если кто-то успел вступить в брак, пока висело предложение, всё откатится
+            try:
+                async with transaction() as conn:
+                    now = datetime.now()
+                    await MARRIAGE_INSERT(conn, interaction.user.id, interaction.guild_id, partner.id, now)
+                    await MARRIAGE_INSERT(conn, partner.id, interaction.guild_id, interaction.user.id, now)
+            except (asyncpg.UniqueViolationError, sqlite3.IntegrityError):
+                return await interaction2.response.send_message("❌ Кто-то из вас уже в браке", ephemeral=True)
+            profiles.invalidate(interaction.guild_id, interaction.user.id)
+            profiles.invalidate(interaction.guild_id, partner.id)
             
             embed = discord.Embed(
                 title="💍 Поздравляем!",
@@ -673,88 +3567,332 @@ async def ai_command(interaction: discord.Interaction, prompt: str, reset: str =
     
     await interaction.response.defer()
     
-    user_id = str(interaction.user.id)
+    user_id = interaction.user.id
     
     if reset.lower() == "да":
-        user_conversations[user_id] = []
+        await conversations.reset(user_id)
         await interaction.followup.send("🧹 История диалога очищена!")
         return
     
-    if user_id not in user_conversations:
-        user_conversations[user_id] = [
-            {"role": "system", "content": "Ты полезный ассистент. Отвечай на русском языке кратко и по делу."}
-        ]
-    
-    user_conversations[user_id].append({"role": "user", "content": prompt})
-    
-    if len(user_conversations[user_id]) > 11:
-        user_conversations[user_id] = [user_conversations[user_id][0]] + user_conversations[user_id][-10:]
-    
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {AI_TOKEN}",
-                    "Content-Type": "application/json",
-                    "HTTP-Referer": "https://discord.com",
-                    "X-Title": "Discord Bot"
-                },
-                json={
-                    "model": "openrouter/free",
-                    "messages": user_conversations[user_id],
-                    "max_tokens": 500
-                }
-            ) as resp:
-                data = await resp.json()
-                
-                if resp.status == 200:
-                    answer = data['choices'][0]['message']['content']
-                else:
-                    await interaction.followup.send(f"❌ Ошибка API: {data}")
-                    return
+        # Кэш только для первого вопроса: с историей ответ зависит от контекста
+        cache_key = None
+        if not await conversations.has_history(user_id):
+            cache_key = AIResponseCache.key(bot.ai.model, AI_SYSTEM_PROMPT, prompt)
         
-        user_conversations[user_id].append({"role": "assistant", "content": answer})
+        cached = ai_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            await conversations.add(user_id, "user", prompt)
+            for chunk in split_message(cached):
+                await interaction.followup.send(chunk)
+            await conversations.add(user_id, "assistant", cached)
+            return
         
-        if len(answer) > 1900:
-            await interaction.followup.send(answer[:1900] + "...")
-        else:
-            await interaction.followup.send(answer)
-            
+        queued = False
+        
+        async def on_queued(position):
+            nonlocal queued
+            queued = True
+            await interaction.edit_original_response(content=f"⏳ Много запросов, ты {position}-й в очереди…")
+        
+        async with ai_scheduler.slot(user_id, on_queued) as api:
+            if queued:
+                # Очередь подошла: уведомление больше не нужно, ответ придёт следующими сообщениями
+                try:
+                    await interaction.delete_original_response()
+                except discord.HTTPException:
+                    pass
+            messages = await conversations.add(user_id, "user", prompt)
+            started = time.monotonic()
+            if AI_STREAM:
+                reply = StreamingReply(interaction)
+                async for delta in api.stream(bot.ai.stream_chat(messages)):
+                    await reply.feed(delta)
+                answer = await reply.finish()
+            else:
+                answer = await api.call(bot.ai.chat(messages))
+                for chunk in split_message(answer):
+                    await interaction.followup.send(chunk)
+        
+        if cache_key:
+            ai_cache.put(cache_key, answer, time.monotonic() - started)
+        await conversations.add(user_id, "assistant", answer)
+    
+    except AIRejected as e:
+        await interaction.followup.send(e.message)
+    except AIError as e:
+        # Сырой ответ API — только в консоль, в канал он не нужен
+        print(f"❌ Ошибка API нейросети: {e}")
+        await interaction.followup.send(f"❌ Нейросеть ответила ошибкой ({e.status}), попробуй позже")
     except Exception as e:
-        await interaction.followup.send(f"❌ Ошибка: {str(e)}")
+        print(f"❌ Ошибка /ai: {e!r}")
+        await interaction.followup.send("❌ Не удалось получить ответ нейросети, попробуй позже")
 
 # ================== ТИКЕТЫ ==================
-class TicketView(discord.ui.View):
-    def __init__(self):
-        super().__init__(timeout=None)
+MAX_OPEN_TICKETS = int(os.getenv('MAX_OPEN_TICKETS', '50'))  # открытых тикетов на сервер
 
-    @discord.ui.button(label="📩 Открыть тикет", style=discord.ButtonStyle.green)
-    async def ticket_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        for ch in interaction.guild.channels:
-            if ch.name == f"ticket-{interaction.user.name.lower()}":
-                return await interaction.response.send_message("❌ Тикет уже есть", ephemeral=True)
-        
-        category = discord.utils.get(interaction.guild.categories, name="ТИКЕТЫ")
+class TicketRegistry:
+    """Открытые тикеты: (guild_id, user_id) -> channel_id в памяти и в таблице open_tickets"""
+
+    def __init__(self, max_per_guild):
+        self.max_per_guild = max_per_guild
+        self._by_user = {}  # (guild_id, user_id) -> channel_id, None пока канал создаётся
+        self._by_channel = {}  # channel_id -> (guild_id, user_id)
+        self._per_guild = {}  # guild_id -> открытых тикетов
+
+    async def load(self):
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            rows = [row for row in await OPEN_TICKETS_LOAD(conn) if owns_guild(row['guild_id'])]
+        for row in rows:
+            self._add(row['guild_id'], row['user_id'], row['channel_id'])
+        print(f"📩 Открытых тикетов: {len(rows)}")
+
+    def _add(self, guild_id, user_id, channel_id):
+        if (guild_id, user_id) not in self._by_user:
+            self._per_guild[guild_id] = self._per_guild.get(guild_id, 0) + 1
+        self._by_user[(guild_id, user_id)] = channel_id
+        if channel_id is not None:
+            self._by_channel[channel_id] = (guild_id, user_id)
+
+    def _remove(self, guild_id, user_id):
+        channel_id = self._by_user.pop((guild_id, user_id))
+        self._by_channel.pop(channel_id, None)
+        self._per_guild[guild_id] -= 1
+        if not self._per_guild[guild_id]:
+            del self._per_guild[guild_id]
+
+    def get(self, guild_id, user_id):
+        return self._by_user.get((guild_id, user_id))
+
+    def opener(self, channel_id):
+        owner = self._by_channel.get(channel_id)
+        return owner[1] if owner else None
+
+    def reserve(self, guild_id, user_id):
+        """Занимает место под новый тикет; возвращает текст ошибки, если открыть нельзя"""
+        if (guild_id, user_id) in self._by_user:
+            channel_id = self._by_user[(guild_id, user_id)]
+            return f"❌ Тикет уже есть: <#{channel_id}>" if channel_id else "❌ Тикет уже создаётся"
+        if self._per_guild.get(guild_id, 0) >= self.max_per_guild:
+            return "❌ Слишком много открытых тикетов, попробуй позже"
+        self._add(guild_id, user_id, None)
+        return None
+
+    def release(self, guild_id, user_id):
+        """Канал так и не создался — освобождаем место"""
+        if self._by_user.get((guild_id, user_id), 0) is None:
+            self._remove(guild_id, user_id)
+
+    async def open(self, guild_id, user_id, channel_id):
+        """Сначала запись в БД, потом в память: иначе после сбоя бот помнил бы тикет, которого нет в базе"""
+        try:
+            pool = await wait_for_db()
+            async with pool.acquire() as conn:
+                await OPEN_TICKET_SAVE(conn, guild_id, user_id, channel_id, datetime.now())
+        except BaseException:
+            self.release(guild_id, user_id)
+            raise
+        self._add(guild_id, user_id, channel_id)
+
+    async def close(self, channel_id):
+        owner = self._by_channel.get(channel_id)
+        if owner is None:
+            return
+        self._remove(*owner)
+        pool = await wait_for_db()
+        async with pool.acquire() as conn:
+            await OPEN_TICKET_DELETE(conn, channel_id)
+
+    async def reconcile(self):
+        """Убирает тикеты, чьи каналы удалили, пока бот был офлайн"""
+        for channel_id, (guild_id, _) in list(self._by_channel.items()):
+            guild = bot.get_guild(guild_id)
+            if guild is not None and guild.get_channel(channel_id) is None:
+                await self.close(channel_id)
+
+ticket_registry = TicketRegistry(MAX_OPEN_TICKETS)
+
+async def open_ticket(interaction, member):
+    """Создаёт канал тикета для member; при отказе сам отвечает на взаимодействие и возвращает None"""
+    guild = interaction.guild
+    error = ticket_registry.reserve(guild.id, member.id)
+    if error:
+        await interaction.response.send_message(error, ephemeral=True)
+        return None
+    
+    try:
+        category = discord.utils.get(guild.categories, name="ТИКЕТЫ")
         if not category:
-            category = await interaction.guild.create_category("ТИКЕТЫ")
+            category = await guild.create_category("ТИКЕТЫ")
         
         overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True),
-            interaction.guild.get_role(ROLES["support"]): discord.PermissionOverwrite(read_messages=True, send_messages=True),
-            interaction.guild.get_role(ROLES["admin"]): discord.PermissionOverwrite(read_messages=True, send_messages=True)
+            guild.default_role: discord.PermissionOverwrite(read_messages=False),
+            member: discord.PermissionOverwrite(read_messages=True, send_messages=True),
+            guild.get_role(ROLES["support"]): discord.PermissionOverwrite(read_messages=True, send_messages=True),
+            guild.get_role(ROLES["admin"]): discord.PermissionOverwrite(read_messages=True, send_messages=True)
         }
         
-        channel = await interaction.guild.create_text_channel(
-            name=f"ticket-{interaction.user.name}",
+        channel = await guild.create_text_channel(
+            name=f"ticket-{member.name.lower()}",
             category=category,
             overwrites=overwrites
         )
+    except BaseException:
+        ticket_registry.release(guild.id, member.id)
+        raise
+    
+    try:
+        await ticket_registry.open(guild.id, member.id, channel.id)
+    except BaseException:
+        # Тикет не сохранился — канал без записи в реестре никто бы не закрыл
+        try:
+            await channel.delete(reason="Не удалось сохранить тикет")
+        except discord.HTTPException:
+            pass
+        raise
+    return channel
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    await ticket_registry.close(channel.id)
+
+class TicketView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label="📩 Открыть тикет", style=discord.ButtonStyle.green)
+    async def ticket_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        channel = await open_ticket(interaction, interaction.user)
+        if channel is None:
+            return
         
         await interaction.response.send_message(f"✅ Тикет: {channel.mention}", ephemeral=True)
         await channel.send(embed=discord.Embed(title="📩 Тикет", description="Опиши проблему", color=discord.Color.green()), view=TicketCloseView())
 
+# ================== АРХИВ ТИКЕТОВ ==================
+TRANSCRIPT_HTML_HEAD = """<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: sans-serif; background: #313338; color: #dbdee1; }}
+.msg {{ padding: 4px 12px; }}
+.author {{ font-weight: bold; color: #f2f3f5; }}
+.bot {{ color: #949cf7; }}
+.time {{ color: #949ba4; font-size: 0.8em; margin-left: 6px; }}
+.content {{ white-space: pre-wrap; }}
+.attachments, .embeds {{ color: #949ba4; font-size: 0.9em; }}
+</style></head><body><h1>{title}</h1>
+"""
+
+def transcript_lines(message):
+    """Строка для текстового транскрипта и блок для HTML"""
+    stamp = message.created_at.strftime('%d.%m.%Y %H:%M')
+    author = message.author.display_name + (" [BOT]" if message.author.bot else "")
+    text_parts = [f"[{stamp}] {author}: {message.content}"]
+    html_parts = [
+        f'<div class="msg"><span class="author{" bot" if message.author.bot else ""}">{html.escape(author)}</span>'
+        f'<span class="time">{stamp}</span><div class="content">{html.escape(message.content)}</div>'
+    ]
+    if message.embeds:
+        titles = [embed.title or embed.description or "embed" for embed in message.embeds]
+        text_parts.extend(f"    [embed] {title}" for title in titles)
+        html_parts.append('<div class="embeds">' + "<br>".join(f"📎 {html.escape(t)}" for t in titles) + '</div>')
+    if message.attachments:
+        text_parts.extend(f"    [файл] {a.filename} ({a.size} байт) {a.url}" for a in message.attachments)
+        html_parts.append('<ul class="attachments">' + "".join(
+            f'<li><a href="{html.escape(a.url)}">{html.escape(a.filename)}</a> ({a.size} байт)</li>'
+            for a in message.attachments) + '</ul>')
+    html_parts.append('</div>')
+    return "\n".join(text_parts) + "\n", "".join(html_parts) + "\n"
+
+async def write_transcript(channel):
+    """Читает всю историю канала потоком и собирает zip с transcript.txt и transcript.html.
+
+    Текст пишется прямо в архив, HTML — во временный файл, который сбрасывается
+    на диск после 1 МБ, так что длинный тикет не держится в памяти целиком.
+    """
+    archive = io.BytesIO()
+    count = 0
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf, \
+            tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+", encoding="utf-8") as html_file:
+        html_file.write(TRANSCRIPT_HTML_HEAD.format(title=html.escape(channel.name)))
+        with zf.open("transcript.txt", "w") as text_file:
+            async for message in channel.history(limit=None, oldest_first=True):
+                text_line, html_block = transcript_lines(message)
+                text_file.write(text_line.encode("utf-8"))
+                html_file.write(html_block)
+                if not message.author.bot:
+                    count += 1
+        html_file.write("</body></html>\n")
+        html_file.seek(0)
+        with zf.open("transcript.html", "w") as out:
+            for chunk in iter(lambda: html_file.read(64 * 1024), ""):
+                out.write(chunk.encode("utf-8"))
+    archive.seek(0)
+    return archive, count
+
+ARCHIVE_MAX_PARTS = int(os.getenv('ARCHIVE_MAX_PARTS', '5'))  # сообщений на транскрипт больше лимита файла
+
+async def upload_transcript(archive, embed, transcript, filename):
+    """Отправляет карточку тикета с транскриптом и возвращает её сообщение.
+
+    Zip больше лимита файлов сервера режется на части name.zip.001, .002… (склеиваются обратно
+    cat или copy /b). Если частей слишком много или Discord всё равно ответил 413, карточка уходит
+    без файла: закрытие тикета из-за размера архива падать не должно.
+    """
+    data = transcript.getvalue()
+    limit = archive.guild.filesize_limit
+    if len(data) <= limit:
+        parts = [(filename, data)]
+    else:
+        parts = [(f"{filename}.{number:03d}", data[offset:offset + limit])
+                 for number, offset in enumerate(range(0, len(data), limit), 1)]
+    first = None
+    if len(parts) <= ARCHIVE_MAX_PARTS:
+        try:
+            for name, part in parts:
+                file = discord.File(io.BytesIO(part), filename=name)
+                if first is None:
+                    first = await archive.send(embed=embed, file=file)
+                else:
+                    await archive.send(file=file)
+            return first
+        except discord.HTTPException as e:
+            if e.status != 413:
+                raise
+            print(f"⚠️ Discord не принял транскрипт {filename}: {e}")
+            if first is not None:
+                return first
+    embed.add_field(name="⚠️ Транскрипт", value=f"Не загружен: {len(data) / 1024 / 1024:.1f} МБ — больше лимита сервера",
+                    inline=False)
+    return await archive.send(embed=embed)
+
+async def archive_ticket(channel, closer):
+    """Выгружает транскрипт в канал-архив и записывает тикет в таблицу tickets"""
+    opener = channel.guild.get_member(ticket_registry.opener(channel.id) or 0)
+    if opener is None:
+        opener = next((target for target in channel.overwrites if isinstance(target, discord.Member) and not target.bot), None)
+    transcript, count = await write_transcript(channel)
+    opened_at = channel.created_at
+    closed_at = discord.utils.utcnow()
+    
+    embed = discord.Embed(title=f"📦 {channel.name}", color=discord.Color.dark_gray())
+    embed.add_field(name="📩 Открыл", value=f"{opener.mention} ({opener.id})" if opener else "Неизвестно", inline=True)
+    embed.add_field(name="👤 Закрыл", value=f"{closer.mention} ({closer.id})", inline=True)
+    embed.add_field(name="🎭 Роли", value=", ".join([r.name for r in closer.roles if r.name != "@everyone"]) or "Нет", inline=True)
+    embed.add_field(name="💬 Сообщений", value=count, inline=True)
+    embed.add_field(name="⏱️ Длительность", value=str(closed_at - opened_at).split(".")[0], inline=True)
+    
+    archive_message = None
+    archive = channel.guild.get_channel(ARCHIVE_CHANNEL_ID)
+    if archive:
+        archive_message = await upload_transcript(archive, embed, transcript, f"{channel.name}.zip")
+    
+    pool = await wait_for_db()
+    async with pool.acquire() as conn:
+        await TICKET_ARCHIVE(conn, channel.guild.id, channel.id, channel.name, opener.id if opener else None, closer.id,
+            opened_at, closed_at, count, archive_message.id if archive_message else None)
+
 class TicketCloseView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
@@ -762,28 +3900,8 @@ class TicketCloseView(discord.ui.View):
     @discord.ui.button(label="🔒 Закрыть", style=discord.ButtonStyle.red)
     async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.send_message("📦 Архивация...", ephemeral=True)
-        
-        msgs = []
-        async for m in interaction.channel.history(limit=100, oldest_first=True):
-            if not m.author.bot:
-                msgs.append(f"[{m.created_at.strftime('%d.%m %H:%M')}] {m.author.display_name}: {m.content}")
-        
-        embed = discord.Embed(title=f"📦 {interaction.channel.name}", color=discord.Color.dark_gray())
-        embed.add_field(name="👤 Закрыл", value=f"{interaction.user.mention} ({interaction.user.id})", inline=True)
-        embed.add_field(name="🎭 Роли", value=", ".join([r.name for r in interaction.user.roles if r.name != "@everyone"]) or "Нет", inline=True)
-        embed.add_field(name="💬 Сообщений", value=len(msgs), inline=True)
-        
-        archive = interaction.guild.get_channel(ARCHIVE_CHANNEL_ID)
-        if archive:
-            await archive.send(embed=embed)
-            if msgs:
-                text = "\n".join(msgs)
-                if len(text) > 1900:
-                    for i in range(0, len(text), 1900):
-                        await archive.send(f"```{text[i:i+1900]}```")
-                else:
-                    await archive.send(f"```{text}```")
-        
+        await archive_ticket(interaction.channel, interaction.user)
+        await ticket_registry.close(interaction.channel.id)
         await interaction.channel.delete()
 
 @bot.tree.command(name="ticket", description="Панель тикетов")
@@ -792,16 +3910,412 @@ async def ticket_panel(interaction: discord.Interaction):
     embed = discord.Embed(title="🎫 Поддержка", description="Нажми кнопку для открытия тикета", color=discord.Color.blue())
     await interaction.response.send_message(embed=embed, view=TicketView())
 
+# ================== СИНХРОНИЗАЦИЯ КОМАНД ==================
+# Слэш-команды уходят в Discord, только если изменился их JSON: хэш последней синхронизации
+# лежит в command_sync. --force-sync или FORCE_COMMAND_SYNC=1 синхронизируют всегда.
+COMMAND_GUILD_IDS = [GUILD_ID] + [int(guild_id) for guild_id in os.getenv('COMMAND_GUILD_IDS', '').split(',') if guild_id]
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC', '0') == '1' or '--force-sync' in sys.argv
+
+def command_tree_hash(tree, guild):
+    """SHA-256 того же JSON, что tree.sync отправил бы для сервера, в стабильном порядке"""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+                     key=lambda command: (command.get('type', 1), command['name']))
+    blob = json.dumps({"application_id": tree.client.application_id, "commands": payload},
+                      sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+async def sync_commands(tree, guild):
+    """Синхронизирует команды сервера, если они поменялись; возвращает True, если был запрос к Discord"""
+    digest = command_tree_hash(tree, guild)
+    pool = bot.db_pool
+    if not FORCE_COMMAND_SYNC and pool is not None and await COMMAND_SYNC_HASH(pool, guild.id) == digest:
+        return False
+    await tree.sync(guild=guild)
+    if pool is not None:
+        await COMMAND_SYNC_SAVE(pool, guild.id, digest, datetime.now())
+    return True
+
+# ================== КЛАСТЕР ==================
+# python main.py --cluster поднимает лаунчер: он делит SHARD_COUNT шардов на CLUSTER_WORKERS процессов,
+# перезапускает упавшие и собирает их статистику по локальному TCP (строки JSON на 127.0.0.1).
+# Состояние по серверам (голос, тикеты, кэши топа и профилей) живёт в процессе, которому принадлежит шард сервера.
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 1)))
+CLUSTER_STATS_INTERVAL = float(os.getenv('CLUSTER_STATS_INTERVAL', '15'))  # секунды между отчётами воркера
+
+def shard_of(guild_id):
+    return (guild_id >> 22) % SHARD_COUNT
+
+def owns_guild(guild_id):
+    """Приходят ли события этого сервера в текущий процесс"""
+    if not SHARDED:
+        return True
+    return not SHARD_IDS or shard_of(guild_id) in SHARD_IDS
+
+def shard_latencies():
+    latencies = bot.latencies if SHARDED else [(0, bot.latency)]
+    return {str(shard_id): round(latency * 1000) for shard_id, latency in latencies if math.isfinite(latency)}
+
+class ClusterClient:
+    """Воркер: раз в CLUSTER_STATS_INTERVAL шлёт лаунчеру свои цифры и получает в ответ сводку по кластеру"""
+
+    def __init__(self, port, cluster_id, interval):
+        self.port = port
+        self.cluster_id = cluster_id
+        self.interval = interval
+        self.snapshot = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def report(self):
+        return {"cluster": self.cluster_id, "pid": os.getpid(), "guilds": len(bot.guilds), "shards": shard_latencies()}
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                try:
+                    while True:
+                        writer.write(json.dumps(self.report()).encode() + b"\n")
+                        await writer.drain()
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        self.snapshot = json.loads(line)
+                        await asyncio.sleep(self.interval)
+                finally:
+                    writer.close()
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Нет связи с лаунчером кластера: {e}")
+            await asyncio.sleep(self.interval)
+
+cluster = ClusterClient(CLUSTER_IPC_PORT, CLUSTER_ID, CLUSTER_STATS_INTERVAL) if CLUSTER_IPC_PORT else None
+
+async def gateway_info(token):
+    """Рекомендуемое Discord число шардов и сколько из них можно подключать одновременно"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={'Authorization': f'Bot {token}'}) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data['shards'], data['session_start_limit']['max_concurrency']
+
+class ClusterLauncher:
+    def __init__(self, shard_count, workers, max_concurrency, port):
+        self.shard_count = shard_count
+        self.port = port
+        self.max_concurrency = max_concurrency
+        # Непрерывные диапазоны шардов, по одному на процесс
+        self.ranges = [list(range(i * shard_count // workers, (i + 1) * shard_count // workers)) for i in range(workers)]
+        self.reports = {}  # cluster_id -> последний отчёт воркера
+        self._reported = {}  # cluster_id -> Event первого отчёта (БД воркера готова)
+
+    def snapshot(self):
+        shards = {}
+        for report in self.reports.values():
+            shards.update(report['shards'])
+        return {
+            "workers": len(self.reports),
+            "shard_count": self.shard_count,
+            "guilds": sum(report['guilds'] for report in self.reports.values()),
+            "shards": shards,
+        }
+
+    async def _handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                report = json.loads(line)
+                self.reports[report['cluster']] = report
+                self._reported[report['cluster']].set()
+                writer.write(json.dumps(self.snapshot()).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            writer.close()
+
+    async def _worker(self, cluster_id, start_delay):
+        shard_ids = self.ranges[cluster_id]
+        env = {
+            **os.environ,
+            'SHARD_COUNT': str(self.shard_count),
+            'SHARD_IDS': ",".join(map(str, shard_ids)),
+            'CLUSTER_ID': str(cluster_id),
+            'CLUSTER_IPC_PORT': str(self.port),
+            'CLUSTER_SIZE': str(len(self.ranges)),
+        }
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(METRICS_PORT + cluster_id)
+        await asyncio.sleep(start_delay)
+        while True:
+            print(f"🚀 Воркер {cluster_id}: шарды {shard_ids[0]}–{shard_ids[-1]}")
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            self.reports.pop(cluster_id, None)
+            print(f"⚠️ Воркер {cluster_id} завершился с кодом {code}, перезапуск через 5 с")
+            await asyncio.sleep(5)
+
+    async def run(self):
+        self._reported = {cluster_id: asyncio.Event() for cluster_id in range(len(self.ranges))}
+        server = await asyncio.start_server(self._handle, '127.0.0.1', self.port)
+        print(f"🧩 Кластер: {len(self.ranges)} процессов, {self.shard_count} шардов, IPC 127.0.0.1:{self.port}")
+        async with server:
+            first = asyncio.create_task(self._worker(0, 0))
+            # Первый воркер создаёт таблицы и применяет миграции; остальные ждут его отчёта
+            await self._reported[0].wait()
+            # Шарды подключаются по 5 секунд на каждые max_concurrency штук
+            workers, shards_before = [first], len(self.ranges[0])
+            for cluster_id in range(1, len(self.ranges)):
+                workers.append(asyncio.create_task(self._worker(cluster_id, 5 * shards_before / self.max_concurrency)))
+                shards_before += len(self.ranges[cluster_id])
+            await asyncio.gather(*workers)
+
+async def run_cluster():
+    recommended, max_concurrency = await gateway_info(os.getenv('BOT_TOKEN'))
+    shard_count = SHARD_COUNT or max(recommended, CLUSTER_WORKERS)
+    workers = max(1, min(CLUSTER_WORKERS, shard_count))
+    await ClusterLauncher(shard_count, workers, max_concurrency, CLUSTER_IPC_PORT or 47800).run()
+
+# ================== БЕНЧМАРК ==================
+# python main.py --bench гоняет горячие обработчики на подставных сообщениях и взаимодействиях
+# против отдельной одноразовой БД. Каждый размер — своя схема, которая удаляется после прогона;
+# с BENCH_DATABASE_URL=sqlite:// — свой временный файл SQLite.
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')  # только локальная тестовая БД, не DATABASE_URL
+BENCH_SIZES = [int(size) for size in os.getenv('BENCH_SIZES', '1000,100000,1000000').split(',')]
+BENCH_EVENTS = int(os.getenv('BENCH_EVENTS', '2000'))  # вызовов на обработчик
+BENCH_OUTPUT = os.getenv('BENCH_OUTPUT')  # файл для JSON, иначе stdout
+BENCH_GUILD_ID = 1
+
+BENCH_SEED_SQL = [
+    'INSERT INTO coins SELECT u, $2, random() * 1000 FROM generate_series(1, $1) u',
+    'INSERT INTO xp SELECT u, $2, floor(random() * 100)::INT, 1 + floor(random() * 30)::INT FROM generate_series(1, $1) u',
+    'INSERT INTO messages SELECT u, $2, floor(random() * 5000)::INT FROM generate_series(1, $1) u',
+    'INSERT INTO voice_time SELECT u, $2, floor(random() * 3000)::INT, NULL FROM generate_series(1, $1) u',
+    '''INSERT INTO warns (user_id, guild_id, moderator_id, reason, date)
+       SELECT u, $2, 0, 'bench', NOW() - random() * INTERVAL '14 days' FROM generate_series(1, $1, 10) u''',
+]
+BENCH_SERIES_SQLITE = 'WITH RECURSIVE s(u) AS (SELECT 1 UNION ALL SELECT u + 1 FROM s WHERE u < ?1) '
+BENCH_SEED_SQL_SQLITE = [BENCH_SERIES_SQLITE + sql for sql in [
+    'INSERT INTO coins SELECT u, ?2, abs(random() % 1000000) / 1000.0 FROM s',
+    'INSERT INTO xp SELECT u, ?2, abs(random() % 100), 1 + abs(random() % 30) FROM s',
+    'INSERT INTO messages SELECT u, ?2, abs(random() % 5000) FROM s',
+    'INSERT INTO voice_time SELECT u, ?2, abs(random() % 3000), NULL FROM s',
+    '''INSERT INTO warns (user_id, guild_id, moderator_id, reason, date, expired)
+       SELECT u, ?2, 0, 'bench', datetime('now', 'localtime', '-' || abs(random() % 1209600) || ' seconds'), FALSE
+       FROM s WHERE u % 10 = 1''',
+]]
+
+class BenchResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+class BenchGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+    def get_member(self, user_id):
+        return None
+
+def bench_member(user_id):
+    return SimpleNamespace(
+        id=user_id, bot=False, display_name=f"user{user_id}", mention=f"<@{user_id}>",
+        status=discord.Status.online, color=discord.Color.default(),
+        avatar=None, default_avatar=SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png"),
+    )
+
+def bench_interaction(guild, user):
+    return SimpleNamespace(guild=guild, guild_id=guild.id, user=user, response=BenchResponse())
+
+def bench_message(guild, user, words):
+    return SimpleNamespace(author=user, guild=guild, content=" ".join(["слово"] * words), _state=None)
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+class QueryCounter:
+    """Считает запросы к БД через query logger asyncpg"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, record):
+        self.count += 1
+
+    async def attach(self, conn):
+        conn.add_query_logger(self)
+
+async def bench_run(counter, events, handler, finish=None):
+    """Вызывает handler(i) events раз; возвращает пропускную способность, задержки и запросы на событие.
+
+    finish() — отложенная работа сценария (например, сброс остатка буфера): её время и запросы
+    входят в пропускную способность и запросы на событие, но не в задержки отдельных событий.
+    """
+    samples = []
+    queries = counter.count
+    started = time.perf_counter()
+    for i in range(events):
+        call_started = time.perf_counter()
+        await handler(i)
+        samples.append((time.perf_counter() - call_started) * 1000)
+    finish_ms = 0.0
+    if finish is not None:
+        finish_started = time.perf_counter()
+        await finish()
+        finish_ms = (time.perf_counter() - finish_started) * 1000
+    elapsed = time.perf_counter() - started
+    result = {
+        "events": events,
+        "events_per_sec": round(events / elapsed, 1),
+        "p50_ms": round(percentile(samples, 0.50), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "queries_per_event": round((counter.count - queries) / events, 3),
+    }
+    if finish is not None:
+        result["finish_ms"] = round(finish_ms, 3)
+    return result
+
+def bench_reset_state():
+    """Свежие кэши на каждый размер, чтобы прогоны не грели друг друга"""
+    global activity_buffer, rank_service, leaderboard, profiles
+    activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_EVENTS)
+    rank_service = RankService(RANK_IN_MEMORY)
+    leaderboard = LeaderboardCache(LEADERBOARD_SIZE, LEADERBOARD_MAX_GUILDS)
+    profiles = ProfileLoader(PROFILE_TTL, PROFILE_CACHE_SIZE)
+
+async def bench_size(size):
+    sqlite = BENCH_DATABASE_URL.startswith('sqlite://')
+    if sqlite:
+        path = os.path.join(tempfile.gettempdir(), f"bench_{size}_{os.getpid()}.db")
+        admin = None
+    else:
+        schema = f"bench_{size}_{os.getpid()}"
+        admin = await asyncpg.connect(BENCH_DATABASE_URL)
+        await admin.execute(f'CREATE SCHEMA {schema}')
+    counter = QueryCounter()
+    bot.db_ready.clear()
+    bench_reset_state()
+    try:
+        if sqlite:
+            await init_db(f"sqlite:///{path}", init=counter.attach)
+        else:
+            await init_db(BENCH_DATABASE_URL, server_settings={'search_path': schema}, init=counter.attach)
+        pool = bot.db_pool
+        seed_started = time.perf_counter()
+        async with pool.acquire() as conn:
+            for sql in BENCH_SEED_SQL_SQLITE if sqlite else BENCH_SEED_SQL:
+                await conn.execute(sql, size, BENCH_GUILD_ID)
+            await conn.execute('ANALYZE')
+        seed_seconds = time.perf_counter() - seed_started
+
+        guild = BenchGuild(BENCH_GUILD_ID)
+        rng = random.Random(size)
+        users = [bench_member(rng.randint(1, size)) for _ in range(BENCH_EVENTS)]
+        results = {}
+
+        async def message(i):
+            await on_message(bench_message(guild, users[i], 1 + i % 10))
+            if activity_buffer._events >= activity_buffer.max_events:
+                await activity_buffer.flush()
+        # Остаток буфера сбрасывается внутри сценария, иначе его запросы и время выпадут из итогов
+        results["on_message"] = await bench_run(counter, BENCH_EVENTS, message, finish=activity_buffer.flush)
+
+        async def xp(i):
+            async with pool.acquire() as conn:
+                await add_xp(users[i].id, BENCH_GUILD_ID, 1, conn)
+        results["add_xp"] = await bench_run(counter, BENCH_EVENTS, xp)
+
+        async def milestone(i):
+            async with pool.acquire() as conn:
+                await check_coin_milestone(users[i].id, conn)
+        results["check_coin_milestone"] = await bench_run(counter, BENCH_EVENTS, milestone)
+
+        async def stat(i):
+            await stat_command.callback(bench_interaction(guild, users[i]), users[i])
+        results["stat_command"] = await bench_run(counter, BENCH_EVENTS, stat)
+
+        async def top(i):
+            await top_command.callback(bench_interaction(guild, users[i]))
+        results["top_command"] = await bench_run(counter, BENCH_EVENTS, top)
+
+        return {"rows": size, "seed_seconds": round(seed_seconds, 2), "handlers": results}
+    finally:
+        if bot.db_pool is not None:
+            await bot.db_pool.close()
+            bot.db_pool = None
+        if sqlite:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        else:
+            await admin.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+            await admin.close()
+
+async def run_benchmarks():
+    if not BENCH_DATABASE_URL:
+        print("❌ BENCH_DATABASE_URL не задан: бенчмарк пишет в БД и запускается только на отдельной базе")
+        return
+    # Без входа в Discord у бота нет user; process_commands сверяет с ним автора сообщения
+    bot._connection.user = SimpleNamespace(id=0)
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "events": BENCH_EVENTS,
+        "config": {"rank_in_memory": RANK_IN_MEMORY, "flush_events": ACTIVITY_FLUSH_EVENTS, "pool_max": DB_POOL_MAX},
+        "sizes": [],
+    }
+    for size in BENCH_SIZES:
+        print(f"⏱️ Бенчмарк на {size} строк...", file=sys.stderr)
+        report["sizes"].append(await bench_size(size))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"✅ Результаты записаны в {BENCH_OUTPUT}", file=sys.stderr)
+    else:
+        print(output)
+
 # ================== ЗАПУСК ==================
+@bot.event
+async def on_app_command_completion(interaction, command):
+    record_command(interaction)
+
 @bot.event
 async def on_ready():
-    await init_db()
-    bot.loop.create_task(check_expired_warns())
+    await voice_tracker.rebuild()
+    await ticket_registry.reconcile()
     print(f"✅ {bot.user} готов! Серверов: {len(bot.guilds)}")
+    if not startup.reported:
+        startup.mark("шлюз")
+        startup.reported = True
+        print(f"⏱️ Запуск: {startup.report()}")
+    if SHARDED:
+        print(f"🧩 Воркер {CLUSTER_ID}: шарды {', '.join(map(str, bot.shards))} из {SHARD_COUNT}")
     print(f"🤖 Нейросеть: {'доступна' if AI_TOKEN else 'не настроена'}")
-    bot.add_view(TicketView())
-    bot.add_view(TicketCloseView())
 
-bot.run(os.getenv('BOT_TOKEN'))
+if __name__ == '__main__':
+    if '--migrate-dry-run' in sys.argv:
+        asyncio.run(migrations_dry_run())
+    elif '--bench' in sys.argv:
+        asyncio.run(run_benchmarks())
+    elif '--cluster' in sys.argv:
+        asyncio.run(run_cluster())
+    else:
+        bot.run(os.getenv('BOT_TOKEN'))
 
 
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# main.py лежит в корне репозитория, а не в пакете
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class QueryCounter:
+    """Query logger, который запоминает текст каждого запроса"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, record):
+        self.queries.append(record.query)
+
+    async def attach(self, conn):
+        conn.add_query_logger(self)
+
+
+@pytest.fixture
+def query_counter():
+    return QueryCounter()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """sqlite_db(test, **pool_options): запускает корутину test(pool) на свежей SQLite-базе бота"""
+    def run(test, **pool_options):
+        async def scenario():
+            main.bot.db_ready.clear()
+            await main.init_db(f"sqlite:///{tmp_path / 'bot.db'}", **pool_options)
+            try:
+                return await test(main.bot.db_pool)
+            finally:
+                await main.bot.db_pool.close()
+                main.bot.db_pool = None
+        return asyncio.run(scenario())
+    return run
@@ -0,0 +1,87 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import main
+
+
+def test_flush_checks_milestones_in_one_batch(sqlite_db, query_counter, monkeypatch):
+    sent = []
+
+    async def record_milestones(milestones):
+        sent.append(milestones)
+    monkeypatch.setattr(main, 'send_coin_milestones', record_milestones)
+
+    async def scenario(pool):
+        buffer = main.ActivityBuffer(3600, 10 ** 6)
+        for user_id in range(1, 51):
+            buffer.add(user_id, 1, messages=1, coins=user_id * 5.0, xp=1)
+        buffer.add(7, 2, coins=500.0)
+        query_counter.queries.clear()
+        await buffer.flush()
+        # Сброс, чтение уведомлений и их запись — три обращения к БД на всю пачку
+        assert len(query_counter.queries) == 3
+        expected = {user_id: user_id * 5 // 100 * 100 for user_id in range(20, 51)}
+        expected[7] = 500  # у игрока два сервера, уведомление идёт по большему балансу
+        assert sent[-1] == expected
+
+        # Уже отмеченные сотни не повторяются, новая — да
+        buffer.add(30, 1, coins=1.0)
+        buffer.add(40, 1, coins=100.0)
+        await buffer.flush()
+        assert sent[-1] == {40: 300}
+
+    sqlite_db(scenario, init=query_counter.attach)
+
+
+def test_flush_restores_batch_only_when_the_write_failed(sqlite_db, monkeypatch):
+    async def no_milestones(milestones):
+        pass
+    monkeypatch.setattr(main, 'send_coin_milestones', no_milestones)
+
+    async def messages(pool):
+        return await pool.fetchval('SELECT count FROM messages WHERE user_id = 1 AND guild_id = 1')
+
+    async def scenario(pool):
+        buffer = main.ActivityBuffer(3600, 10 ** 6)
+
+        # Запрос упал — пачка возвращается в буфер
+        async def broken_flush(conn, *args):
+            raise RuntimeError("БД недоступна")
+        real_flush = main.ACTIVITY_FLUSH
+        monkeypatch.setattr(main, 'ACTIVITY_FLUSH', broken_flush)
+        buffer.add(1, 1, messages=1)
+        with pytest.raises(RuntimeError):
+            await buffer.flush()
+        assert buffer.pending(1, 1)[0] == 1
+        monkeypatch.setattr(main, 'ACTIVITY_FLUSH', real_flush)
+
+        # Пачка записана, падает обновление кэшей — в буфер она не возвращается
+        def broken_update(*args, **kwargs):
+            raise RuntimeError("кэш")
+        with monkeypatch.context() as patch:
+            patch.setattr(main.profiles, 'invalidate', broken_update)
+            with pytest.raises(RuntimeError):
+                await buffer.flush()
+        assert buffer.pending(1, 1)[0] == 0
+        assert await messages(pool) == 1
+
+        # Отмена при возврате соединения после записи — тоже без повторного учёта
+        real_acquire = pool.acquire
+
+        @asynccontextmanager
+        async def cancelled_on_release():
+            async with real_acquire() as conn:
+                yield conn
+            raise asyncio.CancelledError()
+        pool.acquire = cancelled_on_release
+        buffer.add(1, 1, messages=1)
+        with pytest.raises(asyncio.CancelledError):
+            await buffer.flush()
+        del pool.acquire
+        assert buffer.pending(1, 1)[0] == 0
+        assert buffer.failed_flushes == 1
+        assert await messages(pool) == 2
+
+    sqlite_db(scenario)
@@ -0,0 +1,45 @@
+import main
+
+
+def test_period_top_cache_is_bounded(sqlite_db):
+    async def scenario(pool):
+        rollups = main.ActivityRollups(top_ttl=60, max_tops=3)
+        for guild_id in range(10):
+            await rollups.top(guild_id, 'week')
+        assert len(rollups._tops) == 3
+        assert list(rollups._tops) == [(7, 'week'), (8, 'week'), (9, 'week')]
+
+        # Свежее обращение поднимает запись, вытесняется самая давняя
+        await rollups.top(7, 'week')
+        await rollups.top(0, 'day')
+        assert list(rollups._tops) == [(9, 'week'), (7, 'week'), (0, 'day')]
+
+    sqlite_db(scenario)
+
+
+def frozen_now(monkeypatch, moment):
+    class FrozenDatetime(main.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return moment
+    monkeypatch.setattr(main, 'datetime', FrozenDatetime)
+
+
+def test_period_start_rounds_up_to_a_whole_bucket(monkeypatch):
+    frozen_now(monkeypatch, main.datetime(2026, 10, 18, 12, 30))
+    # Сутки — по часовым корзинам: неполный час 12:00 прошлых суток не входит
+    assert main.period_start('day') == main.datetime(2026, 10, 17, 13, 0)
+    # Месяц — по дневным: неполный день начала периода не входит
+    assert main.period_start('month') == main.datetime(2026, 9, 19)
+
+    frozen_now(monkeypatch, main.datetime(2026, 10, 18, 12, 0))
+    assert main.period_start('day') == main.datetime(2026, 10, 17, 12, 0)
+
+
+def test_user_rollup_reads_only_the_players_buckets(sqlite_db):
+    async def scenario(pool):
+        plan = await pool.fetch('EXPLAIN QUERY PLAN ' + main.ROLLUP_USER.sql, 1, 2, main.datetime(2026, 10, 1))
+        detail = " ".join(row['detail'] for row in plan)
+        assert "COVERING INDEX activity_rollups_user_idx (guild_id=? AND user_id=? AND bucket>?)" in detail
+
+    sqlite_db(scenario)
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import main
+
+
+async def start_stub(status, body, content_type):
+    async def handler(request):
+        return web.Response(status=status, text=body, content_type=content_type)
+
+    app = web.Application()
+    app.router.add_post('/chat/completions', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def call(client, stream, api=None):
+    messages = [{"role": "user", "content": "hi"}]
+    if stream:
+        chunks = client.stream_chat(messages)
+        return "".join([delta async for delta in (api.stream(chunks) if api else chunks)])
+    return await (api.call(client.chat(messages)) if api else client.chat(messages))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_html_error_page_is_upstream_failure(stream):
+    async def scenario():
+        runner, url = await start_stub(503, "<html><body>Service Unavailable</body></html>", "text/html")
+        client = main.AIClient("token", base_url=url)
+        await client.start()
+        try:
+            with pytest.raises(main.AIError) as error:
+                await call(client, stream)
+            assert error.value.status == 503
+            assert "Service Unavailable" in error.value.data
+            assert main.is_upstream_failure(error.value)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_html_errors_open_breaker(stream):
+    async def scenario():
+        runner, url = await start_stub(502, "<html>Bad Gateway</html>", "text/html")
+        client = main.AIClient("token", base_url=url)
+        await client.start()
+        scheduler = main.AIScheduler(2, 5, 600, 10, main.CircuitBreaker(3, 30))
+        try:
+            for _ in range(3):
+                with pytest.raises(main.AIError):
+                    async with scheduler.slot(1) as api:
+                        await call(client, stream, api)
+            with pytest.raises(main.AIRejected):
+                async with scheduler.slot(1):
+                    pass
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
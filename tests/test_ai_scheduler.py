@@ -0,0 +1,164 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import main
+
+
+def make_scheduler(max_concurrent=1):
+    return main.AIScheduler(max_concurrent, queue_size=5, user_rate=600, user_burst=10,
+                            breaker=main.CircuitBreaker(3, 30))
+
+
+def test_failed_queue_notice_does_not_leak_slot():
+    async def scenario():
+        scheduler = make_scheduler()
+
+        async def broken_notice(position):
+            raise discord.HTTPException(type("Resp", (), {"status": 500, "reason": "boom"})(), "edit failed")
+
+        async with scheduler.slot(1):
+            with pytest.raises(discord.HTTPException):
+                async with scheduler.slot(2, on_queued=broken_notice):
+                    pass
+            assert scheduler.stats()["queued"] == 0
+        assert scheduler.stats()["active"] == 0
+
+        # Место не потерялось: следующий запрос проходит сразу
+        async with scheduler.slot(3):
+            assert scheduler.stats()["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_queue_notice_does_not_leak_slot():
+    async def scenario():
+        scheduler = make_scheduler()
+        notice_started = asyncio.Event()
+
+        async def slow_notice(position):
+            notice_started.set()
+            await asyncio.sleep(3600)
+
+        async def queued():
+            async with scheduler.slot(2, on_queued=slow_notice):
+                pass
+
+        async with scheduler.slot(1):
+            task = asyncio.create_task(queued())
+            await notice_started.wait()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert scheduler.stats()["active"] == 0
+        assert scheduler.stats()["queued"] == 0
+        await asyncio.wait_for(scheduler._acquire(None), timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_breaker_counts_only_api_errors():
+    async def scenario():
+        scheduler = make_scheduler()
+        timeout = asyncio.TimeoutError()
+
+        async def failing_api():
+            raise main.AIError(502, "Bad Gateway")
+
+        async def answer():
+            return "ответ"
+
+        # Таймауты и сетевые ошибки Discord после ответа API размыкатель не трогают
+        for _ in range(5):
+            with pytest.raises(asyncio.TimeoutError):
+                async with scheduler.slot(1) as api:
+                    await api.call(answer())
+                    raise timeout
+        assert scheduler.breaker.failures == 0
+
+        for _ in range(3):
+            with pytest.raises(main.AIError):
+                async with scheduler.slot(1) as api:
+                    await api.call(failing_api())
+        assert scheduler.stats()["breaker"] == "open"
+
+    asyncio.run(scenario())
+
+
+def test_breaker_counts_stream_errors_but_not_message_edits():
+    async def chunks(fail):
+        yield "при"
+        if fail:
+            raise main.AIError(503, "Service Unavailable")
+        yield "вет"
+
+    async def scenario():
+        scheduler = make_scheduler()
+        scheduler.breaker.failures = 2
+
+        # Правка сообщения упала посреди потока — это не ошибка API, и ответ не засчитан как успех
+        with pytest.raises(asyncio.TimeoutError):
+            async with scheduler.slot(1) as api:
+                async for delta in api.stream(chunks(fail=False)):
+                    raise asyncio.TimeoutError()
+        assert scheduler.breaker.failures == 2
+
+        async with scheduler.slot(1) as api:
+            assert [delta async for delta in api.stream(chunks(fail=False))] == ["при", "вет"]
+        assert scheduler.breaker.failures == 0
+
+        with pytest.raises(main.AIError):
+            async with scheduler.slot(1) as api:
+                async for delta in api.stream(chunks(fail=True)):
+                    pass
+        assert scheduler.breaker.failures == 1
+
+    asyncio.run(scenario())
+
+
+class FakeInteraction:
+    def __init__(self):
+        self.user = SimpleNamespace(id=42)
+        self.log = []
+        self.response = SimpleNamespace(defer=self._defer)
+        self.followup = SimpleNamespace(send=self._send)
+
+    async def _defer(self):
+        self.log.append("defer")
+
+    async def _send(self, content):
+        self.log.append(("send", content))
+
+    async def edit_original_response(self, content):
+        self.log.append(("edit", content))
+
+    async def delete_original_response(self):
+        self.log.append("delete")
+
+
+def test_queue_notice_is_removed_when_slot_is_acquired(monkeypatch):
+    async def scenario():
+        scheduler = make_scheduler()
+        monkeypatch.setattr(main, 'ai_scheduler', scheduler)
+        monkeypatch.setattr(main, 'AI_TOKEN', "token")
+        monkeypatch.setattr(main, 'AI_STREAM', False)
+        monkeypatch.setattr(main, 'conversations', main.ConversationStore(1000, 10 ** 6, 3600, persist=False))
+        monkeypatch.setattr(main, 'ai_cache', main.AIResponseCache(60, 10))
+
+        async def chat(messages):
+            return "ответ"
+        monkeypatch.setattr(main.bot, 'ai', SimpleNamespace(model="m", chat=chat))
+
+        interaction = FakeInteraction()
+        async with scheduler.slot(1):
+            task = asyncio.create_task(main.ai_command.callback(interaction, "вопрос"))
+            while scheduler.stats()["queued"] == 0:
+                await asyncio.sleep(0)
+        await task
+        assert interaction.log == ["defer", ("edit", "⏳ Много запросов, ты 1-й в очереди…"), "delete",
+                                   ("send", "ответ")]
+        assert scheduler.breaker.failures == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,108 @@
+import asyncio
+
+import main
+
+
+def make_store(**options):
+    return main.ConversationStore(max_tokens=1000, budget_tokens=10 ** 6, idle_seconds=3600, **options)
+
+
+def test_cluster_workers_share_one_history(sqlite_db):
+    async def scenario(pool):
+        worker0 = make_store(persist=True, shared=True)
+        worker1 = make_store(persist=True, shared=True)
+
+        await worker0.add(1, "user", "привет")
+        await worker0.add(1, "assistant", "здравствуй")
+        # Следующий вопрос уходит на другой воркер: он видит весь диалог
+        messages = await worker1.add(1, "user", "как дела?")
+        assert [m["content"] for m in messages[1:]] == ["привет", "здравствуй", "как дела?"]
+        await worker1.add(1, "assistant", "отлично")
+
+        # И первый воркер не затирает ответ второго своей устаревшей копией
+        messages = await worker0.add(1, "user", "ещё вопрос")
+        assert [m["content"] for m in messages[1:]] == ["привет", "здравствуй", "как дела?", "отлично", "ещё вопрос"]
+        assert worker0._tokens == sum(c.tokens for c in worker0._conversations.values())
+
+    sqlite_db(scenario)
+
+
+def test_cluster_share_divides_global_caps(monkeypatch):
+    monkeypatch.setattr(main, 'CLUSTER_SIZE', 4)
+    assert main.cluster_share(20) == 5
+    assert main.cluster_share(2) == 1
+
+
+def assert_accounting(store):
+    assert store._tokens == sum(c.tokens for c in store._conversations.values())
+    for conversation in store._conversations.values():
+        assert conversation.tokens == sum(main.estimate_tokens(m) for m in conversation.messages)
+
+
+def test_budget_evicts_least_recently_used():
+    async def scenario():
+        store = make_store(persist=False)
+        for user_id in (1, 2, 3):
+            await store.add(user_id, "user", "x" * 240)
+        store.budget_tokens = store._tokens + 10
+        await store.add(1, "user", "свежее")  # 1 становится самым свежим, бюджет ещё не превышен
+        assert store.evictions == 0
+        await store.add(4, "user", "x" * 240)
+        assert list(store._conversations) == [3, 1, 4]
+        assert store.evictions == 1
+        assert store._tokens <= store.budget_tokens
+        assert_accounting(store)
+
+    asyncio.run(scenario())
+
+
+def test_idle_conversations_are_evicted():
+    async def scenario():
+        store = make_store(persist=False)
+        await store.add(1, "user", "давно")
+        await store.add(2, "user", "недавно")
+        store._conversations[1].touched -= 3600
+        await store.add(3, "user", "сейчас")
+        assert list(store._conversations) == [2, 3]
+        assert_accounting(store)
+
+    asyncio.run(scenario())
+
+
+def test_trim_keeps_system_prompt_and_last_message():
+    async def scenario():
+        store = main.ConversationStore(max_tokens=100, budget_tokens=10 ** 6, idle_seconds=3600, persist=False)
+        for i in range(20):
+            messages = await store.add(1, "user" if i % 2 == 0 else "assistant", f"реплика {i} " * 5)
+        assert messages[0]["role"] == "system"
+        assert messages[-1]["content"] == "реплика 19 " * 5
+        assert store._conversations[1].tokens <= 100
+
+        # Одна реплика больше лимита обрезается сама
+        messages = await store.add(1, "user", "я" * 3000)
+        assert len(messages) == 2
+        assert store._conversations[1].tokens <= 100
+        assert_accounting(store)
+
+    asyncio.run(scenario())
+
+
+def test_evicted_conversation_is_reloaded_from_database(sqlite_db):
+    async def scenario(pool):
+        store = main.ConversationStore(max_tokens=1000, budget_tokens=10 ** 6, idle_seconds=3600, persist=True)
+        await store.add(1, "user", "вопрос")
+        await store.add(1, "assistant", "ответ")
+        store._conversations[1].touched -= 3600
+        await store.add(2, "user", "другой")
+        assert 1 not in store._conversations and store.evictions == 1
+
+        messages = await store.add(1, "user", "продолжим")
+        assert [m["content"] for m in messages[1:]] == ["вопрос", "ответ", "продолжим"]
+        assert store.loads == 1
+
+        await store.reset(1)
+        assert 1 not in store._conversations
+        assert not await store.has_history(1)
+        assert_accounting(store)
+
+    sqlite_db(scenario)
@@ -0,0 +1,116 @@
+import asyncio
+import random
+
+import main
+
+
+async def db_top(pool, guild_id, size):
+    async with pool.acquire() as conn:
+        return [dict(row) for row in await main.LEADERBOARD_TOP(conn, guild_id, size)]
+
+
+def test_updates_keep_cached_top_equal_to_the_database(sqlite_db):
+    rng = random.Random(11)
+
+    async def scenario(pool):
+        cache = main.LeaderboardCache(size=5, max_guilds=10)
+        balances = {user_id: rng.random() * 100 for user_id in range(1, 30)}
+        levels = {user_id: rng.randint(0, 5) for user_id in balances}
+        async with pool.acquire() as conn:
+            for user_id, balance in balances.items():
+                await conn.execute('INSERT INTO coins (user_id, guild_id, balance) VALUES ($1, 1, $2)', user_id, balance)
+                await conn.execute('INSERT INTO xp (user_id, guild_id, xp, level) VALUES ($1, 1, 0, $2)',
+                                   user_id, levels[user_id])
+        await cache.get(1)
+
+        for _ in range(200):
+            user_id = rng.choice(list(balances))
+            balances[user_id] += rng.random() * 30
+            level_up = rng.random() < 0.3
+            if level_up:
+                levels[user_id] += 1
+            async with pool.acquire() as conn:
+                await conn.execute('UPDATE coins SET balance = $3 WHERE user_id = $1 AND guild_id = $2',
+                                   user_id, 1, balances[user_id])
+                await conn.execute('UPDATE xp SET level = $3 WHERE user_id = $1 AND guild_id = $2',
+                                   user_id, 1, levels[user_id])
+            # Пути начисления без XP уровень не передают
+            level = levels[user_id] if level_up or rng.random() < 0.5 else None
+            cache.update(1, user_id, balance=balances[user_id], level=level)
+            assert await cache.get(1) == await db_top(pool, 1, 5)
+        assert cache.hits > cache.misses
+
+    sqlite_db(scenario)
+
+
+def test_level_only_update_and_unknown_newcomer():
+    cache = main.LeaderboardCache(size=2, max_guilds=10)
+    cache._boards[1] = [{'user_id': 1, 'balance': 50.0, 'level': 3}, {'user_id': 2, 'balance': 40.0, 'level': 2}]
+
+    cache.update(1, 2, level=4)
+    assert cache._boards[1][1] == {'user_id': 2, 'balance': 40.0, 'level': 4}
+
+    # Не дотягивает до топа — кэш не трогаем
+    cache.update(1, 3, balance=10.0)
+    assert [entry['user_id'] for entry in cache._boards[1]] == [1, 2]
+
+    # Новичок в топе с неизвестным уровнем — сервер перечитается при следующем запросе
+    cache.update(1, 3, balance=45.0)
+    assert 1 not in cache._boards
+
+
+class FakePool:
+    def acquire(self):
+        return FakeAcquire()
+
+
+class FakeAcquire:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def fake_top(monkeypatch, top):
+    monkeypatch.setattr(main, 'LEADERBOARD_TOP', top)
+    monkeypatch.setattr(main.bot, 'db_pool', FakePool())
+    main.bot.db_ready.set()
+
+
+def test_update_during_load_is_not_lost(monkeypatch):
+    cache = main.LeaderboardCache(size=3, max_guilds=10)
+
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_top(conn, guild_id, size):
+            started.set()
+            await release.wait()
+            return [{'user_id': 1, 'balance': 10.0, 'level': 1}]
+        fake_top(monkeypatch, slow_top)
+
+        task = asyncio.create_task(cache.get(1))
+        await started.wait()
+        cache.update(1, 2, balance=99.0, level=1)
+        release.set()
+        await task
+        # Снимок мог не увидеть начисление — в кэш он не попал
+        assert 1 not in cache._boards
+
+    asyncio.run(scenario())
+
+
+def test_guilds_are_evicted_least_recently_used_first(monkeypatch):
+    async def top(conn, guild_id, size):
+        return []
+    fake_top(monkeypatch, top)
+
+    async def scenario():
+        cache = main.LeaderboardCache(size=3, max_guilds=2)
+        for guild_id in (1, 2, 1, 3):
+            await cache.get(guild_id)
+        assert list(cache._boards) == [1, 3]
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import random
+from datetime import datetime
+
+import asyncpg
+import pytest
+
+import main
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')  # отдельная PostgreSQL для проверки SQL-формул
+
+
+def loop_apply_xp(level, xp, amount):
+    """Исходный цикл начисления XP, который заменили формулой"""
+    xp += amount
+    next_level_xp = level * 100
+    while xp >= next_level_xp:
+        level += 1
+        xp -= next_level_xp
+        next_level_xp = level * 100
+    return level, xp
+
+
+def xp_cases(count=2000, seed=2):
+    """Случайные (level, xp, amount) и границы уровней; xp всегда в пределах своего уровня"""
+    rng = random.Random(seed)
+    cases = []
+    for level in (1, 2, 3, 10, 99, 100, 1000):
+        for xp in (0, 1, level * 100 - 1):
+            for amount in (0, 1, level * 100 - xp - 1, level * 100 - xp, level * 100 - xp + 1, 10 ** 6):
+                cases.append((level, xp, amount))
+    for _ in range(count):
+        level = rng.randint(1, 500)
+        cases.append((level, rng.randrange(level * 100), rng.choice([rng.randint(0, 300), rng.randint(0, 10 ** 7)])))
+    return cases
+
+
+@pytest.mark.parametrize("level, xp, amount", xp_cases())
+def test_apply_xp_matches_loop(level, xp, amount):
+    assert main.apply_xp(level, xp, amount) == loop_apply_xp(level, xp, amount)
+
+
+def test_level_boundaries():
+    for level in range(1, 2000):
+        assert main.level_from_total(main.level_base(level)) == level
+    for level in range(2, 2000):
+        assert main.level_from_total(main.level_base(level) - 1) == level - 1
+    assert main.level_from_total(-5) == 1
+
+
+async def check_sql_levels(pool):
+    """XP_ADD и сброс буфера на настоящей БД дают то же, что исходный цикл"""
+    cases = xp_cases(count=300)
+    async with pool.acquire() as conn:
+        for user_id, (level, xp, amount) in enumerate(cases):
+            await conn.execute('INSERT INTO xp (user_id, guild_id, xp, level) VALUES ($1, $2, $3, $4)',
+                               user_id, 1, xp, level)
+            await conn.execute('INSERT INTO xp (user_id, guild_id, xp, level) VALUES ($1, $2, $3, $4)',
+                               user_id, 2, xp, level)
+
+        # Точечное начисление
+        for user_id, (level, xp, amount) in enumerate(cases):
+            row = await main.XP_ADD(conn, user_id, 1, amount)
+            assert (row['level'], row['xp']) == loop_apply_xp(level, xp, amount)
+
+        # Пачка буфера: тот же прирост одним запросом, плюс игрок без записи
+        ids = list(range(len(cases))) + [len(cases)]
+        amounts = [amount for _, _, amount in cases] + [12345]
+        zeros = [0] * len(ids)
+        await main.ACTIVITY_FLUSH(conn, ids, [2] * len(ids), zeros, [0.0] * len(ids), amounts, zeros,
+                                  main.hour_bucket(datetime.now()))
+        rows = {row['user_id']: (row['level'], row['xp'])
+                for row in await conn.fetch('SELECT user_id, level, xp FROM xp WHERE guild_id = 2')}
+    for user_id, (level, xp, amount) in enumerate(cases):
+        assert rows[user_id] == loop_apply_xp(level, xp, amount)
+    assert rows[len(cases)] == loop_apply_xp(1, 0, 12345)
+
+
+def test_sql_levels_sqlite(sqlite_db):
+    sqlite_db(check_sql_levels)
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL не задан")
+def test_sql_levels_postgres():
+    async def scenario():
+        schema = f"test_levels_{os.getpid()}"
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f'CREATE SCHEMA {schema}')
+        main.bot.db_ready.clear()
+        try:
+            await main.init_db(TEST_DATABASE_URL, server_settings={'search_path': schema})
+            await check_sql_levels(main.bot.db_pool)
+        finally:
+            if main.bot.db_pool is not None:
+                await main.bot.db_pool.close()
+                main.bot.db_pool = None
+            await admin.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+            await admin.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import main
+
+
+def scrape():
+    values = {}
+    for line in main.metrics.render().splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_cache_and_buffer_counters_are_exported(monkeypatch):
+    buffer = main.ActivityBuffer(5, 100)
+    buffer.add(1, 1, messages=1)
+    buffer.add(2, 1, messages=1)
+    buffer.flushes, buffer.total_flush_ms, buffer.last_flush_ms = 4, 250.0, 50.0
+    monkeypatch.setattr(main, 'activity_buffer', buffer)
+
+    cache = main.AIResponseCache(60, 10)
+    cache.hits, cache.misses, cache.saved_seconds = 3, 1, 12.5
+    monkeypatch.setattr(main, 'ai_cache', cache)
+
+    board = main.LeaderboardCache(10, 10)
+    board.hits, board.misses = 9, 1
+    monkeypatch.setattr(main, 'leaderboard', board)
+
+    values = scrape()
+    assert values['activity_buffer_pending_events'] == 2
+    assert values['activity_buffer_pending_users'] == 2
+    assert values['activity_flushes_total'] == 4
+    assert values['activity_flush_last_seconds'] == 0.05
+    assert values['activity_flush_seconds_total'] == 0.25
+    assert values['ai_cache_hit_ratio'] == 0.75
+    assert values['ai_cache_saved_seconds_total'] == 12.5
+    assert values['leaderboard_cache_hits_total'] == 9
+    assert values['leaderboard_cache_misses_total'] == 1
+    assert values['leaderboard_cache_hit_ratio'] == 0.9
+    assert '# TYPE ai_cache_hits_total counter' in main.metrics.render()
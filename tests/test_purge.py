@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class Response:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+
+@pytest.mark.parametrize("minutes", [0, -5])
+def test_purge_rejects_non_positive_minutes(minutes):
+    interaction = SimpleNamespace(guild_id=1, response=Response())
+    asyncio.run(main.purge_command.callback(interaction, 10, minutes=minutes))
+    (content, kwargs), = interaction.response.sent
+    assert content.startswith("❌")
+    assert kwargs.get('ephemeral') is True
+    assert 1 not in main.purge_jobs
+
+
+class Channel:
+    name = "general"
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.bulk = []
+
+    async def history(self, limit=None, after=None, oldest_first=False):
+        for message in self.messages:
+            yield message
+
+    async def delete_messages(self, messages, reason=None):
+        self.bulk.append([message.id for message in messages])
+
+
+class Message:
+    pinned = False
+
+    def __init__(self, id, created_at, author=1):
+        self.id = id
+        self.created_at = created_at
+        self.author = SimpleNamespace(id=author)
+        self.single = False
+
+    async def delete(self):
+        self.single = True
+
+
+def test_purge_stops_after_max_scan_and_reports_it(monkeypatch):
+    monkeypatch.setattr(main, 'PURGE_SINGLE_DELETE_DELAY', 0)
+    now = main.discord.utils.utcnow()
+    channels = [Channel([Message(i, now, author=2) for i in range(60)]) for _ in range(2)]
+    channels[1].messages.append(Message(100, now))
+    job = main.PurgeJob(channels, 10, lambda message: message.author.id == 1, max_scan=100)
+    asyncio.run(job.run())
+    assert job.scanned == 100
+    assert job.deleted == 0
+    assert "Просмотрено: 100 из 100" in job.progress()
+    assert "предел" in job.progress()
+
+
+def test_purge_rechecks_bulk_cutoff_for_each_batch(monkeypatch):
+    monkeypatch.setattr(main, 'PURGE_SINGLE_DELETE_DELAY', 0)
+    start = main.discord.utils.utcnow()
+    clock = [start]
+    monkeypatch.setattr(main.discord.utils, 'utcnow', lambda: clock[0])
+    edge = start - main.PURGE_BULK_MAX_AGE
+    messages = [Message(i, edge + main.timedelta(minutes=3, seconds=-i)) for i in range(150)]
+
+    class SlowChannel(Channel):
+        async def history(self, **kwargs):
+            for message in self.messages:
+                # Обход идёт медленно: к концу первой сотни прошло больше запаса до границы
+                clock[0] += main.timedelta(seconds=2)
+                yield message
+
+    channel = SlowChannel(messages)
+    job = main.PurgeJob([channel], 1000, lambda message: True)
+    asyncio.run(job.run())
+    # Когда пачки набрались, все сообщения уже старше границы: bulk delete отклонил бы их целиком
+    assert channel.bulk == []
+    assert all(message.single for message in messages)
+    assert job.deleted == 150
@@ -0,0 +1,88 @@
+import asyncio
+import random
+
+import main
+
+
+def check_tree(tree, keys):
+    assert len(tree) == len(keys)
+    for probe in keys + [(-1.0, 0), (10 ** 9, 0)]:
+        assert tree.count_greater(probe) == sum(key > probe for key in keys)
+
+
+def test_rank_tree_matches_sorted_list_under_random_updates():
+    rng = random.Random(3)
+    keys = sorted({(float(rng.randint(0, 50)), user_id) for user_id in range(200)})
+    tree = main.RankTree(keys)
+    check_tree(tree, keys)
+    for _ in range(300):
+        if keys and rng.random() < 0.5:
+            key = keys.pop(rng.randrange(len(keys)))
+            tree.remove(key)
+        else:
+            key = (float(rng.randint(0, 50)), rng.randint(1000, 10 ** 6))
+            if key in keys:
+                continue
+            keys.append(key)
+            tree.insert(key)
+        assert len(tree) == len(keys)
+    check_tree(tree, sorted(keys))
+
+
+def test_rank_tree_bulk_build_has_correct_sizes():
+    for n in (0, 1, 2, 7, 1000):
+        keys = [(float(i), i) for i in range(n)]
+        tree = main.RankTree(reversed(keys))
+        check_tree(tree, keys)
+
+
+def test_remove_missing_key_changes_nothing():
+    tree = main.RankTree([(1.0, 1), (2.0, 2)])
+    tree.remove((1.0, 5))
+    assert len(tree) == 2
+
+
+def test_guild_rank_positions_and_ties():
+    rank = main.GuildRank([{'user_id': 1, 'balance': 50.0}, {'user_id': 2, 'balance': 50.0},
+                           {'user_id': 3, 'balance': 10.0}])
+    # Равные балансы делят место, как COUNT(*) + 1 в RANK_POSITION
+    assert [rank.position(user_id) for user_id in (1, 2, 3)] == [1, 1, 3]
+    assert rank.position(99) == 4
+    rank.set(3, 60.0)
+    assert [rank.position(user_id) for user_id in (3, 1, 2)] == [1, 2, 2]
+    assert len(rank.tree) == 3
+
+
+def test_in_memory_rank_matches_sql(sqlite_db):
+    rng = random.Random(7)
+    balances = {user_id: float(rng.randint(0, 20)) for user_id in range(1, 60)}
+
+    async def scenario(pool):
+        async with pool.acquire() as conn:
+            for user_id, balance in balances.items():
+                await conn.execute('INSERT INTO coins (user_id, guild_id, balance) VALUES ($1, 1, $2)',
+                                   user_id, balance)
+            memory = main.RankService(in_memory=True)
+            sql = main.RankService(in_memory=False)
+            for user_id in list(balances) + [999]:
+                assert await memory.position(1, user_id, conn) == await sql.position(1, user_id, conn)
+
+            # Начисление после загрузки обновляет дерево без перечитывания
+            await conn.execute('UPDATE coins SET balance = 100 WHERE user_id = 5 AND guild_id = 1')
+            memory.update(1, 5, 100.0)
+            assert await memory.position(1, 5, conn) == await sql.position(1, 5, conn) == 1
+
+    sqlite_db(scenario)
+
+
+def test_updates_during_load_are_applied(monkeypatch):
+    service = main.RankService(in_memory=True)
+
+    async def balances_with_concurrent_update(conn, guild_id):
+        # Пока грузятся балансы, приходит начисление
+        service.update(guild_id, 2, 500.0)
+        return [{'user_id': 1, 'balance': 100.0}, {'user_id': 2, 'balance': 1.0}]
+    monkeypatch.setattr(main, 'RANK_BALANCES', balances_with_concurrent_update)
+
+    assert asyncio.run(service.position(1, 2, conn=None)) == 1
+    assert service.stats()["entries"] == 2
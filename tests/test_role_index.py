@@ -0,0 +1,105 @@
+import random
+from types import SimpleNamespace
+
+import main
+
+GUILD_ID = 1
+
+
+class Guild:
+    id = GUILD_ID
+
+    def __init__(self, roles):
+        self.roles = {role.id: role for role in roles}
+        self._members = {}
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def set_roles(self, member_id, role_ids):
+        roles = [self.roles[GUILD_ID]] + sorted((self.roles[i] for i in role_ids), key=lambda role: role.position)
+        self._members[member_id] = SimpleNamespace(id=member_id, roles=roles, top_role=roles[-1],
+                                                   mention=f"<@{member_id}>")
+
+
+def make_guild():
+    roles = [SimpleNamespace(id=GUILD_ID, position=0, name="@everyone")]
+    roles += [SimpleNamespace(id=100 + i, position=i, name=f"роль {i}") for i in range(1, 6)]
+    return Guild(roles)
+
+
+def role_ids(member):
+    return {role.id for role in member.roles if role.id != GUILD_ID}
+
+
+def brute_force(guild, *wanted):
+    return {member.id for member in guild.members if role_ids(member) & set(wanted)}
+
+
+def test_index_follows_random_role_changes():
+    rng = random.Random(5)
+    guild = make_guild()
+    for member_id in range(1, 40):
+        guild.set_roles(member_id, set(rng.sample(range(101, 106), rng.randint(0, 3))))
+    index = main.RoleIndex()
+    assert index.holder_ids(guild, 101) == brute_force(guild, 101)
+
+    for _ in range(300):
+        member_id = rng.randint(1, 45)
+        member = guild.get_member(member_id)
+        before = role_ids(member) if member else set()
+        after = set(rng.sample(range(101, 106), rng.randint(0, 3)))
+        guild.set_roles(member_id, after)
+        index.update_member(guild, member_id, before, after)
+        wanted = rng.sample(range(101, 106), 2)
+        assert index.holder_ids(guild, *wanted) == brute_force(guild, *wanted)
+    assert index.builds == 1
+
+
+def test_render_is_cached_until_a_holder_changes():
+    guild = make_guild()
+    guild.set_roles(1, {105})
+    guild.set_roles(2, {103})
+    index = main.RoleIndex()
+    assert index.render(guild, 103, 105) == "• <@1> — роль 5\n• <@2> — роль 3"
+    index.render(guild, 103, 105)
+    assert index.renders == 1
+
+    # Изменение другой роли кэш не сбрасывает, изменение нужной — сбрасывает
+    guild.set_roles(3, {101})
+    index.update_member(guild, 3, set(), {101})
+    index.render(guild, 103, 105)
+    assert index.renders == 1
+    guild.set_roles(3, {101, 104})
+    index.update_member(guild, 3, {101}, {101, 104})
+    assert index.render(guild, 103, 104, 105) == "• <@1> — роль 5\n• <@3> — роль 4\n• <@2> — роль 3"
+    index.update_member(guild, 2, {103}, set())
+    assert "<@2>" not in index.render(guild, 103, 105)
+
+
+def test_dropped_role_and_guild_are_forgotten():
+    guild = make_guild()
+    guild.set_roles(1, {101, 102})
+    index = main.RoleIndex()
+    index.render(guild, 101)
+    index.drop_role(guild, 101)
+    assert index.holder_ids(guild, 101) == set()
+    assert index.holder_ids(guild, 102) == {1}
+    assert index.stats()["rendered"] == 0
+
+    index.drop_guild(GUILD_ID)
+    assert index.stats()["guilds"] == 0
+
+
+def test_updates_before_first_build_are_ignored():
+    guild = make_guild()
+    index = main.RoleIndex()
+    guild.set_roles(1, {101})
+    index.update_member(guild, 1, set(), {101})
+    assert index.stats()["guilds"] == 0
+    # Индекс строится из текущего состояния сервера
+    assert index.holder_ids(guild, 101) == {1}
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_schema_ddl_runs_under_advisory_lock(sqlite_db, query_counter):
+    async def scenario(pool):
+        queries = [" ".join(query.split()) for query in query_counter.queries]
+        lock = queries.index('SELECT pg_advisory_lock($1)')
+        unlock = queries.index('SELECT pg_advisory_unlock($1)')
+        ddl = [i for i, query in enumerate(queries) if query.startswith(('CREATE', 'INSERT INTO schema_migrations'))]
+        assert ddl and all(lock < i < unlock for i in ddl)
+        assert queries.count('SELECT pg_advisory_lock($1)') == 1
+
+    sqlite_db(scenario, init=query_counter.attach)
+
+
+def test_missing_database_url_fails_instead_of_falling_back_to_sqlite(tmp_path, monkeypatch):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(RuntimeError, match="DATABASE_URL"):
+        asyncio.run(main.init_db())
+    assert not list(tmp_path.iterdir())
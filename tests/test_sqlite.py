@@ -0,0 +1,120 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+ENDLESS = 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) FROM n'
+
+
+def run_pool(tmp_path, test, size=2):
+    async def scenario():
+        pool = await main.SqlitePool.open(str(tmp_path / 'test.db'), size)
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute('CREATE TABLE t (id BIGINT PRIMARY KEY, n INTEGER NOT NULL)')
+            return await test(pool)
+        finally:
+            await pool.close()
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("pg, expected", [
+    ("SELECT $1, $2, $10", "SELECT ?1, ?2, ?10"),
+    ("SELECT $1::BIGINT, $2::TEXT[]", "SELECT ?1, ?2"),
+    ("WHERE user_id = ANY($1::BIGINT[]) AND guild_id = $2",
+     "WHERE user_id IN (SELECT value FROM json_each(?1)) AND guild_id = ?2"),
+    ("id SERIAL PRIMARY KEY, at TIMESTAMP DEFAULT NOW()",
+     "id INTEGER PRIMARY KEY AUTOINCREMENT, at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+    ("COALESCE(MAX(x), '-Infinity'::REAL)", "COALESCE(MAX(x), -9e999)"),
+    ("INSERT INTO t VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET n = t.n + EXCLUDED.n RETURNING n",
+     "INSERT INTO t VALUES (?1, ?2) ON CONFLICT (id) DO UPDATE SET n = t.n + EXCLUDED.n RETURNING n"),
+])
+def test_sqlite_sql_translates_postgres_syntax(pg, expected):
+    assert main.sqlite_sql(pg) == expected
+
+
+def test_upsert_returning_and_any_run_on_sqlite(tmp_path):
+    async def scenario(pool):
+        upsert = 'INSERT INTO t VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET n = t.n + EXCLUDED.n RETURNING n'
+        assert await pool.fetchval(upsert, 1, 5) == 5
+        assert await pool.fetchval(upsert, 1, 3) == 8
+        await pool.execute(upsert, 2, 1)
+        await pool.execute(upsert, 3, 1)
+        rows = await pool.fetch('SELECT id FROM t WHERE id = ANY($1::BIGINT[]) ORDER BY id', [1, 3, 4])
+        assert [row['id'] for row in rows] == [1, 3]
+        assert await pool.fetchrow('SELECT n FROM t WHERE id = $1', 99) is None
+    run_pool(tmp_path, scenario)
+
+
+def test_record_behaves_like_asyncpg_record(tmp_path):
+    async def scenario(pool):
+        row = await pool.fetchrow('SELECT 1 AS id, $1 AS name', 'x')
+        assert row[0] == row['id'] == row.id == 1
+        assert dict(row) == {'id': 1, 'name': 'x'}
+        assert row.get('missing', 7) == 7
+        with pytest.raises(KeyError):
+            row['missing']
+        with pytest.raises(AttributeError):
+            row.missing
+    run_pool(tmp_path, scenario)
+
+
+def test_transaction_rolls_back_on_error(tmp_path):
+    async def scenario(pool):
+        async with pool.acquire() as conn:
+            with pytest.raises(ZeroDivisionError):
+                async with conn.transaction():
+                    await conn.execute('INSERT INTO t VALUES ($1, $2)', 1, 1)
+                    1 / 0
+            async with conn.transaction():
+                await conn.execute('INSERT INTO t VALUES ($1, $2)', 2, 2)
+        assert [row['id'] for row in await pool.fetch('SELECT id FROM t')] == [2]
+    run_pool(tmp_path, scenario)
+
+
+def test_call_runs_in_one_transaction(tmp_path):
+    def insert_then_fail(db, ids):
+        for i in ids:
+            db.execute('INSERT INTO t VALUES (?, 0)', (i,))
+        raise ValueError("после вставки")
+
+    async def scenario(pool):
+        with pytest.raises(ValueError):
+            await pool.call(insert_then_fail, [1, 2])
+        assert await pool.fetchval('SELECT count(*) FROM t') == 0
+    run_pool(tmp_path, scenario)
+
+
+def test_cancelled_query_is_interrupted_and_rolled_back(tmp_path):
+    async def scenario(pool):
+        async with pool.acquire() as conn:
+            async def endless_in_transaction():
+                async with conn.transaction():
+                    await conn.execute('INSERT INTO t VALUES ($1, $2)', 1, 1)
+                    await conn.fetchval(ENDLESS)
+
+            task = asyncio.create_task(endless_in_transaction())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(task, 5)
+            # Соединение снова пригодно, а вставка из прерванной транзакции не сохранилась
+            assert await conn.fetchval('SELECT count(*) FROM t') == 0
+            await conn.execute('INSERT INTO t VALUES ($1, $2)', 2, 2)
+        assert await pool.fetchval('SELECT count(*) FROM t') == 1
+    run_pool(tmp_path, scenario)
+
+
+def test_pool_returns_connection_after_error(tmp_path):
+    async def scenario(pool):
+        with pytest.raises(sqlite3.OperationalError):
+            await pool.execute('SELECT * FROM missing_table')
+        assert pool.get_idle_size() == pool.get_size() == 2
+        async with pool.acquire():
+            async with pool.acquire():
+                with pytest.raises(asyncio.TimeoutError):
+                    async with pool.acquire(timeout=0.05):
+                        pass
+    run_pool(tmp_path, scenario)
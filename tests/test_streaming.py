@@ -0,0 +1,105 @@
+import asyncio
+import random
+import re
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+LIMIT = main.DISCORD_MESSAGE_LIMIT
+
+
+def squash(text):
+    return re.sub(r"\s", "", text)
+
+
+def test_short_text_is_one_chunk():
+    assert main.split_message("привет") == ["привет"]
+    assert main.split_message("x" * LIMIT) == ["x" * LIMIT]
+
+
+def test_split_prefers_line_breaks_then_spaces():
+    text = "а" * 1500 + "\n" + "б" * 1000 + " " + "в" * 300
+    assert main.split_message(text) == ["а" * 1500, "б" * 1000 + " " + "в" * 300]
+    text = "слово " * 500
+    chunks = main.split_message(text)
+    assert all(chunk.endswith("слово") for chunk in chunks[:-1])
+
+
+def test_split_cuts_text_without_breaks_at_the_limit():
+    assert main.split_message("x" * (LIMIT * 2 + 5)) == ["x" * LIMIT, "x" * LIMIT, "x" * 5]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_split_keeps_all_text_within_the_limit(seed):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("абвгд") for _ in range(rng.randint(1, 300))) for _ in range(rng.randint(1, 100))]
+    text = "".join(word + rng.choice([" ", "\n", "", "  "]) for word in words)
+    chunks = main.split_message(text)
+    assert all(len(chunk) <= LIMIT for chunk in chunks)
+    assert squash("".join(chunks)) == squash(text)
+
+
+class Message:
+    def __init__(self, content):
+        self.history = [content]
+
+    async def edit(self, content):
+        self.history.append(content)
+
+
+class Followup:
+    def __init__(self):
+        self.messages = []
+        self.plain = []
+
+    async def send(self, content, wait=False):
+        if not wait:
+            self.plain.append(content)
+            return None
+        message = Message(content)
+        self.messages.append(message)
+        return message
+
+
+def stream(deltas, interval):
+    followup = Followup()
+    reply = main.StreamingReply(SimpleNamespace(followup=followup), interval=interval)
+
+    async def scenario():
+        for delta in deltas:
+            await reply.feed(delta)
+        return await reply.finish()
+    return asyncio.run(scenario()), followup
+
+
+def test_stream_edits_one_message_until_the_limit():
+    answer, followup = stream(["Пр", "ив", "ет"], interval=0)
+    assert answer == "Привет"
+    message, = followup.messages
+    assert message.history == ["Пр", "Прив", "Привет"]
+
+
+def test_stream_throttles_edits():
+    answer, followup = stream(["a"] * 50, interval=10 ** 9)
+    message, = followup.messages
+    # Первая правка — только при завершении
+    assert message.history == ["a" * 50]
+
+
+def test_long_stream_continues_in_new_messages():
+    deltas = [f"строка {i}\n" for i in range(600)]
+    answer, followup = stream(deltas, interval=0)
+    assert answer == "".join(deltas)
+    finals = [message.history[-1] for message in followup.messages]
+    assert len(finals) > 1
+    assert all(len(content) <= LIMIT for message in followup.messages for content in message.history)
+    assert squash("".join(finals)) == squash(answer)
+
+
+def test_empty_stream_reports_empty_answer():
+    answer, followup = stream([" ", "\n"], interval=0)
+    assert answer == " \n"
+    assert followup.messages == []
+    assert followup.plain == ["🤷 Нейросеть вернула пустой ответ"]
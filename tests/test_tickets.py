@@ -0,0 +1,129 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import main
+
+
+def test_open_keeps_memory_and_db_in_sync_when_save_fails(sqlite_db, monkeypatch):
+    async def scenario(pool):
+        registry = main.TicketRegistry(max_per_guild=1)
+        assert registry.reserve(1, 10) is None
+
+        async def broken_save(conn, *args):
+            raise RuntimeError("БД недоступна")
+        with monkeypatch.context() as patch:
+            patch.setattr(main, 'OPEN_TICKET_SAVE', broken_save)
+            with pytest.raises(RuntimeError):
+                await registry.open(1, 10, 500)
+        # Резерв снят, канал не запомнен, место под лимит свободно
+        assert registry.get(1, 10) is None
+        assert registry.opener(500) is None
+        assert registry.reserve(1, 10) is None
+
+        await registry.open(1, 10, 501)
+        assert registry.get(1, 10) == 501
+        assert [tuple(row) for row in await pool.fetch('SELECT guild_id, user_id, channel_id FROM open_tickets')] \
+            == [(1, 10, 501)]
+
+    sqlite_db(scenario)
+
+
+def test_reserve_enforces_one_ticket_per_user_and_guild_limit():
+    registry = main.TicketRegistry(max_per_guild=2)
+    assert registry.reserve(1, 10) is None
+    assert registry.reserve(1, 10) == "❌ Тикет уже создаётся"
+    assert registry.reserve(1, 11) is None
+    assert registry.reserve(1, 12).startswith("❌ Слишком много")
+    # Лимит — на сервер
+    assert registry.reserve(2, 12) is None
+
+    # Канал не создался — место освобождается
+    registry.release(1, 11)
+    assert registry.reserve(1, 12) is None
+
+
+def test_release_keeps_an_opened_ticket(sqlite_db):
+    async def scenario(pool):
+        registry = main.TicketRegistry(max_per_guild=5)
+        registry.reserve(1, 10)
+        await registry.open(1, 10, 500)
+        registry.release(1, 10)
+        assert registry.get(1, 10) == 500
+        assert registry.reserve(1, 10) == "❌ Тикет уже есть: <#500>"
+
+    sqlite_db(scenario)
+
+
+def test_close_load_and_reconcile(sqlite_db, monkeypatch):
+    async def scenario(pool):
+        registry = main.TicketRegistry(max_per_guild=5)
+        for user_id, channel_id in ((10, 500), (11, 501), (12, 502)):
+            registry.reserve(1, user_id)
+            await registry.open(1, user_id, channel_id)
+        await registry.close(500)
+        await registry.close(999)  # не тикет
+        assert registry.get(1, 10) is None and registry.opener(501) == 11
+
+        # После перезапуска реестр восстанавливается из БД
+        restored = main.TicketRegistry(max_per_guild=5)
+        await restored.load()
+        assert (restored.opener(501), restored.opener(502), restored.opener(500)) == (11, 12, None)
+
+        # Канал 502 удалили, пока бот был офлайн
+        guild = SimpleNamespace(get_channel=lambda channel_id: object() if channel_id == 501 else None)
+        monkeypatch.setattr(main.bot, 'get_guild', lambda guild_id: guild)
+        await restored.reconcile()
+        assert restored.opener(502) is None
+        assert [row['channel_id'] for row in await pool.fetch('SELECT channel_id FROM open_tickets')] == [501]
+        assert restored.reserve(1, 12) is None
+
+    sqlite_db(scenario)
+
+
+class Archive:
+    def __init__(self, limit, reject_files=False):
+        self.guild = SimpleNamespace(filesize_limit=limit)
+        self.reject_files = reject_files
+        self.sent = []
+
+    async def send(self, embed=None, file=None):
+        if file is not None and self.reject_files:
+            raise discord.HTTPException(SimpleNamespace(status=413, reason="Payload Too Large"), "too large")
+        self.sent.append((embed, file.filename if file else None, file.fp.read() if file else None))
+        return SimpleNamespace(id=len(self.sent))
+
+
+def make_embed():
+    return discord.Embed(title="📦 ticket-1")
+
+
+def test_transcript_within_limit_is_one_file():
+    archive = Archive(limit=100)
+    message = asyncio.run(main.upload_transcript(archive, make_embed(), io.BytesIO(b"z" * 100), "t.zip"))
+    assert message.id == 1
+    assert [(name, len(data)) for _, name, data in archive.sent] == [("t.zip", 100)]
+
+
+def test_large_transcript_is_split_into_parts():
+    archive = Archive(limit=40)
+    data = bytes(range(100))
+    message = asyncio.run(main.upload_transcript(archive, make_embed(), io.BytesIO(data), "t.zip"))
+    assert message.id == 1
+    assert [name for _, name, _ in archive.sent] == ["t.zip.001", "t.zip.002", "t.zip.003"]
+    assert b"".join(part for _, _, part in archive.sent) == data
+    assert archive.sent[0][0] is not None and archive.sent[1][0] is None
+
+
+# Частей больше ARCHIVE_MAX_PARTS или Discord всё равно ответил 413 на файл
+@pytest.mark.parametrize("limit, reject_files", [(10, False), (1000, True)])
+def test_oversized_transcript_degrades_to_embed_only(monkeypatch, limit, reject_files):
+    monkeypatch.setattr(main, 'ARCHIVE_MAX_PARTS', 5)
+    archive = Archive(limit=limit, reject_files=reject_files)
+    asyncio.run(main.upload_transcript(archive, make_embed(), io.BytesIO(b"z" * 100), "t.zip"))
+    (embed, name, _), = archive.sent
+    assert name is None
+    assert embed.fields[-1].name == "⚠️ Транскрипт"
@@ -0,0 +1,34 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import main
+
+
+def test_worker_zero_expires_warns_issued_on_other_workers(sqlite_db, monkeypatch):
+    monkeypatch.setattr(main, 'WARN_LIFETIME', timedelta(seconds=1))
+
+    async def scenario(pool):
+        # Воркер 0 крутит планировщик, у воркера 1 он не запущен и schedule() ничего не делает
+        worker0 = main.WarnExpiryScheduler(poll_interval=0.2)
+        worker1 = main.WarnExpiryScheduler(poll_interval=0.2)
+        worker0.start()
+        try:
+            await asyncio.sleep(0.05)
+            now = datetime.now()
+            local_id = await main.WARN_INSERT(pool, 1, 1, 0, "на воркере 0", now)
+            worker0.schedule(local_id, now)
+            remote_id = await main.WARN_INSERT(pool, 2, 2, 0, "на воркере 1", now)
+            worker1.schedule(remote_id, now)
+            assert worker1.stats()["scheduled"] == 0
+
+            for _ in range(50):
+                if worker0.expired == 2:
+                    break
+                await asyncio.sleep(0.1)
+            assert worker0.expired == 2
+            expired = {row['id']: row['expired'] for row in await pool.fetch('SELECT id, expired FROM warns')}
+            assert expired == {local_id: True, remote_id: True}
+        finally:
+            await worker0.stop()
+
+    sqlite_db(scenario)